@@ -0,0 +1,230 @@
+import glob
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from log_utils import log_context
+from storage_state import STORAGE_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# アカウントごとの巡回間隔・全体の同時実行数・同一アカウントへのリクエスト最小間隔（秒）
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL_SECONDS", "300"))
+POLL_MAX_CONCURRENCY = int(os.getenv("POLL_MAX_CONCURRENCY", "2"))
+POLL_MIN_SPACING = float(os.getenv("POLL_MIN_SPACING_SECONDS", "30"))
+# 失敗が続いたときの待ち時間の上限
+POLL_MAX_BACKOFF = 1800.0
+
+
+def discover_accounts(cookies_dir):
+    """cookies/<email>_storage.json からアカウント（メールアドレス）一覧を作る"""
+    pattern = os.path.join(cookies_dir, f"*{STORAGE_SUFFIX}")
+    return sorted(os.path.basename(path)[:-len(STORAGE_SUFFIX)] for path in glob.glob(pattern))
+
+
+class AccountState:
+    """アカウントごとの巡回状況"""
+
+    def __init__(self, email, interval):
+        self.email = email
+        self.interval = interval
+        self.next_due = 0.0
+        self.last_request_at = 0.0
+        self.queued = 0
+        self.in_flight = False
+        self.last_sync_at = None
+        self.last_latency = None
+        self.last_message_count = None
+        self.last_error = None
+        self.failures = 0
+        self.polls = 0
+
+    def snapshot(self):
+        return {
+            "email": self.email,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "interval_s": self.interval,
+            "last_sync_at": self.last_sync_at,
+            "last_sync_latency_s": round(self.last_latency, 2) if self.last_latency is not None else None,
+            "messages": self.last_message_count,
+            "polls": self.polls,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class AccountPoller:
+    """複数アカウントの受信箱を、それぞれの間隔で並行して巡回する
+
+    poll(email) は各アカウントのメッセージ一覧を返す関数（通常は共有ブラウザ上で取得する）。
+    一覧を読めなかったときは例外を送出させ、失敗として間隔を空けて再試行する（on_result は呼ばない）。
+    1アカウントにつき同時に1件までしか実行せず、期限の早いアカウントから順に
+    max_concurrency 件まで並行に処理する。同じアカウントへのリクエストは
+    min_spacing 秒以上空けるので、1つのアカウントが他を押しのけることはない。
+    """
+
+    def __init__(self, cookies_dir, poll, on_result=None, interval=POLL_INTERVAL,
+                 max_concurrency=POLL_MAX_CONCURRENCY, min_spacing=POLL_MIN_SPACING, intervals=None):
+        self.cookies_dir = cookies_dir
+        self._poll = poll
+        self._on_result = on_result
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_spacing = min_spacing
+        self._accounts = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._in_flight = 0
+        self._started_once = False
+
+    # --- 操作 ---
+
+    def configure(self, poll=None, on_result=None):
+        """巡回関数・結果コールバックを差し替える（次の巡回から有効）"""
+        with self._lock:
+            if poll is not None:
+                self._poll = poll
+            if on_result is not None:
+                self._on_result = on_result
+
+    def start(self):
+        with self._lock:
+            if self._poll is None:
+                raise RuntimeError("巡回関数が設定されていません")
+            if self._thread is not None and self._thread.is_alive():
+                return self
+            self._stop.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="account-poll")
+            self._thread = threading.Thread(target=self._scheduler, name="account-poller", daemon=True)
+            self._thread.start()
+            self._started_once = True
+        logger.info("アカウント巡回を開始しました（同時実行数 %d）", self.max_concurrency)
+        return self
+
+    def start_once(self):
+        """プロセス内で最初の1回だけ開始する（利用者が停止した後は自動で再開しない）"""
+        with self._lock:
+            if self._started_once:
+                return self
+        return self.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("アカウント巡回を停止しました")
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def poll_now(self, email=None):
+        """指定アカウント（省略時は全アカウント）を次の巡回で即時に取得する"""
+        with self._lock:
+            for state in self._accounts.values():
+                if email is None or state.email == email:
+                    state.next_due = 0.0
+        self._wakeup.set()
+
+    def status(self):
+        """アカウントごとのキュー深さ・最終同期時刻・所要時間"""
+        with self._lock:
+            return [state.snapshot() for state in sorted(self._accounts.values(), key=lambda s: s.email)]
+
+    # --- スケジューラー ---
+
+    def _refresh_accounts(self):
+        emails = discover_accounts(self.cookies_dir)
+        with self._lock:
+            for email in emails:
+                if email not in self._accounts:
+                    self._accounts[email] = AccountState(email, self.intervals.get(email, self.interval))
+            for email in list(self._accounts):
+                if email not in emails and not self._accounts[email].in_flight:
+                    del self._accounts[email]
+
+    def _scheduler(self):
+        while not self._stop.is_set():
+            self._refresh_accounts()
+            now = time.time()
+            with self._lock:
+                due = sorted(
+                    (s for s in self._accounts.values() if not s.in_flight and s.next_due <= now),
+                    key=lambda s: s.next_due
+                )
+                for state in due:
+                    state.queued = 1
+                # 期限の早い順に、空きスロットの分だけ実行する
+                for state in due:
+                    if self._in_flight >= self.max_concurrency:
+                        break
+                    wait = state.last_request_at + self.min_spacing - now
+                    if wait > 0:
+                        state.next_due = now + wait
+                        continue
+                    state.queued = 0
+                    state.in_flight = True
+                    self._in_flight += 1
+                    self._executor.submit(self._run_poll, state)
+                pending = [s.next_due for s in self._accounts.values() if not s.in_flight]
+            timeout = max(0.5, min(pending) - time.time()) if pending else self.interval
+            self._wakeup.wait(min(timeout, 30.0))
+            self._wakeup.clear()
+
+    def _run_poll(self, state):
+        started = time.time()
+        try:
+            with log_context(account=state.email, stage="poll"):
+                state.last_request_at = started
+                messages = self._poll(state.email)
+                if messages is None:
+                    raise RuntimeError("メッセージ一覧を取得できませんでした")
+                latency = time.time() - started
+                with self._lock:
+                    state.last_sync_at = time.time()
+                    state.last_latency = latency
+                    state.last_message_count = len(messages)
+                    state.last_error = None
+                    state.failures = 0
+                    state.polls += 1
+                if self._on_result is not None:
+                    self._on_result(state.email, messages)
+        except Exception as e:
+            logger.warning("アカウント %s の巡回に失敗: %s", state.email, e)
+            with self._lock:
+                state.last_latency = time.time() - started
+                state.last_error = f"{type(e).__name__}: {e}"
+                state.failures += 1
+        finally:
+            with self._lock:
+                delay = state.interval
+                if state.failures:
+                    delay = min(POLL_MAX_BACKOFF, state.interval * (2 ** min(state.failures, 5)))
+                state.next_due = time.time() + delay
+                state.in_flight = False
+                self._in_flight -= 1
+            self._wakeup.set()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_account_poller(cookies_dir, poll=None, on_result=None, **kwargs):
+    """プロセス全体で共有する AccountPoller を返す（初回のみ生成）"""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = AccountPoller(cookies_dir, poll, on_result, **kwargs)
+        return _poller
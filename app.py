@@ -1,46 +1,83 @@
+import time
+# 再実行1回ごとの所要時間の計測用（Streamlit は操作のたびにこのスクリプトを頭から実行し直す）
+_RUN_STARTED = time.perf_counter()
+_RUN_STARTED_AT = time.time()
+
 import streamlit as st
 import os
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
 import openai
-import time
+import logging
+from log_utils import setup_logging, debug, debug_enabled, debug_panel, new_panel_buffer, panel_enabled, log_context, LogSampler
+
+
+@st.cache_resource(show_spinner=False)
+def load_config():
+    """ロギング・.env・OpenAI APIキーの設定（プロセスで1回だけ行い、再実行では使い回す）"""
+    # 環境変数の読み込み（設定を import 時に読むモジュールより先に行う）
+    load_dotenv()
+    # ロギングの設定（.env の LOG_LEVEL も効くよう、読み込んだ後に行う）
+    setup_logging()
+    # OpenAI APIキーの設定
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    openai.api_key = api_key
+    return {
+        "loaded_at": time.time(),
+        # バックグラウンドでの取得・返信の事前生成（0で無効）と、画面の自動更新間隔（秒）
+        "background_sync": os.getenv("BACKGROUND_SYNC", "1") != "0",
+        "ui_refresh_seconds": int(os.getenv("UI_REFRESH_SECONDS", "15")),
+    }
+
+
+CONFIG = load_config()
+_CONFIG_READY = time.perf_counter()
+
+from browser_manager import get_browser_manager, StorageStateNotFound
+from timing import BudgetExceeded, OperationBudget, SEND_CONFIRM_GRACE_MS, FETCH_BUDGET_MS, COOKIE_CHECK_BUDGET_MS, SEND_BUDGET_MS, recent_reports, record_rerun, recent_reruns
+from reply_generator import generate_replies, regenerate_reply, request_reply_with_backoff, cache_key, recent_stream_metrics, recent_usage, usage_totals
+from reply_cache import get_reply_cache
+from sync_state import InboxSyncState, sync_mtime, thread_id
+from account_poller import get_account_poller, POLL_MAX_CONCURRENCY
+from debug_artifacts import start_capture
+from resource_filter import install_resource_filter, totals as resource_filter_totals
+from storage_state import COOKIES_DIR, load_storage_state, save_storage_state, storage_file
+from yyc_http import YYC_BASE_URL, HttpFallback, check_cookie_http, fetch_history_html, fetch_inbox_page, get_cookie_check_cache, send_reply_http
+from conversation_history import ConversationHistory
+from send_queue import get_send_queue
 import json
-import traceback
-from streamlit_autorefresh import st_autorefresh
-import requests
+import queue
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 from datetime import datetime, timedelta
-import pytz
-import re
-import base64
-from io import BytesIO
-import logging
-import pickle
-import os.path
-import subprocess
-import streamlit.components.v1 as components
-import pyperclip
-from streamlit_extras.copy_to_clipboard import copy_to_clipboard_button
-
-# ロギングの設定
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Playwright・streamlit_extras などは使う処理の中で読み込む（起動時間を短くするため）
+
 logger = logging.getLogger(__name__)
+_IMPORTS_READY = time.perf_counter()
 
-# 環境変数の読み込み
-load_dotenv()
+BACKGROUND_SYNC = CONFIG["background_sync"]
+UI_REFRESH_SECONDS = CONFIG["ui_refresh_seconds"]
 
-# OpenAI APIキーの設定
-api_key = os.getenv('OPENAI_API_KEY')
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
+DEFAULT_PERSONA = {
+    "name": "優子",
+    "age": 28,
+    "occupation": "OL",
+    "interests": ["カフェ巡り", "旅行", "料理"],
+    "personality": "明るく、フレンドリー",
+    "writing_style": "カジュアルで親しみやすい"
+}
 
-# OpenAIクライアントの設定
-openai.api_key = api_key
+# メッセージ一覧の1ページに表示する件数（再実行のたびに描画するのはこの件数まで）
+MESSAGES_PER_PAGE = int(os.getenv("MESSAGES_PER_PAGE", "20"))
+
+# メッセージカードの操作（再作成・送信）を同時に実行できる数と、実行中のカードを更新する間隔（秒）
+CARD_MAX_IN_FLIGHT = int(os.getenv("CARD_MAX_IN_FLIGHT", "4"))
+CARD_POLL_SECONDS = float(os.getenv("CARD_POLL_SECONDS", "0.5"))
 
 # クッキー保存用のディレクトリ
-COOKIES_DIR = "cookies"
 os.makedirs(COOKIES_DIR, exist_ok=True)
 
 # セッションステートの初期化
@@ -49,70 +86,64 @@ if 'messages' not in st.session_state:
 if 'last_check' not in st.session_state:
     st.session_state.last_check = None
 if 'persona' not in st.session_state:
-    st.session_state.persona = {
-        "name": "優子",
-        "age": 28,
-        "occupation": "OL",
-        "interests": ["カフェ巡り", "旅行", "料理"],
-        "personality": "明るく、フレンドリー",
-        "writing_style": "カジュアルで親しみやすい"
-    }
+    st.session_state.persona = dict(DEFAULT_PERSONA)
+if 'card_jobs' not in st.session_state:
+    # スレッドID -> 実行中のカード操作（CardJob）
+    st.session_state.card_jobs = {}
+if 'card_notices' not in st.session_state:
+    # スレッドID -> 最後の送信結果 (成功したか, メッセージ)
+    st.session_state.card_notices = {}
 
 # サイドバーにデバッグ表示切り替え（開発者用）
 with st.sidebar:
     show_debug = st.checkbox("🔧 開発者用: デバッグ表示", value=False)
     st.session_state["show_debug"] = show_debug
 
-def log_debug(message):
-    logger.debug(message)
-    if st.session_state.get("show_debug"):
-        st.text(f"DEBUG: {message}")
+def log_debug(message, *args):
+    """デバッグログ（無効時は引数のフォーマットも行わない）"""
+    debug(logger, message, *args)
 
 def log_error(message, error=None):
-    logger.error(message)
-    if st.session_state.get("show_debug"):
-        st.text(f"ERROR: {message}")
-        if error:
-            st.text(f"Error details:\n{traceback.format_exc()}")
-    if error:
-        print(f"Error details:\n{traceback.format_exc()}")
+    logger.error(message, exc_info=error is not None)
+    if panel_enabled():
+        import traceback
+        log_debug("ERROR: %s\n%s", message, traceback.format_exc() if error else "")
+
+def render_debug_panel(panel):
+    """デバッグパネル用チャンネルに溜まったログをサイドバーに表示"""
+    with st.sidebar.expander("🪵 デバッグログ", expanded=False):
+        st.code("\n".join(panel) or "(ログなし)", language="")
 
 def save_cookies(context, email):
-    """ブラウザのセッションストレージを保存（storage_stateを使う）"""
+    """ブラウザのセッションストレージを保存（storage_stateを使う。正規化して原子的に書き込む）"""
     try:
-        storage_file = os.path.join(COOKIES_DIR, f"{email}_storage.json")
-        context.storage_state(path=storage_file)
-        log_debug(f"storage_state を保存しました: {storage_file}")
+        save_storage_state(email, context.storage_state())
+        log_debug("storage_state を保存しました: %s", email)
     except Exception as e:
         log_error("セッション保存エラー（storage_state）", e)
 
-def fix_storage_state_format(filepath):
-    with open(filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    changed = False
-    for cookie in data.get("cookies", []):
-        same_site = cookie.get("sameSite")
-        if same_site not in ["Strict", "Lax", "None"]:
-            cookie["sameSite"] = "None"
-            changed = True
-    if changed:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    return filepath
-
 def load_cookies(browser, email):
-    """保存された storage_state を読み込んで新しい context を生成"""
+    """保存された storage_state を読み込んで新しい context を生成
+
+    storage_state はファイルが変わったときだけ読み込み直し、dict のままPlaywrightに渡す。
+    """
     try:
-        storage_file = os.path.join(COOKIES_DIR, f"{email}_storage.json")
-        if os.path.exists(storage_file):
-            fix_storage_state_format(storage_file)
-            return browser.new_context(storage_state=storage_file)
+        storage_state = load_storage_state(email)
+        if storage_state is not None:
+            context = browser.new_context(storage_state=storage_state)
+            # 画像・フォント・広告などを読み込まないようにする
+            install_resource_filter(context)
+            return context
         else:
             return None
     except Exception as e:
         log_error("セッション復元エラー（storage_state）", e)
         return None
 
+def get_browser():
+    """プロセス全体で共有するブラウザマネージャーを取得"""
+    return get_browser_manager(load_cookies)
+
 def check_session_valid(page):
     """セッションが有効かチェック"""
     try:
@@ -127,7 +158,7 @@ def check_session_valid(page):
         
         for selector in selectors:
             if page.query_selector(selector):
-                log_debug(f"セッション有効: {selector}が見つかりました")
+                log_debug("セッション有効: %sが見つかりました", selector)
                 return True
         
         # ログインページの要素が表示されていないかチェック
@@ -142,547 +173,1132 @@ def check_session_valid(page):
         log_error("セッションチェックエラー", e)
         return False
 
-def get_latest_messages(page):
-    """最新のメッセージを取得（返信URLも含める）"""
+# メッセージ一覧（またはログインフォーム）が描画されたことを示すセレクター
+MESSAGE_LIST_READY_SELECTOR = ".mdl_listBox_simple, .message_listWrap, input[type='password']"
+
+# 履歴ページでメッセージ本文を表す要素
+HISTORY_MESSAGE_SELECTOR = ".message_listWrap .message p, .mdl_listBox_simple .message p, div.message p"
+
+# 一覧のページ送り（1回の取得で読むページ数の上限と、これより古いメッセージは読まない日数。0で無制限）
+FETCH_MAX_PAGES = int(os.getenv("FETCH_MAX_PAGES", "10"))
+FETCH_MAX_AGE_DAYS = float(os.getenv("FETCH_MAX_AGE_DAYS", "0"))
+# 一覧の読み方（http: まずHTTPだけで読み、だめならブラウザ / browser: 常にブラウザ）
+FETCH_MODE = os.getenv("FETCH_MODE", "http")
+# 返信の送り方（http: まずHTTPでフォームを送信し、だめならブラウザ / browser: 常にブラウザ）
+SEND_MODE = os.getenv("SEND_MODE", "http")
+# 返信生成に会話履歴を使うか（0で使わない）
+CONVERSATION_HISTORY = os.getenv("CONVERSATION_HISTORY", "1") != "0"
+
+# メッセージ一覧ページの全行と次ページのURLをブラウザ内で一括抽出するスクリプト
+MESSAGE_EXTRACT_JS = """
+() => {
+    const text = (root, selector, fallback = "") => {
+        const el = root.querySelector(selector);
+        return el ? el.innerText : fallback;
+    };
+    const items = Array.from(document.querySelectorAll(".mdl_listBox_simple, .message_listWrap > div")).map(el => {
+        const link = el.querySelector("a[href^='/my/mail_box/history/?id=']");
+        return {
+            sender: text(el, ".name strong, .thumb + div strong", "不明"),
+            content: text(el, ".message p, .thumb + div p"),
+            time: text(el, ".date, .thumb + div .date"),
+            is_unreplied: !!el.querySelector(".msgHistoryStatus.replied"),
+            reply_url: link ? link.getAttribute("href") : null
+        };
+    });
+    const next = document.querySelector("a[rel='next'], .pager .next a, .pagination .next a, li.next a");
+    return {hasWrap: !!document.querySelector(".message_listWrap"), items: items, next: next ? next.href : null};
+}
+"""
+
+def parse_message_time(text, now=None):
+    """一覧の日時表記（"MM/DD HH:MM"・"YYYY/MM/DD HH:MM"・当日の "HH:MM"）を datetime にする。読めなければ None"""
+    now = now or datetime.now()
+    text = (text or "").strip()
     try:
-        log_debug("メッセージページに移動します...")
-        page.goto("https://www.yyc.co.jp/my/mail_box/round_trip?filter=not_res", wait_until="domcontentloaded", timeout=60000)
-        time.sleep(2)
-        log_debug(f"現在のURL: {page.url}")
-        if "login" in page.url.lower():
-            log_debug(f"ログインページにリダイレクトされました: {page.url}")
-            st.error("cookieでログインできませんでした。再度保存してください。")
-            return []
-        log_debug("メッセージ要素を検索中...")
-        message_list_wrap = page.query_selector(".message_listWrap")
-        if message_list_wrap:
-            log_debug("message_listWrap要素が見つかりました")
-            children = message_list_wrap.query_selector_all("*")
-            log_debug(f"message_listWrapの子要素数: {len(children)}")
-        else:
-            log_debug("message_listWrap要素が見つかりません")
-        message_elements = page.query_selector_all(".mdl_listBox_simple, .message_listWrap > div")
-        log_debug(f"見つかったメッセージ要素の数: {len(message_elements)}")
-        if not message_elements:
-            log_debug("メッセージ要素が見つかりません。HTMLの構造を確認します...")
-            st.warning("メッセージ要素が見つかりません。セレクターが変更された可能性があります。")
-            return []
-        messages = []
-        log_debug(f"メッセージ要素の解析を開始します（{len(message_elements)}件）")
-        for i, element in enumerate(message_elements, 1):
-            try:
-                log_debug(f"メッセージ {i} の解析を開始")
-                sender = element.query_selector(".name strong, .thumb + div strong")
-                sender_name = sender.inner_text() if sender else "不明"
-                log_debug(f"送信者: {sender_name}")
-                content = element.query_selector(".message p, .thumb + div p")
-                message_text = content.inner_text() if content else ""
-                log_debug(f"メッセージ本文: {message_text[:50]}...")
-                time_elem = element.query_selector(".date, .thumb + div .date")
-                sent_time = time_elem.inner_text() if time_elem else ""
-                log_debug(f"送信日時: {sent_time}")
-                status = element.query_selector(".msgHistoryStatus.replied")
-                is_unreplied = bool(status)
-                log_debug(f"未返信ステータス: {is_unreplied}")
-                # 返信URLの取得
-                reply_a = element.query_selector("a[href^='/my/mail_box/history/?id=']")
-                reply_url = reply_a.get_attribute("href") if reply_a else None
-                log_debug(f"返信URL: {reply_url}")
-                if message_text:
-                    messages.append({
-                        "sender": sender_name,
-                        "content": message_text,
-                        "time": sent_time,
-                        "is_unreplied": is_unreplied,
-                        "reply_url": reply_url
-                    })
-                    log_debug(f"メッセージ {i} の解析が完了")
-                else:
-                    log_debug(f"メッセージ {i} は本文が空のためスキップ")
-            except Exception as e:
-                log_error(f"メッセージ {i} の解析中にエラーが発生: {str(e)}")
-                continue
-        log_debug(f"合計 {len(messages)} 件のメッセージを取得しました")
-        return messages
+        return datetime.strptime(text, "%Y/%m/%d %H:%M")
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.strptime(text, "%H:%M")
+    except ValueError:
+        pass
+    else:
+        return parsed.replace(year=now.year, month=now.month, day=now.day)
+    # 年が書かれていないので今年から遡って当てはめる（未来になるなら去年、02/29 は直近のうるう年）。
+    # strptime の既定の1900年はうるう年ではないので、年を付けてから読む
+    for year in range(now.year, now.year - 8, -1):
+        try:
+            parsed = datetime.strptime(f"{year}/{text}", "%Y/%m/%d %H:%M")
+        except ValueError:
+            continue
+        if parsed <= now + timedelta(days=1):
+            return parsed
+    return None
+
+def _iter_message_pages(load_page, budget, max_pages=None, since=None, owns_budget=True):
+    """一覧のページ送りをたどり、各ページを読み終えるたびにそのページのメッセージを1件ずつ返す
+
+    load_page(url, page_no, budget) は MESSAGE_EXTRACT_JS と同じ形の結果
+    （ログインページに飛ばされたときは None）を返す。
+    max_pages ページ読むか、since より古いメッセージに達したところで止まる。
+    読み込みに失敗したとき（ログインページ・一覧の構造がないページを含む）は、
+    途中まで返していても例外を送出する。最後まで読めたときだけ正常に終わるので、
+    呼び出し元はそのときだけ同期状態の一覧を置き換えてよい。
+    """
+    max_pages = max_pages or FETCH_MAX_PAGES or None
+    if since is None and FETCH_MAX_AGE_DAYS:
+        since = datetime.now() - timedelta(days=FETCH_MAX_AGE_DAYS)
+    url = f"{YYC_BASE_URL}/my/mail_box/round_trip?filter=not_res"
+    visited = set()
+    total = 0
+    sample_log = LogSampler()
+    try:
+        page_no = 0
+        while url and url not in visited and (max_pages is None or page_no < max_pages):
+            visited.add(url)
+            page_no += 1
+            rows = load_page(url, page_no, budget)
+            # 空の一覧として返すと前回の同期結果が消えるので、読めなかったページは失敗にする
+            if rows is None:
+                raise RuntimeError("cookieでログインできませんでした。再度保存してください。")
+            log_debug("message_listWrap要素: %s", 'あり' if rows['hasWrap'] else 'なし')
+            log_debug("ページ%dのメッセージ要素の数: %s", page_no, len(rows['items']))
+            if not rows['items']:
+                if not rows['hasWrap']:
+                    log_debug("メッセージ要素が見つかりません。HTMLの構造を確認します...")
+                    raise RuntimeError("メッセージ要素が見つかりません。セレクターが変更された可能性があります。")
+                return
+            for row in rows['items']:
+                total += 1
+                if sample_log():
+                    log_debug("メッセージ %d: 送信者=%s 日時=%s 本文=%.50s 返信URL=%s", total, row['sender'], row['time'], row['content'], row['reply_url'])
+                if not row['content']:
+                    log_debug("メッセージ %d は本文が空のためスキップ", total)
+                    continue
+                if since is not None:
+                    sent_at = parse_message_time(row['time'])
+                    if sent_at is not None and sent_at < since:
+                        log_debug("%s より古いメッセージに達したため取得を終了します", since)
+                        return
+                yield {
+                    "sender": row['sender'],
+                    "content": row['content'],
+                    "time": row['time'],
+                    "is_unreplied": row['is_unreplied'],
+                    "reply_url": row['reply_url']
+                }
+            url = rows.get('next')
+    except HttpFallback as e:
+        # 1件も返していなければブラウザでやり直せるよう呼び出し元に伝える
+        if total == 0:
+            raise
+        # 途中まで返した後は、やり直すと重複するので取得の失敗として伝える
+        raise RuntimeError(f"{total}件目以降をHTTPで読めませんでした: {e}") from e
     except Exception as e:
+        # 途中までの一覧を取得結果として扱わないよう、呼び出し元に伝える
         log_error("メッセージ取得エラー", e)
-        return []
+        raise
+    finally:
+        log_debug("合計 %s 件のメッセージ要素を読みました", total)
+        if owns_budget:
+            budget.finish()
+
+def iter_latest_messages(page, budget=None, max_pages=None, since=None):
+    """最新のメッセージをブラウザで1件ずつ取得するジェネレーター（返信URLも含める）"""
+    # ブラウザスレッドで実行されるので Playwright は読み込み済み
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+    def load_page(url, page_no, budget):
+        log_debug("メッセージページ%dに移動します...", page_no)
+        with budget.stage(f"goto[{page_no}]"):
+            page.goto(url, wait_until="domcontentloaded", timeout=budget.remaining_ms())
+        # 一覧かログインフォームが描画されるまで待つ（なければ下の判定に任せる）
+        with budget.stage(f"wait_list[{page_no}]"):
+            try:
+                page.wait_for_selector(MESSAGE_LIST_READY_SELECTOR, state="attached", timeout=budget.remaining_ms(10000))
+            except PlaywrightTimeoutError:
+                log_debug("メッセージ一覧の描画待機がタイムアウトしました")
+        log_debug("現在のURL: %s", page.url)
+        if "login" in page.url.lower():
+            log_debug("ログインページにリダイレクトされました: %s", page.url)
+            return None
+        # 1回の evaluate でページ内の全行の全項目を取得する（要素ごとのCDP往復をなくす）
+        with budget.stage(f"extract[{page_no}]"):
+            return page.evaluate(MESSAGE_EXTRACT_JS)
+
+    owns_budget = budget is None
+    if owns_budget:
+        budget = OperationBudget("get_latest_messages", FETCH_BUDGET_MS)
+    return _iter_message_pages(load_page, budget, max_pages, since, owns_budget)
+
+def iter_latest_messages_http(email, max_pages=None, since=None):
+    """最新のメッセージをブラウザを使わずHTTPで1件ずつ取得するジェネレーター
+
+    1ページ目がログインページや想定外のHTMLだったときは HttpFallback を送出する。
+    """
+    def load_page(url, page_no, budget):
+        with budget.stage(f"http_get[{page_no}]"):
+            return fetch_inbox_page(email, url)
+
+    return _iter_message_pages(load_page, OperationBudget("get_latest_messages_http", FETCH_BUDGET_MS), max_pages, since)
+
+def get_latest_messages(page, budget=None, max_pages=None, since=None):
+    """最新のメッセージをすべて取得してリストで返す"""
+    return list(iter_latest_messages(page, budget, max_pages, since))
+
+def get_latest_messages_http(email, max_pages=None, since=None):
+    """最新のメッセージをHTTPですべて取得してリストで返す（読めなければ HttpFallback）"""
+    return list(iter_latest_messages_http(email, max_pages, since))
+
+def _fetch_messages_in_context(context):
+    page = context.new_page()
+    return get_latest_messages(page)
+
+_STREAM_END = object()
+
+def _stream_messages_in_context(context, out):
+    page = context.new_page()
+    try:
+        for message in iter_latest_messages(page):
+            out.put(message)
+    finally:
+        out.put(_STREAM_END)
+
+def _drain(out, future, poll_interval=0.1):
+    """キューに届いた分をまとめて（リストで）順に返す。最後に future の例外を伝える"""
+    finished = False
+    while not finished:
+        try:
+            batch = [out.get(timeout=poll_interval)]
+        except queue.Empty:
+            if future.done() and out.empty():
+                break
+            continue
+        # すでに届いている分はまとめて返す
+        while True:
+            try:
+                batch.append(out.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is _STREAM_END:
+            batch.pop()
+            finished = True
+        if batch:
+            yield batch
+    # 取得側の例外（storage_state がない等）はここで呼び出し元に伝える
+    future.result()
+
+def iter_inbox_messages(email):
+    """受信箱のメッセージを1件ずつ返す（HTTPで読めればHTTP、だめならブラウザ）"""
+    if FETCH_MODE == "http":
+        try:
+            yield from iter_latest_messages_http(email)
+            return
+        except HttpFallback as e:
+            log_debug("HTTPで一覧を読めないためブラウザで取得します: %s", e)
+    out = queue.Queue()
+    future = get_browser().submit(email, _stream_messages_in_context, out)
+    for batch in _drain(out, future):
+        yield from batch
+
+def fetch_inbox(email):
+    """受信箱のメッセージをすべて取得してリストで返す（巡回用）"""
+    return list(iter_inbox_messages(email))
+
+def _pump_inbox(email, out):
+    try:
+        for message in iter_inbox_messages(email):
+            out.put(message)
+    finally:
+        out.put(_STREAM_END)
+
+def stream_messages(email, poll_interval=0.1):
+    """別スレッドで一覧を読みながら、届いたメッセージをまとめて（リストで）順に返す"""
+    out = queue.Queue()
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(_pump_inbox(email, out))
+        except BaseException as e:
+            future.set_exception(e)
+
+    # ログのフィールドとStreamlitのスクリプト情報を取得スレッドに引き継ぐ
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), name="inbox-fetch", daemon=True)
+    add_script_run_ctx(thread)
+    thread.start()
+    yield from _drain(out, future, poll_interval)
 
 def generate_reply(message, persona):
     """ChatGPTで返信文を生成"""
     try:
-        # プロンプトの作成
-        prompt = f"""
-        以下のメッセージに対する返信を、以下のペルソナに基づいて生成してください。
-        
-        ペルソナ:
-        - 名前: {persona['name']}
-        - 年齢: {persona['age']}歳
-        - 職業: {persona['occupation']}
-        - 趣味: {', '.join(persona['interests'])}
-        - 性格: {persona['personality']}
-        - 文章スタイル: {persona['writing_style']}
-        
-        メッセージ:
-        {message['content']}
-        
-        返信の条件:
-        1. 自然で親しみやすい文章
-        2. 相手のメッセージの内容に適切に反応
-        3. 会話を発展させる要素を含める
-        4. 短すぎず長すぎない適度な長さ
-        5. 絵文字を適度に使用
-        
-        返信文のみを出力してください。
-        """
-        
-        # ChatGPT APIを呼び出し
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "あなたは親しみやすい女性のペルソナで、マッチングアプリでの会話を担当します。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=200
-        )
-        
-        return response.choices[0].message.content.strip()
+        return request_reply_with_backoff(message, persona)
     except Exception as e:
         log_error("返信生成エラー", e)
         return "返信の生成に失敗しました。"
 
-def check_cookie_valid(email):
+def attach_history(email, messages, fetch=True):
+    """返信生成用に、各メッセージのコピーへ直近の会話履歴（history）を付ける
+
+    fetch=True なら、新しい動きのあったスレッドだけ履歴ページを並行して読んで追記する。
+    """
+    if not CONVERSATION_HISTORY or not email or not messages:
+        return messages
     try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = load_cookies(browser, email)
-            if context is not None:
-                page = context.new_page()
-                page.goto("https://www.yyc.co.jp/mypage/", wait_until="domcontentloaded", timeout=15000)
-                time.sleep(2)
-                # マイページに遷移できれば有効
-                if "mypage" in page.url:
-                    context.close()
-                    browser.close()
-                    return True
-                context.close()
-                browser.close()
-        return False
+        history = ConversationHistory(email)
+        if fetch:
+            history.refresh(messages, lambda reply_url: fetch_history_html(email, reply_url))
     except Exception as e:
-        return False
+        log_error("会話履歴の更新エラー", e)
+        return messages
+    result = []
+    for message in messages:
+        turns = history.window(message)
+        result.append(dict(message, history=turns) if turns else message)
+    return result
 
-def send_reply(email, reply_url, reply_text):
-    """Playwrightで指定メッセージに自動返信（タイムアウト延長＆デバッグ用スクリーンショット）"""
+def sync_inbox(email, messages, persona):
+    """取得したメッセージを前回の同期状態と突き合わせ、新規・変更のあったスレッドだけ返信を生成
+
+    messages は一覧を最後まで読めた結果に限る（一覧の順序と最終取得時刻を置き換えるため）。
+    """
+    state = InboxSyncState(email)
+    # バックグラウンド巡回でも同じペルソナで生成できるよう保存しておく
+    state.persona = persona
+    reply_key = lambda m: cache_key(m, persona)
+    pending = state.pending(messages, reply_key)
+    log_debug("同期: %s件中 %s件が新規または変更あり", len(messages), len(pending))
+    results = generate_replies(attach_history(email, [messages[i] for i in pending]), persona, cache=get_reply_cache())
+    generated = dict(zip(pending, results))
+    replies, errors = [], []
+    for i, message in enumerate(messages):
+        if i in generated:
+            result = generated[i]
+            state.record(message, result.reply, reply_key(message), result.error)
+            replies.append(result.reply)
+            errors.append(result.error)
+        else:
+            replies.append(state.reply_for(message))
+            errors.append(None)
+    state.finish_sync(messages)
+    return replies, errors, datetime.fromtimestamp(state.last_check)
+
+def render_message_header(message):
+    """メッセージカードの送信者・日時・本文"""
+    st.markdown(f"<div class='user-card'><b>{message['sender']}</b> <span style='color:#888;font-size:0.9em;'>({message['time']})</span></div>", unsafe_allow_html=True)
+    st.code(message['content'], language="")  # 本文を全文表示
+
+def filter_messages(messages, unreplied_only=False, sender="", since=None):
+    """絞り込み条件に合うメッセージの添字（返信・エラーの並びと対応する）のリスト"""
+    sender = sender.strip().lower()
+    indices = []
+    for i, message in enumerate(messages):
+        if unreplied_only and not message.get("is_unreplied"):
+            continue
+        if sender and sender not in (message.get("sender") or "").lower():
+            continue
+        if since is not None:
+            sent_at = parse_message_time(message.get("time"))
+            if sent_at is None or sent_at.date() < since:
+                continue
+        indices.append(i)
+    return indices
+
+def paginate(indices, page, per_page=MESSAGES_PER_PAGE):
+    """indices のうち page ページ目（1始まり）の分と、補正後のページ番号・総ページ数"""
+    page_count = max(1, -(-len(indices) // per_page))
+    page = min(max(1, page), page_count)
+    return indices[(page - 1) * per_page:page * per_page], page, page_count
+
+def _set_message_page(page):
+    st.session_state.message_page = page
+
+def render_message_filters(messages):
+    """絞り込み・ページ送りの入力欄を表示し、このページに描画するメッセージの添字を返す"""
+    if not messages:
+        return []
+    col_unreplied, col_sender, col_date = st.columns([1, 2, 2])
+    unreplied_only = col_unreplied.checkbox("未返信のみ", key="filter_unreplied")
+    sender = col_sender.text_input("送信者", key="filter_sender", placeholder="名前の一部")
+    since = col_date.date_input("この日以降", value=None, key="filter_since")
+    indices = filter_messages(messages, unreplied_only, sender, since)
+    # 条件が変わったら1ページ目に戻す（同期で件数が変わっただけなら、今のページを paginate で範囲内に収める）
+    filters = (unreplied_only, sender, since)
+    if st.session_state.get("message_filters") != filters:
+        st.session_state.message_filters = filters
+        st.session_state.message_page = 1
+    page_indices, page, page_count = paginate(indices, st.session_state.get("message_page", 1))
+    st.session_state.message_page = page
+    if page_count > 1:
+        col_prev, col_info, col_next = st.columns([1, 3, 1])
+        # ページ番号はボタンの on_click で変える（描画前に反映されるので再実行し直さなくてよい）
+        col_prev.button("◀ 前へ", key="message_page_prev", on_click=_set_message_page, args=(page - 1,), disabled=page <= 1, use_container_width=True)
+        col_info.caption(f"{len(indices)}件中 {(page - 1) * MESSAGES_PER_PAGE + 1}〜{(page - 1) * MESSAGES_PER_PAGE + len(page_indices)}件目（{page}/{page_count}ページ）")
+        col_next.button("次へ ▶", key="message_page_next", on_click=_set_message_page, args=(page + 1,), disabled=page >= page_count, use_container_width=True)
+    elif len(indices) != len(messages):
+        st.caption(f"{len(messages)}件中 {len(indices)}件を表示")
+    return page_indices
+
+def fetch_inbox_progressively(email, persona):
+    """一覧を読みながらカードを順に表示し、返信ができた分から埋めていく
+
+    読み終えたら同期状態に保存し、セッションに結果を入れる。表示は一時的なもので、
+    この後の通常のメッセージ一覧の描画に置き換わる。
+    """
+    state = InboxSyncState(email)
+    state.persona = persona
+    reply_key = lambda m: cache_key(m, persona)
+    messages, replies, errors = [], [], []
+    live = st.empty()
     try:
-        request_log = []  # ここで必ず初期化
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = load_cookies(browser, email)
-            if context is None:
-                return False, "cookieファイルの読み込みに失敗しました"
-            page = context.new_page()
-            # YYCは相対パスなのでフルURLに
-            if reply_url.startswith("/"):
-                reply_url = f"https://www.yyc.co.jp{reply_url}"
-            page.goto(reply_url, wait_until="domcontentloaded", timeout=60000)  # 60秒に延長
-            time.sleep(2)
-            # デバッグ用スクリーンショット
-            try:
-                # スクリーンショット保存用のディレクトリを作成
-                screenshot_dir = os.path.join(os.getcwd(), "screenshots")
-                os.makedirs(screenshot_dir, exist_ok=True)
-                screenshot_path = os.path.join(screenshot_dir, "debug_reply.png")
-                page.screenshot(path=screenshot_path)
-                log_debug(f"スクリーンショットを保存しました: {screenshot_path}")
-                
-                # ページのHTMLを取得してログに出力
-                html_content = page.content()
-                log_debug("ページのHTML構造:")
-                log_debug(html_content[:1000])  # 最初の1000文字だけ出力
-                
-                # 返信フォームの要素を確認
-                textarea = page.query_selector("textarea[name='message']")
-                if textarea:
-                    log_debug("返信フォームが見つかりました")
-                    log_debug(f"返信フォームの属性: {textarea.get_attribute('name')}")
-                else:
-                    log_debug("返信フォームが見つかりません")
-                    # 代替のセレクターを試す
-                    alternative_selectors = [
-                        "textarea",
-                        "input[type='text']",
-                        ".message-form textarea",
-                        "#message-form textarea"
-                    ]
-                    for selector in alternative_selectors:
-                        element = page.query_selector(selector)
-                        if element:
-                            log_debug(f"代替セレクター '{selector}' で要素が見つかりました")
-                
-            except Exception as e:
-                log_error(f"スクリーンショットの保存に失敗: {str(e)}", e)
-            # 送信ボタンを探しておく
-            send_btn = page.query_selector("input[type='submit'], button[type='submit']")
-            if not send_btn:
-                # 代替のセレクターを試す
-                alternative_buttons = [
-                    "button:has-text('送信')",
-                    "input[value='送信']",
-                    ".submit-button",
-                    "#submit-button"
-                ]
-                for selector in alternative_buttons:
-                    send_btn = page.query_selector(selector)
-                    if send_btn:
-                        log_debug(f"送信ボタンが見つかりました: {selector}")
-                        break
+        _render_progressive_fetch(live, email, persona, state, reply_key, messages, replies, errors)
+    except Exception:
+        # 途中で失敗しても、生成済みの返信は次回に使えるよう残す
+        state.save()
+        raise
+    live.empty()
+    state.finish_sync(messages)
+    st.session_state.messages = messages
+    st.session_state.replies = replies
+    st.session_state.reply_errors = errors
+    st.session_state.last_check = datetime.fromtimestamp(state.last_check)
 
-            # --- 自動調査: フォーム構造・hiddenフィールド・イベント属性・関数名をログ出力 ---
-            try:
-                # フォーム要素
-                form_handle = textarea.evaluate_handle('el => el.form')
-                if form_handle:
-                    form_html = form_handle.evaluate('form => form.outerHTML')
-                    log_debug(f"[自動調査] 送信フォームのHTML:\n{form_html}")
-                    # hiddenフィールド・input一覧
-                    inputs = form_handle.evaluate('form => Array.from(form.querySelectorAll("input,textarea")).map(i => ({name: i.name, type: i.type, value: i.value, hidden: i.type==="hidden"}))')
-                    for inp in inputs:
-                        log_debug(f"[自動調査] input: name={inp['name']}, type={inp['type']}, value={inp['value']}, hidden={inp['hidden']}")
-                else:
-                    log_debug("[自動調査] textarea.formが取得できませんでした")
-                # 送信ボタンのonclick属性・outerHTML
-                if send_btn:
-                    send_btn_html = send_btn.evaluate('el => el.outerHTML')
-                    send_btn_onclick = send_btn.get_attribute('onclick')
-                    log_debug(f"[自動調査] 送信ボタンouterHTML: {send_btn_html}")
-                    log_debug(f"[自動調査] 送信ボタンonclick属性: {send_btn_onclick}")
+def _render_progressive_fetch(live, email, persona, state, reply_key, messages, replies, errors):
+    cache = get_reply_cache()
+    with live.container():
+        status = st.empty()
+        status.info("メッセージを取得中...")
+        for batch in stream_messages(email):
+            offset = len(messages)
+            slots = []
+            for message in batch:
+                messages.append(message)
+                replies.append(state.reply_for(message))
+                errors.append(None)
+                render_message_header(message)
+                slots.append(st.empty())
+                slots[-1].caption("返信を生成中..." if not replies[-1] else replies[-1])
+            status.info(f"{len(messages)}件取得しました。返信を生成中...")
+            pending = state.pending(batch, reply_key)
+
+            def on_result(j, result, pending=pending, offset=offset, slots=slots, batch=batch):
+                i = pending[j]
+                state.record(batch[i], result.reply, reply_key(batch[i]), result.error)
+                replies[offset + i] = result.reply
+                errors[offset + i] = result.error
+                if result.error:
+                    slots[i].error(f"返信の生成に失敗しました: {result.error}")
                 else:
-                    log_debug("[自動調査] 送信ボタンが見つかりませんでした")
-                # windowオブジェクトの関数名一覧
-                window_keys = page.evaluate('() => Object.keys(window).filter(k => typeof window[k] === "function")')
-                log_debug(f"[自動調査] windowオブジェクトの関数名一覧: {window_keys}")
-            except Exception as e:
-                log_debug(f"[自動調査] フォーム構造等の自動調査中にエラー: {str(e)}")
-            
-            # フォームの状態を確認
-            is_disabled = textarea.get_attribute("disabled")
-            is_readonly = textarea.get_attribute("readonly")
-            log_debug(f"フォームの状態: disabled={is_disabled}, readonly={is_readonly}")
-            
-            # フォームが有効になるまで待機
-            try:
-                page.wait_for_selector("textarea[name='message']:not([disabled]):not([readonly])", timeout=5000)
-            except Exception as e:
-                log_debug(f"フォームの有効化待機中にタイムアウト: {str(e)}")
-            
-            # テキストを入力
-            textarea.fill(reply_text)
-            log_debug("返信テキストを入力しました")
-            
-            # 送信ボタンが有効になるまで待機
+                    slots[i].caption(result.reply)
+
+            # できた返信から表示するので、OPENAI_BATCH_SIZE にかかわらず1件ずつ生成する
+            generate_replies(attach_history(email, [batch[i] for i in pending]), persona, cache=cache, on_result=on_result, batch_size=1)
+
+def remember_reply(email, message, reply, persona, error=None):
+    """再作成・編集した返信を同期状態にも反映する"""
+    try:
+        state = InboxSyncState(email)
+        state.record(message, reply, cache_key(message, persona), error)
+        state.save()
+    except Exception as e:
+        log_error("同期状態の保存エラー", e)
+
+def load_synced_inbox(email):
+    """同期結果をセッションに読み込む（前回読み込んだ後に更新されたときだけ）"""
+    if not email:
+        return
+    mtime = sync_mtime(email)
+    if mtime is None or st.session_state.get("sync_loaded") == (email, mtime):
+        return
+    st.session_state.sync_loaded = (email, mtime)
+    try:
+        state = InboxSyncState(email)
+    except Exception as e:
+        log_error("同期状態の読み込みエラー", e)
+        return
+    messages, replies, errors = state.snapshot()
+    if messages:
+        st.session_state.messages = messages
+        st.session_state.replies = replies
+        st.session_state.reply_errors = errors
+    if state.last_check:
+        st.session_state.last_check = datetime.fromtimestamp(state.last_check)
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def watch_synced_inbox(email):
+    """バックグラウンド同期の結果が、画面に読み込んだ後に更新されていたら再実行する"""
+    mtime = sync_mtime(email) if email else None
+    if mtime is not None and st.session_state.get("sync_loaded") != (email, mtime):
+        st.rerun()
+
+def get_poller():
+    """全アカウントを巡回する共有ポーラーを取得"""
+    return get_account_poller(COOKIES_DIR)
+
+def poll_account(email):
+    """巡回用: 1アカウントの受信箱を取得（HTTPで読めなければ共有ブラウザ上で）"""
+    if not check_cookie_valid(email):
+        raise RuntimeError("cookieが無効です。再度保存してください")
+    return fetch_inbox(email)
+
+def on_poll_result(email, messages, persona=None):
+    """巡回結果を同期状態に反映し、新規・変更分の返信を生成
+
+    ペルソナの指定がなければ、そのアカウントで最後に使ったペルソナ（なければ既定値）を使う。
+    """
+    if persona is None:
+        persona = InboxSyncState(email).persona or DEFAULT_PERSONA
+    sync_inbox(email, messages, persona)
+
+def ensure_background_sync():
+    """バックグラウンドの取得・事前生成をサーバーごとに1回だけ開始する（再実行では何もしない）"""
+    if not BACKGROUND_SYNC:
+        return None
+    poller = get_poller()
+    if not poller.running:
+        poller.configure(poll=poll_account, on_result=on_poll_result)
+        get_browser().resize(POLL_MAX_CONCURRENCY)
+        poller.start_once()
+    return poller
+
+def render_poller_panel():
+    """サイドバー: 複数アカウント巡回の操作と状況表示"""
+    with st.expander("🔁 複数アカウント巡回"):
+        poller = get_poller()
+        col1, col2 = st.columns(2)
+        if col1.button("開始", key="poller_start", disabled=poller.running):
+            # 巡回中の返信生成には開始時のペルソナを使う
+            persona = dict(st.session_state.persona)
+            poller.configure(poll=poll_account, on_result=lambda email, messages: on_poll_result(email, messages, persona))
+            get_browser().resize(POLL_MAX_CONCURRENCY)
+            poller.start()
+        if col2.button("停止", key="poller_stop", disabled=not poller.running):
+            poller.stop(timeout=1)
+        st.caption("巡回中" if poller.running else "停止中")
+        status = poller.status()
+        if status:
+            for row in status:
+                if row["last_sync_at"]:
+                    row["last_sync_at"] = datetime.fromtimestamp(row["last_sync_at"]).strftime("%H:%M:%S")
+            st.dataframe(status, use_container_width=True)
+        browser_stats = get_browser().stats()
+        st.text(f"ブラウザ: 稼働 {browser_stats['busy']}/{browser_stats['workers']}（上限 {browser_stats['max_workers']}）待ち {browser_stats['queued']}件")
+
+def _check_cookie_in_context(context):
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+    budget = OperationBudget("check_cookie_valid", COOKIE_CHECK_BUDGET_MS)
+    try:
+        page = context.new_page()
+        with budget.stage("goto"):
+            page.goto(f"{YYC_BASE_URL}/mypage/", wait_until="domcontentloaded", timeout=budget.remaining_ms())
+        # マイページかログインページのどちらかに落ち着くまで待つ
+        with budget.stage("wait_url"):
             try:
-                page.wait_for_selector("input[type='submit']:not([disabled]), button[type='submit']:not([disabled])", timeout=5000)
-            except Exception as e:
-                log_debug(f"送信ボタンの有効化待機中にタイムアウト: {str(e)}")
-            
-            # クリック前の状態を確認しログ出力
+                page.wait_for_url(lambda url: "mypage" in url or "login" in url, wait_until="domcontentloaded", timeout=budget.remaining_ms())
+            except PlaywrightTimeoutError:
+                pass
+        # マイページに遷移できれば有効
+        return "mypage" in page.url
+    finally:
+        budget.finish()
+
+def check_cookie_valid(email, use_cache=True):
+    """cookieが有効か確認する
+
+    まずHTTPでマイページを開いて判定し、判定できないときだけブラウザで確認する。
+    結果はアカウントごとに一定時間キャッシュする（storage_state が変われば確認し直す）。
+    """
+    cache = get_cookie_check_cache()
+    if use_cache:
+        cached = cache.get(email)
+        if cached is not None:
+            return cached
+    try:
+        with log_context(account=email, stage="cookie_check"):
+            valid = check_cookie_http(email)
+            if valid is None:
+                log_debug("HTTPでは判定できないためブラウザで確認します")
+                valid = get_browser().run(email, _check_cookie_in_context)
+    except Exception as e:
+        log_error("cookieチェックエラー", e)
+        return False
+    cache.put(email, valid)
+    return valid
+
+def _send_reply_in_context(context, reply_url, reply_text):
+    """ブラウザスレッド上で返信ページを開いて送信する"""
+    budget = OperationBudget("send_reply", SEND_BUDGET_MS)
+    artifacts = start_capture("send")
+    page = context.new_page()
+    try:
+        return _submit_reply_form(page, reply_url, reply_text, budget, artifacts)
+    except Exception:
+        _capture_failure(page, artifacts, "exception")
+        raise
+    finally:
+        budget.finish()
+        # 送信キューでは同じ context で続けて呼ばれるので、ページはここで閉じる
+        try:
+            page.close()
+        except Exception as e:
+            log_debug("ページを閉じられませんでした: %s", e)
+
+def _capture_failure(page, artifacts, name):
+    """失敗時のスクリーンショットとHTMLを保存キューに積む（on-error 以上のときだけ取得）"""
+    if not artifacts.wants(error=True):
+        return
+    try:
+        artifacts.add_screenshot(name, page.screenshot(), error=True)
+        artifacts.add_html(name, page.content(), error=True)
+    except Exception as e:
+        log_debug("デバッグ情報の取得に失敗: %s", e)
+
+def _submit_reply_form(page, reply_url, reply_text, budget, artifacts):
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+    request_log = []  # ここで必ず初期化
+    # YYCは相対パスなのでフルURLに
+    if reply_url.startswith("/"):
+        reply_url = f"{YYC_BASE_URL}{reply_url}"
+    # 送信時のPOSTを記録しておき、クリック後の完了待ちに使う
+    post_responses = []
+    page.on("request", lambda req: request_log.append({"url": req.url, "post_data": req.post_data}) if req.method == "POST" else None)
+    page.on("response", lambda res: post_responses.append(res) if res.request.method == "POST" else None)
+    with budget.stage("goto"):
+        page.goto(reply_url, wait_until="domcontentloaded", timeout=budget.remaining_ms())
+    # 返信フォームが描画されるまで待つ
+    with budget.stage("wait_form"):
+        try:
+            page.wait_for_selector("textarea[name='message'], form#send-mail-form", state="attached", timeout=budget.remaining_ms(15000))
+        except PlaywrightTimeoutError:
+            log_debug("返信フォームの描画待機がタイムアウトしました")
+    # デバッグ用スクリーンショット・HTML（DEBUG_ARTIFACTS=always のときだけ取得）
+    try:
+        if artifacts.wants():
+            artifacts.add_screenshot("reply_page", page.screenshot())
+            artifacts.add_html("reply_page", page.content())
+        
+        # 返信フォームの要素を確認
+        textarea = page.query_selector("textarea[name='message']")
+        if textarea:
+            log_debug("返信フォームが見つかりました")
+        elif debug_enabled(logger):
+            log_debug("返信フォームが見つかりません")
+            # 代替のセレクターを試す
+            alternative_selectors = [
+                "textarea",
+                "input[type='text']",
+                ".message-form textarea",
+                "#message-form textarea"
+            ]
+            for selector in alternative_selectors:
+                element = page.query_selector(selector)
+                if element:
+                    log_debug("代替セレクター '%s' で要素が見つかりました", selector)
+        
+    except Exception as e:
+        log_error("デバッグ情報の保存に失敗", e)
+    # 送信ボタンを探しておく
+    send_btn = page.query_selector("input[type='submit'], button[type='submit']")
+    if not send_btn:
+        # 代替のセレクターを試す
+        alternative_buttons = [
+            "button:has-text('送信')",
+            "input[value='送信']",
+            ".submit-button",
+            "#submit-button"
+        ]
+        for selector in alternative_buttons:
+            send_btn = page.query_selector(selector)
             if send_btn:
-                is_visible = send_btn.is_visible()
-                is_enabled = send_btn.is_enabled()
-                log_debug(f"送信ボタン: visible={is_visible}, enabled={is_enabled}")
-            else:
-                is_visible = False
-                is_enabled = False
-                log_debug("送信ボタンがNoneです")
+                log_debug("送信ボタンが見つかりました: %s", selector)
+                break
+
+    # --- 自動調査: フォーム構造・hiddenフィールド・イベント属性・関数名を保存（always のときだけ） ---
+    if artifacts.wants():
+        try:
+            probe = {}
+            # フォーム要素
+            form_handle = textarea.evaluate_handle('el => el.form')
+            if form_handle:
+                probe["form_html"] = form_handle.evaluate('form => form.outerHTML')
+                # hiddenフィールド・input一覧
+                probe["inputs"] = form_handle.evaluate('form => Array.from(form.querySelectorAll("input,textarea")).map(i => ({name: i.name, type: i.type, value: i.value, hidden: i.type==="hidden"}))')
+            # 送信ボタンのonclick属性・outerHTML
+            if send_btn:
+                probe["send_button_html"] = send_btn.evaluate('el => el.outerHTML')
+                probe["send_button_onclick"] = send_btn.get_attribute('onclick')
+            # windowオブジェクトの関数名一覧
+            probe["window_functions"] = page.evaluate('() => Object.keys(window).filter(k => typeof window[k] === "function")')
+            artifacts.add_json("form_probe", probe)
+        except Exception as e:
+            log_debug("[自動調査] フォーム構造等の自動調査中にエラー: %s", e)
+    
+    # フォームの状態を確認
+    is_disabled = textarea.get_attribute("disabled")
+    is_readonly = textarea.get_attribute("readonly")
+    log_debug("フォームの状態: disabled=%s, readonly=%s", is_disabled, is_readonly)
+    
+    # フォームが有効になるまで待機
+    try:
+        with budget.stage("wait_textarea_enabled"):
+            page.wait_for_selector("textarea[name='message']:not([disabled]):not([readonly])", timeout=budget.remaining_ms(5000))
+    except Exception as e:
+        log_debug("フォームの有効化待機中にタイムアウト: %s", e)
+    
+    # テキストを入力
+    textarea.fill(reply_text)
+    log_debug("返信テキストを入力しました")
+    
+    # 送信ボタンが有効になるまで待機
+    try:
+        with budget.stage("wait_button_enabled"):
+            page.wait_for_selector("input[type='submit']:not([disabled]), button[type='submit']:not([disabled])", timeout=budget.remaining_ms(5000))
+    except Exception as e:
+        log_debug("送信ボタンの有効化待機中にタイムアウト: %s", e)
+    
+    # クリック前の状態を確認しログ出力
+    if send_btn:
+        is_visible = send_btn.is_visible()
+        is_enabled = send_btn.is_enabled()
+        log_debug("送信ボタン: visible=%s, enabled=%s", is_visible, is_enabled)
+    else:
+        is_visible = False
+        is_enabled = False
+        log_debug("送信ボタンがNoneです")
 
-            # クリックを試みる
+    # クリックを試みる
+    try:
+        if send_btn and is_visible and is_enabled:
+            send_btn.scroll_into_view_if_needed()
             try:
-                # クリック前に少し待機
-                time.sleep(1)
-                if send_btn and is_visible and is_enabled:
-                    send_btn.scroll_into_view_if_needed()
-                    try:
-                        send_btn.click(timeout=10000)
-                        log_debug("送信ボタンをクリックしました")
-                    except Exception as e:
-                        log_debug(f"通常のクリックに失敗: {str(e)}")
-                        # outerHTMLをログ出力
-                        try:
-                            send_btn_html = send_btn.evaluate('el => el.outerHTML')
-                            log_debug(f"送信ボタンouterHTML: {send_btn_html}")
-                        except Exception as html_e:
-                            log_debug(f"送信ボタンouterHTML取得失敗: {str(html_e)}")
-                        # JavaScriptでクリックイベントを発火
-                        try:
-                            page.evaluate("(btn) => btn.click()", send_btn)
-                            log_debug("JavaScriptでクリックイベントを発火しました")
-                        except Exception as js_error:
-                            log_debug(f"JavaScriptクリックに失敗: {str(js_error)}")
-                            # デバッグ用にスクリーンショットとHTMLを保存
-                            error_screenshot_path = os.path.join(screenshot_dir, "send_btn_error.png")
-                            page.screenshot(path=error_screenshot_path)
-                            log_debug(f"送信ボタンエラー時のスクリーンショットを保存: {error_screenshot_path}")
-                            log_debug(page.content()[:1000])
-                            context.close()
-                            browser.close()
-                            return False, "送信ボタンがクリックできませんでした（send_btn_error.pngを確認してください）"
-                else:
-                    log_debug("送信ボタンが非表示または無効です。クリックをスキップします。")
-                    # デバッグ用にスクリーンショットとHTMLを保存
-                    error_screenshot_path = os.path.join(screenshot_dir, "send_btn_error.png")
-                    page.screenshot(path=error_screenshot_path)
-                    log_debug(f"送信ボタンエラー時のスクリーンショットを保存: {error_screenshot_path}")
-                    log_debug(page.content()[:1000])
-                    context.close()
-                    browser.close()
-                    return False, "送信ボタンが非表示または無効です（send_btn_error.pngを確認してください）"
+                send_btn.click(timeout=budget.remaining_ms(10000))
+                log_debug("送信ボタンをクリックしました")
             except Exception as e:
-                log_debug(f"クリック処理全体で予期せぬエラー: {str(e)}")
-            
-            # 送信後の状態を確認
-            try:
-                # 送信成功の確認（URLの変更を確認）
-                if "history" in page.url and "id=" in page.url:
-                    log_debug("送信成功を確認: URLが履歴ページに遷移")
-                    # 履歴ページで自分の送信内容が直近に表示されているか確認
+                log_debug("通常のクリックに失敗: %s", e)
+                # outerHTMLをログ出力
+                if debug_enabled(logger):
                     try:
-                        page.wait_for_load_state("networkidle", timeout=5000)
-                        time.sleep(1)
-                        # --- 追加: 履歴ページのHTMLを保存 ---
-                        try:
-                            os.makedirs(screenshot_dir, exist_ok=True)
-                            history_html_path = os.path.join(screenshot_dir, "history_debug.html")
-                            with open(history_html_path, "w", encoding="utf-8") as f:
-                                content = page.content()
-                                f.write(content)
-                                f.flush()
-                                os.fsync(f.fileno())
-                            if os.path.exists(history_html_path):
-                                log_debug(f"[保存確認] {history_html_path} が正常に保存されました")
-                                log_debug(f"[保存内容先頭20000] {content[:20000]}")
-                                # 送信ページ（返信ページ）のHTMLも保存・ログ出力
-                                try:
-                                    send_page_path = os.path.join(screenshot_dir, "send_page_debug.html")
-                                    with open(send_page_path, "w", encoding="utf-8") as sf:
-                                        send_page_content = page.content()
-                                        sf.write(send_page_content)
-                                        sf.flush()
-                                        os.fsync(sf.fileno())
-                                    log_debug(f"[送信ページHTML先頭20000] {send_page_content[:20000]}")
-                                except Exception as e:
-                                    log_debug(f"[送信ページHTML保存エラー] {str(e)}")
-                            else:
-                                log_debug(f"[保存確認] {history_html_path} が保存されていません！")
-                                log_debug(f"[保存内容先頭20000] {content[:20000]}")
-                        except Exception as e:
-                            log_debug(f"[失敗時も保存] 履歴ページHTML保存に失敗: {str(e)} (パス: {history_html_path})")
-                        # --- 追加: 送信時のPOSTリクエスト内容を保存 ---
-                        if request_log:
-                            post_debug_path = os.path.join(screenshot_dir, "post_debug.json")
-                            import json as _json
-                            with open(post_debug_path, "w", encoding="utf-8") as f:
-                                _json.dump(request_log, f, ensure_ascii=False, indent=2)
-                            log_debug(f"送信時のPOSTリクエスト内容を保存: {post_debug_path}")
-                        # --- 追加ここまで ---
-                        found = False
-                        for reload_count in range(3):
-                            if reload_count > 0:
-                                log_debug(f"履歴ページをリロード: {reload_count}回目")
-                                page.reload(wait_until="networkidle")
-                                time.sleep(2)
-                            # メッセージリストの一番下（または上）に自分の送信内容があるか確認
-                            selectors = [
-                                ".message_listWrap .message p",
-                                ".mdl_listBox_simple .message p",
-                                "div.message p"
-                            ]
-                            for selector in selectors:
-                                elements = page.query_selector_all(selector)
-                                for elem in elements[-3:]:  # 直近3件だけ見る
-                                    text = elem.inner_text().strip()
-                                    log_debug(f"履歴ページのメッセージ: {text}")
-                                    if reply_text.strip()[:30] in text:
-                                        found = True
-                                        break
-                                if found:
-                                    break
-                            if found:
+                        log_debug("送信ボタンouterHTML: %s", send_btn.evaluate('el => el.outerHTML'))
+                    except Exception as html_e:
+                        log_debug("送信ボタンouterHTML取得失敗: %s", html_e)
+                # JavaScriptでクリックイベントを発火
+                try:
+                    page.evaluate("(btn) => btn.click()", send_btn)
+                    log_debug("JavaScriptでクリックイベントを発火しました")
+                except Exception as js_error:
+                    log_debug("JavaScriptクリックに失敗: %s", js_error)
+                    _capture_failure(page, artifacts, "send_btn_error")
+                    return False, f"送信ボタンがクリックできませんでした（デバッグID: {artifacts.capture_id}）"
+        else:
+            log_debug("送信ボタンが非表示または無効です。クリックをスキップします。")
+            _capture_failure(page, artifacts, "send_btn_error")
+            return False, f"送信ボタンが非表示または無効です（デバッグID: {artifacts.capture_id}）"
+    except Exception as e:
+        log_debug("クリック処理全体で予期せぬエラー: %s", e)
+    
+    def confirm_ms(cap=None):
+        """クリック後の待ち時間。POST 済みかもしれないので、予算を使い切っても送信結果の確認は短時間続ける"""
+        try:
+            return budget.remaining_ms(cap)
+        except BudgetExceeded:
+            return min(cap or SEND_CONFIRM_GRACE_MS, SEND_CONFIRM_GRACE_MS)
+
+    # 送信（POST）のレスポンスと遷移先の読み込みを待つ
+    with budget.stage("wait_submit"):
+        try:
+            if not post_responses:
+                page.wait_for_event("response", predicate=lambda res: res.request.method == "POST", timeout=confirm_ms(15000))
+            page.wait_for_load_state("domcontentloaded", timeout=confirm_ms())
+        except PlaywrightTimeoutError:
+            log_debug("送信レスポンスの待機がタイムアウトしました")
+
+    # 送信後の状態を確認
+    try:
+        # 送信成功の確認（URLの変更を確認）
+        if "history" in page.url and "id=" in page.url:
+            log_debug("送信成功を確認: URLが履歴ページに遷移")
+            # 履歴ページで自分の送信内容が直近に表示されているか確認
+            try:
+                with budget.stage("wait_history_idle"):
+                    page.wait_for_load_state("networkidle", timeout=confirm_ms(5000))
+                # 履歴ページのHTMLと送信時のPOSTリクエスト内容を保存（always のときだけ）
+                if artifacts.wants():
+                    artifacts.add_html("history", page.content())
+                    artifacts.add_json("post_requests", request_log)
+                found = False
+                sample_log = LogSampler()
+                for reload_count in range(3):
+                    if reload_count > 0:
+                        log_debug("履歴ページをリロード: %s回目", reload_count)
+                        with budget.stage(f"reload_{reload_count}"):
+                            page.reload(wait_until="domcontentloaded", timeout=confirm_ms())
+                            try:
+                                page.wait_for_selector(HISTORY_MESSAGE_SELECTOR, timeout=confirm_ms(10000))
+                            except PlaywrightTimeoutError:
+                                log_debug("履歴メッセージの描画待機がタイムアウトしました")
+                    # メッセージリストの一番下（または上）に自分の送信内容があるか確認
+                    selectors = [
+                        ".message_listWrap .message p",
+                        ".mdl_listBox_simple .message p",
+                        "div.message p"
+                    ]
+                    for selector in selectors:
+                        elements = page.query_selector_all(selector)
+                        for elem in elements[-3:]:  # 直近3件だけ見る
+                            text = elem.inner_text().strip()
+                            if sample_log():
+                                log_debug("履歴ページのメッセージ: %.50s", text)
+                            if reply_text.strip()[:30] in text:
+                                found = True
                                 break
                         if found:
-                            log_debug("履歴ページで自分の送信内容を確認")
-                            # --- 送信時のPOSTリクエストログも出力 ---
-                            return True, "返信を送信しました"
-                        else:
-                            log_debug("履歴ページに自分の送信内容が見つかりません")
-                            return False, "送信処理は完了しましたが、履歴ページに自分の送信内容が見つかりませんでした。手動でご確認ください。"
-                    except Exception as e:
-                        log_debug(f"履歴ページ確認中にエラー: {str(e)}")
-                        return False, "送信後の履歴ページ確認中にエラーが発生しました"
-                
-                # 送信成功の確認（成功メッセージや特定の要素の出現を待機）
-                success_selectors = [
-                    ".success-message",
-                    ".alert-success",
-                    "div:has-text('送信しました')",
-                    "div:has-text('送信完了')"
-                ]
-                
-                for selector in success_selectors:
-                    try:
-                        element = page.wait_for_selector(selector, timeout=5000)
-                        if element:
-                            log_debug(f"送信成功を確認: {selector}")
                             break
-                    except Exception:
-                        continue
-                
-                # 現在のURLを確認
-                current_url = page.url
-                log_debug(f"送信後のURL: {current_url}")
-                
-                # エラーメッセージの確認
-                error_selectors = [
-                    ".error-message",
-                    ".alert-danger",
-                    "div:has-text('エラー')",
-                    "div:has-text('失敗')"
-                ]
-                
-                for selector in error_selectors:
-                    try:
-                        element = page.query_selector(selector)
-                        if element:
-                            error_text = element.inner_text()
-                            # エラーメッセージの内容を検証
-                            if any(keyword in error_text.lower() for keyword in ['エラー', '失敗', 'error', 'failed']):
-                                log_debug(f"エラーメッセージを検出: {error_text}")
-                                return False, f"送信に失敗しました: {error_text}"
-                            else:
-                                log_debug(f"誤検出を除外: {error_text}")
-                    except Exception:
-                        continue
-                
-                # 送信成功しなかった場合もHTMLを保存
+                    if found:
+                        break
+                if found:
+                    log_debug("履歴ページで自分の送信内容を確認")
+                    # --- 送信時のPOSTリクエストログも出力 ---
+                    return True, "返信を送信しました"
                 else:
-                    try:
-                        os.makedirs(screenshot_dir, exist_ok=True)
-                        history_html_path = os.path.join(screenshot_dir, "history_debug.html")
-                        with open(history_html_path, "w", encoding="utf-8") as f:
-                            content = page.content()
-                            f.write(content)
-                            f.flush()
-                            os.fsync(f.fileno())
-                        if os.path.exists(history_html_path):
-                            log_debug(f"[保存確認] {history_html_path} が正常に保存されました")
-                            log_debug(f"[保存内容先頭20000] {content[:20000]}")
-                            # 送信ページ（返信ページ）のHTMLも保存・ログ出力
-                            try:
-                                send_page_path = os.path.join(screenshot_dir, "send_page_debug.html")
-                                with open(send_page_path, "w", encoding="utf-8") as sf:
-                                    send_page_content = page.content()
-                                    sf.write(send_page_content)
-                                    sf.flush()
-                                    os.fsync(sf.fileno())
-                                log_debug(f"[送信ページHTML先頭20000] {send_page_content[:20000]}")
-                            except Exception as e:
-                                log_debug(f"[送信ページHTML保存エラー] {str(e)}")
-                        else:
-                            log_debug(f"[保存確認] {history_html_path} が保存されていません！")
-                            log_debug(f"[保存内容先頭20000] {content[:20000]}")
-                        # 直後にls -lとfindの結果も出力
-                        try:
-                            ls_result = subprocess.check_output(["ls", "-l", screenshot_dir], encoding="utf-8")
-                            log_debug(f"[ls結果] {ls_result}")
-                        except Exception as e:
-                            log_debug(f"[ls結果エラー] {str(e)}")
-                        try:
-                            find_result = subprocess.check_output(["find", screenshot_dir, "-name", "history_debug.html"], encoding="utf-8")
-                            log_debug(f"[find結果] {find_result}")
-                        except Exception as e:
-                            log_debug(f"[find結果エラー] {str(e)}")
-                    except Exception as e:
-                        log_debug(f"[失敗時も保存] 履歴ページHTML保存に失敗: {str(e)} (パス: {history_html_path})")
+                    log_debug("履歴ページに自分の送信内容が見つかりません")
+                    _capture_failure(page, artifacts, "history_not_found")
+                    artifacts.add_json("post_requests", request_log, error=True)
+                    return False, "送信処理は完了しましたが、履歴ページに自分の送信内容が見つかりませんでした。手動でご確認ください。"
             except Exception as e:
-                log_debug(f"ページ読み込み待機中にタイムアウト: {str(e)}")
-            
-            time.sleep(2)
-            context.close()
-            browser.close()
-            return True, "返信を送信しました"
+                log_debug("履歴ページ確認中にエラー: %s", e)
+                return False, "送信後の履歴ページ確認中にエラーが発生しました"
+        
+        # 送信成功の確認（成功メッセージや特定の要素の出現を待機）
+        success_selectors = [
+            ".success-message",
+            ".alert-success",
+            "div:has-text('送信しました')",
+            "div:has-text('送信完了')"
+        ]
+        
+        for selector in success_selectors:
+            try:
+                with budget.stage("wait_success"):
+                    element = page.wait_for_selector(selector, timeout=confirm_ms(5000))
+                if element:
+                    log_debug("送信成功を確認: %s", selector)
+                    break
+            except Exception:
+                continue
+        
+        # 現在のURLを確認
+        current_url = page.url
+        log_debug("送信後のURL: %s", current_url)
+        
+        # エラーメッセージの確認
+        error_selectors = [
+            ".error-message",
+            ".alert-danger",
+            "div:has-text('エラー')",
+            "div:has-text('失敗')"
+        ]
+        
+        for selector in error_selectors:
+            try:
+                element = page.query_selector(selector)
+                if element:
+                    error_text = element.inner_text()
+                    # エラーメッセージの内容を検証
+                    if any(keyword in error_text.lower() for keyword in ['エラー', '失敗', 'error', 'failed']):
+                        log_debug("エラーメッセージを検出: %s", error_text)
+                        return False, f"送信に失敗しました: {error_text}"
+                    else:
+                        log_debug("誤検出を除外: %s", error_text)
+            except Exception:
+                continue
+        
+        # 送信成功を確認できなかった場合も保存
+        else:
+            _capture_failure(page, artifacts, "send_unconfirmed")
+            artifacts.add_json("post_requests", request_log, error=True)
+    except Exception as e:
+        log_debug("ページ読み込み待機中にタイムアウト: %s", e)
+    
+    return True, "返信を送信しました"
+
+def send_reply(email, reply_url, reply_text):
+    """指定メッセージに返信を送信する
+
+    SEND_MODE=http ならまずHTTPでフォームを送信し、フォームの形が変わっている等で
+    送信前に判定できないときだけPlaywrightで送信する（タイムアウト延長＆デバッグ用スクリーンショット）。
+    """
+    try:
+        with log_context(account=email, stage="send", message_id=reply_url):
+            if SEND_MODE == "http":
+                try:
+                    return send_reply_http(email, reply_url, reply_text)
+                except HttpFallback as e:
+                    log_debug("HTTPで送信できないためブラウザで送信します: %s", e)
+            return get_browser().run(email, _send_reply_in_context, reply_url, reply_text, retry=False)
+    except StorageStateNotFound:
+        return False, "cookieファイルの読み込みに失敗しました"
     except Exception as e:
         return False, f"返信送信エラー: {str(e)}"
 
+class CardJob:
+    """メッセージカード1枚で実行中の操作（再作成・送信）"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.partial = ""  # 再作成中に届いた文章
+        self.future = None
+
+    def on_token(self, text):
+        self.partial = text
+
+@st.cache_resource(show_spinner=False)
+def get_card_executor():
+    """カードの操作を実行するスレッドプール（プロセスで共有）"""
+    return ThreadPoolExecutor(max_workers=CARD_MAX_IN_FLIGHT, thread_name_prefix="card-action")
+
+def start_card_job(i, kind):
+    """カードの操作をバックグラウンドで始める（ボタンの on_click から呼ぶ）"""
+    message = st.session_state.messages[i]
+    tid = thread_id(message)
+    if tid in st.session_state.card_jobs:
+        st.toast("このメッセージは処理中です")
+        return
+    email = st.session_state.user_email
+    persona = dict(st.session_state.persona)
+    job = CardJob(kind)
+    if kind == "regenerate":
+        def run():
+            with log_context(account=email, stage="regenerate"):
+                reply = regenerate_reply(attach_history(email, [message], fetch=False)[0], persona, cache=get_reply_cache(), on_token=job.on_token)
+                remember_reply(email, message, reply, persona)
+                return reply
+    else:
+        # 編集中の返信欄の内容をそのまま送る
+        reply_text = st.session_state.get(f"reply_area_{i}", st.session_state.replies[i])
+        run = lambda: send_reply(email, message["reply_url"], reply_text)
+    st.session_state.card_notices.pop(tid, None)
+    job.future = get_card_executor().submit(contextvars.copy_context().run, run)
+    st.session_state.card_jobs[tid] = job
+
+def _apply_card_job(i, tid, job):
+    """終わったカード操作の結果をセッションに反映する"""
+    del st.session_state.card_jobs[tid]
+    reply_errors = st.session_state.get('reply_errors', [])
+    try:
+        result = job.future.result()
+    except Exception as e:
+        log_error("返信生成エラー" if job.kind == "regenerate" else "返信送信エラー", e)
+        if job.kind == "regenerate":
+            if i < len(reply_errors):
+                reply_errors[i] = f"{type(e).__name__}: {e}"
+        else:
+            st.session_state.card_notices[tid] = (False, f"返信送信エラー: {e}")
+        return
+    if job.kind == "regenerate":
+        st.session_state.replies[i] = result
+        if i < len(reply_errors):
+            reply_errors[i] = None
+    else:
+        st.session_state.card_notices[tid] = result
+
+def _save_reply_edit(i):
+    reply = st.session_state[f"reply_area_{i}"]
+    st.session_state.replies[i] = reply
+    # 同期状態にも書いておき、バックグラウンド同期の結果を読み込み直しても編集が消えないようにする
+    if st.session_state.user_email:
+        remember_reply(st.session_state.user_email, st.session_state.messages[i], reply, st.session_state.persona)
+
+def render_reply_body(i):
+    """返信欄。操作の実行中は一定間隔で再実行され、進み具合と結果を表示する"""
+    if i >= len(st.session_state.get('replies', [])):
+        return  # 一覧が読み込み直されて、このカードがなくなった
+    message = st.session_state.messages[i]
+    tid = thread_id(message)
+    job = st.session_state.card_jobs.get(tid)
+    if job is not None and job.future.done():
+        _apply_card_job(i, tid, job)
+        if not st.session_state.card_jobs:
+            # run_every による定期実行はページ全体の再実行でしか止まらないので、
+            # 実行中の操作がすべて終わったところで1回だけ全体を再実行して止める
+            st.rerun()
+        job = None
+    reply_errors = st.session_state.get('reply_errors', [])
+    if i < len(reply_errors) and reply_errors[i]:
+        st.error(f"返信の生成に失敗しました: {reply_errors[i]}")
+    if job is not None and job.kind == "regenerate":
+        # 生成中の文章をトークンが届いた分だけ表示する
+        st.markdown(f"{job.partial}▌" if job.partial else "✍️ 返信を作成中…")
+        return
+    reply = st.session_state.replies[i]
+    st.text_area("返信文", reply, key=f"reply_area_{i}", height=100, on_change=_save_reply_edit, args=(i,), disabled=job is not None)
+    from streamlit_extras.copy_to_clipboard import copy_to_clipboard_button
+    copy_to_clipboard_button(reply, "📋 コピー", "✅ コピーしました！")
+    if job is not None:
+        st.info("📤 送信中…")
+    notice = st.session_state.card_notices.get(tid)
+    if notice is not None:
+        (st.success if notice[0] else st.error)(notice[1])
+
+@st.fragment
+def render_message_card(i):
+    """メッセージ1件のカード。再作成・編集・送信はこのカードだけを再実行する"""
+    message = st.session_state.messages[i]
+    render_message_header(message)
+    if i >= len(st.session_state.get('replies', [])):
+        return
+    tid = thread_id(message)
+    job = st.session_state.card_jobs.get(tid)
+    if job is not None and job.future.done():
+        # 終わっている操作はここで反映し、返信欄を定期実行で登録しない
+        _apply_card_job(i, tid, job)
+        job = None
+    with st.container():
+        st.markdown("<div class='reply-box'>", unsafe_allow_html=True)
+        # 操作の実行中だけ返信欄を定期的に更新する（他のカードやページ全体は再実行しない）
+        st.fragment(render_reply_body, run_every=CARD_POLL_SECONDS if job is not None else None)(i)
+        col_regen, col_send = st.columns(2)
+        col_regen.button("🔄 再作成", key=f"regen_reply_{i}", on_click=start_card_job, args=(i, "regenerate"), use_container_width=True)
+        col_send.button("📤 送信", key=f"send_reply_{i}", on_click=start_card_job, args=(i, "send"), disabled=not message.get("reply_url"), use_container_width=True)
+        st.markdown("</div>", unsafe_allow_html=True)
+
+def drain_send_queue(email, drain):
+    """送信キューの runner。HTTPのセッション（使えなければ1つのブラウザ context）を使い回して drain する"""
+    if SEND_MODE == "http":
+        try:
+            drain(lambda reply_url, reply_text: send_reply_http(email, reply_url, reply_text))
+            return
+        except HttpFallback as e:
+            log_debug("HTTPで送信できないため残りをブラウザで送信します: %s", e)
+    get_browser().run(email, _drain_send_queue_in_context, drain, retry=False)
+
+def _drain_send_queue_in_context(context, drain):
+    """ブラウザスレッド上で、1つの context（storage_state の読み込みは1回）のまま順に送信する"""
+    drain(lambda reply_url, reply_text: _send_reply_in_context(context, reply_url, reply_text))
+
+def get_account_send_queue(email):
+    return get_send_queue(email, drain_send_queue)
+
+def render_send_queue_panel(email):
+    """一括送信の進み具合とジョブごとの結果"""
+    queue = get_account_send_queue(email)
+    if st.session_state.get("send_queue_polling") and not queue.active:
+        # run_every の定期実行はページ全体の再実行でしか止まらないので、送り終えたら1回だけ再実行する
+        st.session_state.send_queue_polling = False
+        st.rerun()
+    status = queue.status()
+    if not status["total"]:
+        return
+    st.progress(status["done"] / status["total"], text=f"一括送信: {status['done']}/{status['total']}件（送信済み {status['sent']}・失敗 {status['failed']}）")
+    labels = {"queued": "⏳ 待機中", "sending": "📤 送信中", "retrying": "🔁 再送待ち", "sent": "✅ 送信済み", "failed": "❌ 失敗"}
+    st.dataframe(
+        [{"宛先": job["label"], "状態": labels[job["status"]], "試行": job["attempts"], "結果": job["message"] or ""} for job in status["jobs"]],
+        use_container_width=True, hide_index=True
+    )
+    col_cancel, col_clear = st.columns(2)
+    if col_cancel.button("⏹ 残りを取り消す", key="send_queue_cancel", disabled=not queue.active, use_container_width=True):
+        queue.cancel()
+    if col_clear.button("🧹 完了分を消す", key="send_queue_clear", use_container_width=True):
+        queue.clear_finished()
+        st.rerun(scope="fragment")
+
+def _enqueue_bulk_send(email, targets):
+    items = []
+    for i in targets:
+        message = st.session_state.messages[i]
+        # 編集中の返信欄の内容をそのまま送る
+        reply_text = st.session_state.get(f"reply_area_{i}", st.session_state.replies[i])
+        items.append((message["reply_url"], reply_text, f"{message['sender']}（{message['time']}）"))
+    added = get_account_send_queue(email).enqueue(items)
+    # 続けて押して二重に積まないよう、確認をやり直してもらう
+    st.session_state.bulk_send_confirmed = False
+    st.toast(f"{added}件を送信キューに積みました" if added else "送信待ち・送信済みのものだけでした")
+
+def render_bulk_send(email, page_indices):
+    """表示中のページの返信をまとめて送信キューに積むボタンと進み具合"""
+    if not email or not st.session_state.get('replies'):
+        return
+    targets = [i for i in page_indices if i < len(st.session_state.replies) and st.session_state.messages[i].get("reply_url")]
+    with st.expander(f"📤 一括送信（表示中の {len(targets)}件）", expanded=get_account_send_queue(email).active):
+        confirmed = st.checkbox("表示中の返信文を確認しました", key="bulk_send_confirmed")
+        st.button("📤 まとめて送信", key="bulk_send", on_click=_enqueue_bulk_send, args=(email, targets), disabled=not confirmed or not targets, use_container_width=True)
+        # 送信中だけ進み具合を定期的に更新する（ページ全体は再実行しない）
+        active = get_account_send_queue(email).active
+        st.session_state.send_queue_polling = active
+        st.fragment(render_send_queue_panel, run_every=1.0 if active else None)(email)
+
+# 追加CSS
+APP_CSS = '''
+<style>
+body, .stApp {
+  font-family: "Noto Sans JP", "Hiragino Sans", sans-serif;
+  background: linear-gradient(180deg, #fefefe 0%, #fdf2f8 100%);
+}
+
+h1, .stMarkdown h1 { font-size: 1.8rem !important; color: #333 !important; }
+h2, .stMarkdown h2 { font-size: 1.4rem !important; color: #444 !important; }
+h3, .stMarkdown h3 { font-size: 1.2rem !important; color: #444 !important; }
+
+.user-card, .reply-box {
+  max-width: 640px;
+  margin: 1.2em auto;
+  padding: 1.2em 1.5em;
+  border-radius: 18px;
+  background: #fff;
+  box-shadow: 0 2px 12px rgba(249, 199, 209, 0.10);
+  color: #555;
+  line-height: 1.6;
+}
+.reply-box {
+  border: 1.5px solid #f9c7d1;
+  background: #fdf2f8;
+  box-shadow: 0 2px 8px rgba(249, 199, 209, 0.13);
+  margin-bottom: 1.2em;
+}
+.reply-actions {
+  display: flex;
+  gap: 1em;
+  justify-content: center;
+  margin-top: 0.7em;
+}
+.reply-actions button {
+  background: linear-gradient(90deg, #f9c7d1, #f7e9f0);
+  border-radius: 12px;
+  padding: 0.8em 1.5em;
+  font-size: 1rem;
+  border: none;
+  transition: 0.2s;
+  box-shadow: 0 2px 4px rgba(0,0,0,0.08);
+  cursor: pointer;
+  display: flex;
+  align-items: center;
+  gap: 0.5em;
+}
+.reply-actions button:hover {
+  background: linear-gradient(90deg, #f7e9f0, #f9c7d1);
+  color: #c94f7c;
+}
+.scrollable-chat {
+  max-width: 640px;
+  margin: auto;
+}
+@media (max-width: 700px) {
+  .user-card, .reply-box, .scrollable-chat {
+    max-width: 98vw;
+    padding: 1em 0.5em;
+  }
+  .reply-actions { flex-direction: column; gap: 0.7em; }
+}
+</style>
+'''
+
 def main():
     if 'user_email' not in st.session_state:
         st.session_state.user_email = ""
     if 'user_password' not in st.session_state:
         st.session_state.user_password = ""
     
-    # --- 追加CSS ---
-    st.markdown('''
-    <style>
-    body, .stApp {
-      font-family: "Noto Sans JP", "Hiragino Sans", sans-serif;
-      background: linear-gradient(180deg, #fefefe 0%, #fdf2f8 100%);
-    }
-
-    h1, .stMarkdown h1 { font-size: 1.8rem !important; color: #333 !important; }
-    h2, .stMarkdown h2 { font-size: 1.4rem !important; color: #444 !important; }
-    h3, .stMarkdown h3 { font-size: 1.2rem !important; color: #444 !important; }
-
-    .user-card, .reply-box {
-      max-width: 640px;
-      margin: 1.2em auto;
-      padding: 1.2em 1.5em;
-      border-radius: 18px;
-      background: #fff;
-      box-shadow: 0 2px 12px rgba(249, 199, 209, 0.10);
-      color: #555;
-      line-height: 1.6;
-    }
-    .reply-box {
-      border: 1.5px solid #f9c7d1;
-      background: #fdf2f8;
-      box-shadow: 0 2px 8px rgba(249, 199, 209, 0.13);
-      margin-bottom: 1.2em;
-    }
-    .reply-actions {
-      display: flex;
-      gap: 1em;
-      justify-content: center;
-      margin-top: 0.7em;
-    }
-    .reply-actions button {
-      background: linear-gradient(90deg, #f9c7d1, #f7e9f0);
-      border-radius: 12px;
-      padding: 0.8em 1.5em;
-      font-size: 1rem;
-      border: none;
-      transition: 0.2s;
-      box-shadow: 0 2px 4px rgba(0,0,0,0.08);
-      cursor: pointer;
-      display: flex;
-      align-items: center;
-      gap: 0.5em;
-    }
-    .reply-actions button:hover {
-      background: linear-gradient(90deg, #f7e9f0, #f9c7d1);
-      color: #c94f7c;
-    }
-    .scrollable-chat {
-      max-width: 640px;
-      margin: auto;
-    }
-    @media (max-width: 700px) {
-      .user-card, .reply-box, .scrollable-chat {
-        max-width: 98vw;
-        padding: 1em 0.5em;
-      }
-      .reply-actions { flex-direction: column; gap: 0.7em; }
-    }
-    </style>
-    ''', unsafe_allow_html=True)
+    # 追加CSS（要素は再実行ごとに描画し直されるので毎回出力する）
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
     # タイトルを親しみやすく小さめに
     st.title("📨 YYCで届いたメッセージに楽しく返信しよう♪")
@@ -698,18 +1314,26 @@ def main():
                 email = st.session_state.user_email
                 if not email:
                     st.warning("先にメールアドレスを入力してください")
+                elif st.session_state.get("uploaded_cookie") == (email, uploaded_file.name, uploaded_file.size):
+                    # 自動更新による再実行では保存・検証をやり直さない
+                    pass
                 else:
-                    cookies_dir = COOKIES_DIR if 'COOKIES_DIR' in globals() else "cookies"
-                    os.makedirs(cookies_dir, exist_ok=True)
-                    file_path = os.path.join(cookies_dir, f"{email}_storage.json")
-                    with open(file_path, "wb") as f:
-                        f.write(uploaded_file.read())
-                    st.success("✅ cookieファイルを保存しました")
-                    # バリデーション
-                    if check_cookie_valid(email):
-                        st.success("✅ cookieは有効です")
+                    st.session_state.uploaded_cookie = (email, uploaded_file.name, uploaded_file.size)
+                    try:
+                        # 正規化はここで1回だけ行い、以降の読み込みでは書き換えない
+                        save_storage_state(email, json.loads(uploaded_file.getvalue().decode("utf-8")))
+                    except (ValueError, AttributeError) as e:
+                        log_error("cookieファイルの読み込みエラー", e)
+                        st.error("cookieファイルの形式が正しくありません（storage_state のJSONを指定してください）")
                     else:
-                        st.error("❌ cookieは無効です")
+                        st.success("✅ cookieファイルを保存しました")
+                        # バリデーション（アップロード直後は必ず確認し直す）
+                        if check_cookie_valid(email, use_cache=False):
+                            st.success("✅ cookieは有効です")
+                            if BACKGROUND_SYNC:
+                                get_poller().poll_now(email)
+                        else:
+                            st.error("❌ cookieは無効です")
             st.markdown('</div>', unsafe_allow_html=True)
         with st.container():
             st.markdown('<div class="sidebar-section">', unsafe_allow_html=True)
@@ -721,6 +1345,35 @@ def main():
             st.text_input("性格", value=st.session_state.persona["personality"], key="persona_personality")
             st.text_input("文章スタイル", value=st.session_state.persona["writing_style"], key="persona_writing_style")
             st.markdown('</div>', unsafe_allow_html=True)
+        render_poller_panel()
+        with st.expander("🗂 返信キャッシュ"):
+            cache_stats = get_reply_cache().stats()
+            st.text(f"ヒット: {cache_stats['hits']}（メモリ {cache_stats['memory_hits']} / ディスク {cache_stats['disk_hits']}）")
+            st.text(f"ミス: {cache_stats['misses']}  ヒット率: {cache_stats['hit_rate']:.0%}")
+            st.text(f"ディスク使用量: {cache_stats['disk_bytes'] / 1024:.1f} KB")
+        if st.session_state.get("show_debug"):
+            with st.expander("⏱ 待ち時間レポート"):
+                st.json(recent_reports()[:10])
+            with st.expander("⚡ 返信ストリーミング（最初のトークンまでの時間）"):
+                st.json(recent_stream_metrics()[:10])
+            with st.expander("🔢 トークン使用量"):
+                totals = usage_totals()
+                st.text(f"呼び出し: {totals['calls']}回  入力: {totals['prompt_tokens']}  出力: {totals['completion_tokens']}")
+                st.json(recent_usage()[:10])
+            with st.expander("🚀 起動・再実行の所要時間"):
+                st.json(recent_reruns()[:10])
+            with st.expander("🚫 リソースブロック"):
+                blocked = resource_filter_totals()
+                st.text(f"ブロック: {blocked['blocked_requests']}件 / 許可: {blocked['allowed_requests']}件")
+                st.text(f"節約（見積もり）: {blocked['estimated_bytes_saved'] / 1024:.0f} KB")
+
+    poller = ensure_background_sync()
+
+    # 同期結果があればすぐに表示する
+    load_synced_inbox(st.session_state.user_email)
+    if poller is not None:
+        # 同期状態が更新されたときだけ画面全体を再実行する（それ以外の定期実行はこの中だけで終わる）
+        watch_synced_inbox(st.session_state.user_email)
 
     # メインコンテンツ
     if st.button("📥 最新メッセージを取得", key="fetch_messages", use_container_width=True):
@@ -728,52 +1381,56 @@ def main():
         if not st.session_state.user_email:
             st.error("メールアドレスを入力してください")
         else:
-            storage_file = os.path.join(COOKIES_DIR, f"{st.session_state.user_email}_storage.json")
-            if not os.path.exists(storage_file):
+            if not os.path.exists(storage_file(st.session_state.user_email)):
                 st.error("cookieファイルがありません。手動でcookieを保存してください")
+            elif not check_cookie_valid(st.session_state.user_email):
+                st.error("cookieでログインできませんでした。再度保存してください。")
             else:
                 try:
-                    with st.spinner("メッセージと返信を取得中..."):
-                        with sync_playwright() as p:
-                            browser = p.chromium.launch(headless=True)
-                            context = load_cookies(browser, st.session_state.user_email)
-                            if context is None:
-                                st.error("cookieファイルの読み込みに失敗しました")
-                                browser.close()
-                            else:
-                                page = context.new_page()
-                                messages = get_latest_messages(page)
-                                st.session_state.messages = messages if messages else []
-                                # 返信候補を自動生成
-                                st.session_state.replies = []
-                                for msg in st.session_state.messages:
-                                    reply = generate_reply(msg, st.session_state.persona)
-                                    st.session_state.replies.append(reply)
-                                context.close()
-                                browser.close()
+                    with log_context(account=st.session_state.user_email, stage="fetch"):
+                        # ページを読むたびにカードを表示し、新規・変更のあったスレッドだけ返信を並列に生成
+                        fetch_inbox_progressively(st.session_state.user_email, st.session_state.persona)
+                except StorageStateNotFound:
+                    st.error("cookieファイルの読み込みに失敗しました")
                 except Exception as e:
                     st.error(f"エラーが発生しました: {str(e)}")
 
     st.subheader("メッセージ一覧")
+    if st.session_state.last_check:
+        st.caption(f"最終取得: {st.session_state.last_check:%Y-%m-%d %H:%M:%S}")
+    # 絞り込んでから表示中のページの分だけ描画する（再実行の重さが受信箱の大きさに依存しない）
+    page_indices = render_message_filters(st.session_state.messages)
+    render_bulk_send(st.session_state.user_email, page_indices)
     # スクロール可能なチャットエリア
     with st.container():
         st.markdown('<div class="scrollable-chat">', unsafe_allow_html=True)
-        for i, message in enumerate(st.session_state.messages):
-            st.markdown(f"<div class='user-card'><b>{message['sender']}</b> <span style='color:#888;font-size:0.9em;'>({message['time']})</span></div>", unsafe_allow_html=True)
-            st.code(message['content'], language="")  # 本文を全文表示
-            if 'replies' in st.session_state and i < len(st.session_state.replies):
-                reply = st.session_state.replies[i]
-                with st.container():
-                    st.markdown("<div class='reply-box'>", unsafe_allow_html=True)
-                    st.text_area("返信文", reply, key=f"reply_area_{i}", height=100)
-                    copy_to_clipboard_button(reply, "📋 コピー", "✅ コピーしました！")
-                    if st.button("🔄 再作成", key=f"regen_reply_{i}"):
-                        st.session_state.replies[i] = generate_reply(message, st.session_state.persona)
-                        st.experimental_rerun()
-                    st.markdown("</div>", unsafe_allow_html=True)
-            if i < len(st.session_state.messages) - 1:
+        for n, i in enumerate(page_indices):
+            render_message_card(i)
+            if n < len(page_indices) - 1:
                 st.markdown("<hr style='margin:0.5em 0;' />", unsafe_allow_html=True)
         st.markdown('</div>', unsafe_allow_html=True)
 
+def record_run_profile(main_started):
+    """この再実行の段階別所要時間（import・設定・画面描画）を記録する"""
+    now = time.perf_counter()
+    record_rerun({
+        "at": datetime.fromtimestamp(_RUN_STARTED_AT).strftime("%H:%M:%S"),
+        # 設定をこの実行で読み込んだ＝プロセス起動後の最初の実行
+        "cold": CONFIG["loaded_at"] >= _RUN_STARTED_AT,
+        "config_ms": round((_CONFIG_READY - _RUN_STARTED) * 1000, 1),
+        "imports_ms": round((_IMPORTS_READY - _CONFIG_READY) * 1000, 1),
+        "setup_ms": round((main_started - _IMPORTS_READY) * 1000, 1),
+        "render_ms": round((now - main_started) * 1000, 1),
+        "total_ms": round((now - _RUN_STARTED) * 1000, 1),
+    })
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main_started = time.perf_counter()
+    if st.session_state.get("show_debug"):
+        # デバッグ表示をオンにしたセッションだけ、ログをパネル用チャンネルにも流す
+        with debug_panel(new_panel_buffer()) as panel:
+            main()
+        render_debug_panel(panel)
+    else:
+        main()
+    record_run_profile(main_started)
@@ -1,16 +1,13 @@
+from debug_artifacts import start_capture
+
 # 送信ボタンをクリック
+# デバッグ用のHTML・スクリーンショットは DEBUG_ARTIFACTS の設定に従ってバックグラウンドで保存する
+artifacts = start_capture("yyc_auto_reply")
 try:
-    # 送信フォームのHTML全体を保存
-    send_form_html = await page.locator('form#send-mail-form').inner_html()
-    with open('send_form_debug.html', 'w', encoding='utf-8') as f:
-        f.write(send_form_html)
-    logger.info(f"送信フォームHTML: {send_form_html[:1000]}...")  # 最初の1000文字をログ出力
-
     # 送信フォームのouterHTMLを保存
-    send_form_outer_html = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
-    with open('send_form_outer_debug.html', 'w', encoding='utf-8') as f:
-        f.write(send_form_outer_html)
-    logger.info(f"送信フォームouterHTML: {send_form_outer_html[:2000]}...")  # 先頭2000文字
+    if artifacts.wants():
+        send_form_outer_html = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
+        artifacts.add_html("send_form_outer", send_form_outer_html)
 
     # 送信ボタンを全て取得してログ出力
     send_buttons = page.locator('form#send-mail-form input[type="submit"], form#send-mail-form button[type="submit"]')
@@ -25,10 +22,9 @@ try:
         logger.warning("送信ボタンがフォーム内に見つかりません。2秒待って再取得します。")
         await page.wait_for_timeout(2000)
         # 再取得
-        send_form_outer_html2 = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
-        with open('send_form_outer_debug_after_wait.html', 'w', encoding='utf-8') as f:
-            f.write(send_form_outer_html2)
-        logger.info(f"[再取得]送信フォームouterHTML: {send_form_outer_html2[:2000]}...")
+        if artifacts.wants(error=True):
+            send_form_outer_html2 = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
+            artifacts.add_html("send_form_outer_after_wait", send_form_outer_html2, error=True)
         send_buttons2 = page.locator('form#send-mail-form input[type=\"submit\"], form#send-mail-form button[type=\"submit\"]')
         count2 = await send_buttons2.count()
         logger.info(f"[再取得]送信ボタン候補の数: {count2}")
@@ -40,10 +36,9 @@ try:
             logger.warning("[再取得]送信ボタンがフォーム内に見つかりません。スクロール後に再取得します。")
             await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
             await page.wait_for_timeout(1000)
-            send_form_outer_html3 = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
-            with open('send_form_outer_debug_after_scroll.html', 'w', encoding='utf-8') as f:
-                f.write(send_form_outer_html3)
-            logger.info(f"[スクロール後]送信フォームouterHTML: {send_form_outer_html3[:2000]}...")
+            if artifacts.wants(error=True):
+                send_form_outer_html3 = await page.locator('form#send-mail-form').evaluate('el => el.outerHTML')
+                artifacts.add_html("send_form_outer_after_scroll", send_form_outer_html3, error=True)
             send_buttons3 = page.locator('form#send-mail-form input[type=\"submit\"], form#send-mail-form button[type=\"submit\"]')
             count3 = await send_buttons3.count()
             logger.info(f"[スクロール後]送信ボタン候補の数: {count3}")
@@ -53,7 +48,8 @@ try:
                 logger.info(f"[スクロール後]送信ボタン{i} outerHTML: {btn_html3}")
             if count3 == 0:
                 logger.warning("[スクロール後]送信ボタンがフォーム内に見つかりません。フォーム全体のスクリーンショットを保存します。")
-                await page.locator('form#send-mail-form').screenshot(path='send_form_no_button_after_scroll.png')
+                if artifacts.wants(error=True):
+                    artifacts.add_screenshot("send_form_no_button_after_scroll", await page.locator('form#send-mail-form').screenshot(), error=True)
 
     # 送信ボタンをクリック
     await send_buttons.click()
@@ -71,20 +67,13 @@ try:
         logger.warning(f"送信後のURLが想定外: {current_url}")
 
     # ページ全体のHTMLを保存
-    full_html = await page.content()
-    with open('page_full_debug.html', 'w', encoding='utf-8') as f:
-        f.write(full_html)
-    logger.info(f"ページ全体のHTMLを保存しました（先頭2000文字）: {full_html[:2000]}...")
-
-    # ページ全体から送信ボタン候補を自動抽出
-    import re
-    submit_buttons = re.findall(r'<(input|button)[^>]*type=["\"]submit["\"][^>]*>', full_html)
-    logger.info(f"ページ全体から抽出した送信ボタン候補の数: {len(submit_buttons)}")
-    for i, btn_html in enumerate(submit_buttons):
-        logger.info(f"[全体探索]送信ボタン候補{i}: {btn_html}")
+    if artifacts.wants():
+        artifacts.add_html("page_full", await page.content())
 
 except Exception as e:
     logger.error(f"送信ボタンのクリックに失敗: {str(e)}")
     # スクリーンショットを保存
-    await page.screenshot(path='send_button_error.png')
+    if artifacts.wants(error=True):
+        artifacts.add_screenshot("send_button_error", await page.screenshot(), error=True)
+        artifacts.add_html("send_button_error", await page.content(), error=True)
     raise 
\ No newline at end of file
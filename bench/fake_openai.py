@@ -0,0 +1,107 @@
+"""ベンチマーク用の偽 chat completions サーバー
+
+POST /v1/chat/completions に対して、設定した遅延のあとで固定の返信を返す。
+stream=true のときは遅延のあと token_interval 秒ごとに数文字ずつ SSE で返す。
+response_format が json_object のとき（バッチ生成）は、プロンプト内の id ごとに返信を入れたJSONを返す。
+latency（秒）と jitter（秒）は実行中に変更できる。
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_TEXT = "メッセージありがとうございます😊 私もカフェ巡りが好きなので、おすすめのお店があったら教えてください！"
+
+
+class FakeOpenAI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.3, jitter=0.05, token_interval=0.02):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_interval = token_interval
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server._handle(self)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    @property
+    def api_base(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("Content-Length", "0"))
+        request = json.loads(handler.rfile.read(length) or b"{}")
+        with self._lock:
+            self.requests += 1
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if request.get("stream"):
+            self._handle_stream(handler, request)
+            return
+        content = REPLY_TEXT
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            ids = re.findall(r'"id": "([^"<]+)"', prompt)
+            content = json.dumps({"replies": [{"id": i, "reply": REPLY_TEXT} for i in ids]}, ensure_ascii=False)
+        body = json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 200, "completion_tokens": 40, "total_tokens": 240},
+        }, ensure_ascii=False).encode("utf-8")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle_stream(self, handler, request):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        pieces = [REPLY_TEXT[i:i + 4] for i in range(0, len(REPLY_TEXT), 4)]
+        for i, piece in enumerate(pieces):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-3.5-turbo"),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": piece} if i == 0 else {"content": piece},
+                    "finish_reason": None,
+                }],
+            }
+            handler.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+            time.sleep(self.token_interval)
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
@@ -0,0 +1,146 @@
+"""ベンチマーク用のYYC代替サイト（ローカルHTTPサーバー）
+
+round_trip 一覧（.mdl_listBox_simple の行を任意件数）、履歴ページ（form#send-mail-form）、
+送信POST、マイページ、ダミー画像を返す。行数は FixtureSite.row_count、1ページの行数は
+FixtureSite.page_size（0ならページ送りなし）で実行中に変更できる。
+"""
+import html
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_PNG_1x1 = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def _page(title, body):
+    return f"""<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="/static/site.css">
+<script src="https://www.googletagmanager.com/gtm.js"></script>
+</head><body>{body}</body></html>"""
+
+
+class FixtureSite:
+    """テスト用サイト本体（スレッドで起動・停止する）"""
+
+    def __init__(self, host="127.0.0.1", port=0, row_count=10, page_size=0):
+        self.row_count = row_count
+        self.page_size = page_size
+        self.sent = {}  # thread id -> 送信されたメッセージ
+        self._lock = threading.Lock()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site._handle_get(self)
+
+            def do_POST(self):
+                site._handle_post(self)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fixture-site", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- ページ生成 ---
+
+    def round_trip_html(self, count, page=1):
+        base = datetime(2024, 1, 1, 12, 0)
+        first, last = 0, count
+        if self.page_size:
+            first = (page - 1) * self.page_size
+            last = min(count, first + self.page_size)
+        rows = []
+        for i in range(first, last):
+            sent_at = (base - timedelta(minutes=i)).strftime("%m/%d %H:%M")
+            rows.append(
+                f'<div class="mdl_listBox_simple">'
+                f'<a href="/my/mail_box/history/?id={i}">'
+                f'<div class="thumb"><img src="/img/{i}.png" width="60" height="60"></div>'
+                f'<div><div class="name"><strong>ユーザー{i}</strong></div>'
+                f'<div class="message"><p>はじめまして！メッセージ{i}です。週末はカフェに行くのが好きです。よろしくお願いします。</p></div>'
+                f'<span class="date">{sent_at}</span></div></a></div>'
+            )
+        pager = ""
+        if last < count:
+            pager = f'<div class="pager"><a rel="next" href="/my/mail_box/round_trip?filter=not_res&amp;page={page + 1}">次へ</a></div>'
+        return _page("メッセージ一覧", f'<div class="message_listWrap">{"".join(rows)}</div>{pager}')
+
+    def history_html(self, thread_id):
+        with self._lock:
+            sent = list(self.sent.get(thread_id, []))
+        items = [f'<div class="message"><p>はじめまして！メッセージ{html.escape(thread_id)}です。</p></div>']
+        items += [f'<div class="message mine"><p>{html.escape(text)}</p></div>' for text in sent]
+        form = (
+            '<form id="send-mail-form" action="/my/mail_box/send" method="post">'
+            f'<input type="hidden" name="id" value="{html.escape(thread_id)}">'
+            '<input type="hidden" name="token" value="bench-token">'
+            '<textarea name="message"></textarea>'
+            '<input type="submit" value="送信">'
+            '</form>'
+        )
+        return _page("メッセージ履歴", f'<div class="message_listWrap">{"".join(items)}</div>{form}')
+
+    # --- リクエスト処理 ---
+
+    def _send(self, handler, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(body)
+
+    def _handle_get(self, handler):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        if url.path == "/my/mail_box/round_trip":
+            self._send(handler, 200, self.round_trip_html(self.row_count, int(query.get("page", ["1"])[0])))
+        elif url.path == "/my/mail_box/history/":
+            self._send(handler, 200, self.history_html(query.get("id", ["0"])[0]))
+        elif url.path == "/mypage/":
+            self._send(handler, 200, _page("マイページ", '<a href="/mypage/">マイページ</a>'))
+        elif url.path.startswith("/img/"):
+            self._send(handler, 200, _PNG_1x1, content_type="image/png")
+        elif url.path == "/static/site.css":
+            self._send(handler, 200, "body{font-family:sans-serif}", content_type="text/css")
+        else:
+            self._send(handler, 404, "not found")
+
+    def _handle_post(self, handler):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length", "0"))
+        form = parse_qs(handler.rfile.read(length).decode("utf-8"))
+        if url.path != "/my/mail_box/send":
+            self._send(handler, 404, "not found")
+            return
+        thread_id = form.get("id", ["0"])[0]
+        with self._lock:
+            self.sent.setdefault(thread_id, []).append(form.get("message", [""])[0])
+        self._send(handler, 303, headers={"Location": f"/my/mail_box/history/?id={thread_id}"})
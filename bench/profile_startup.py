@@ -0,0 +1,81 @@
+"""app.py の起動時間（import にかかる時間）の内訳
+
+別プロセスで python -X importtime を使って app を読み込み、トップレベルの
+import ごとの累積時間を多い順に出す。再実行ごとの所要時間はアプリの
+デバッグ表示（🚀 起動・再実行の所要時間）で確認する。
+
+    python -m bench.profile_startup --top 20 --output startup_profile.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力を [(モジュール名, 深さ, 自身のus, 累積us)] にする"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue  # 見出し行
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def profile(module="app", top=20):
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "profile")
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    # app は作業ディレクトリに cookies/ などを作るので一時ディレクトリで読み込む
+    workdir = tempfile.mkdtemp(prefix="appres-startup-")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    rows = parse_importtime(result.stderr)
+    # 子の import は親より先に出力されるので、module の行の直前にある深さ1の行がその import
+    end = next((i for i in range(len(rows) - 1, -1, -1) if rows[i][1] == 0 and rows[i][0] == module), len(rows))
+    start = next((i + 1 for i in range(end - 1, -1, -1) if rows[i][1] == 0), 0)
+    children = sorted((r for r in rows[start:end] if r[1] == 1), key=lambda r: r[3], reverse=True)
+    total_us = rows[end][3] if end < len(rows) else sum(r[3] for r in children)
+    errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+    return {
+        "module": module,
+        "ok": result.returncode == 0,
+        "error": "\n".join(errors[-5:]) if result.returncode != 0 else None,
+        "total_ms": round(total_us / 1000, 1),
+        "imports": [
+            {"module": name, "cumulative_ms": round(cum / 1000, 1), "self_ms": round(own / 1000, 1)}
+            for name, _, own, cum in children[:top]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--output", help="結果を書き出すJSON")
+    args = parser.parse_args(argv)
+
+    report = profile(args.module, args.top)
+    if not report["ok"]:
+        print(f"{args.module} の読み込みに失敗しました（途中までの結果）:\n{report['error']}", file=sys.stderr)
+    print(f"{args.module}: import 合計 {report['total_ms']}ms")
+    for row in report["imports"]:
+        print(f"  {row['module']:<40} {row['cumulative_ms']:>8.1f}ms（自身 {row['self_ms']}ms）")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""オフラインのベンチマーク
+
+ローカルのYYC代替サイトと偽OpenAIサーバーを起動し、app.py の
+get_latest_messages() / get_latest_messages_http() / generate_reply() / send_reply() と送信キューを実際に動かして
+段階ごとの p50/p95 レイテンシ・スループット・ピークRSS を JSON に書き出す。
+
+    python -m bench.run_bench --rows 10,100,1000,5000 --output bench_results.json
+    python -m bench.run_bench --output new.json --compare bench_results.json
+    python -m bench.run_bench --stages http,generate,send   # Chromium のない環境
+
+ブラウザのステージは Chromium を起動できなければ飛ばす。
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from bench.fake_openai import FakeOpenAI
+from bench.fixture_site import FixtureSite
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_EMAIL = "bench@example.com"
+BENCH_PERSONA = {
+    "name": "優子",
+    "age": 28,
+    "occupation": "OL",
+    "interests": ["カフェ巡り", "旅行", "料理"],
+    "personality": "明るく、フレンドリー",
+    "writing_style": "カジュアルで親しみやすい",
+}
+# --stages で選べるステージのまとまり
+#   browser: browser_warmup / fetch / send_reply_browser / send_queue_browser（Chromium が必要）
+#   http: fetch_http / first_message、generate: generate_reply / generate_replies / regenerate_stream、send: send_reply
+STAGE_GROUPS = ("browser", "http", "generate", "send")
+
+
+# --- メモリ計測 ---
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _descendants(root_pid):
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    result, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        for child in children.get(pid, []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def process_tree_rss():
+    """自プロセス＋子孫プロセス（Chromium等）のRSS合計。/proc がなければ ru_maxrss"""
+    if not os.path.isdir("/proc"):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    pid = os.getpid()
+    return _rss_bytes(pid) + sum(_rss_bytes(child) for child in _descendants(pid))
+
+
+class PeakRSSSampler:
+    """with の間、一定間隔でRSSを測ってピークを記録する"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = process_tree_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_tree_rss())
+
+
+# --- 集計 ---
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+class StageRecorder:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, items_per_op=1):
+        latencies = []
+        sampler = PeakRSSSampler()
+        started = time.perf_counter()
+        with sampler:
+            yield latencies
+        wall = time.perf_counter() - started
+        ops = len(latencies)
+        self.stages[name] = {
+            "iterations": ops,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if ops else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if ops else None,
+            "mean_ms": round(sum(latencies) / ops * 1000, 2) if ops else None,
+            "throughput_ops_per_s": round(ops / wall, 3) if wall else None,
+            "throughput_items_per_s": round(ops * items_per_op / wall, 3) if wall else None,
+            "peak_rss_mb": round(sampler.peak / (1024 * 1024), 1),
+        }
+        print(f"{name:<28} p50={self.stages[name]['p50_ms']}ms p95={self.stages[name]['p95_ms']}ms "
+              f"peak_rss={self.stages[name]['peak_rss_mb']}MB", flush=True)
+
+
+def timed(latencies, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+# --- 実行 ---
+
+def _prepare_environment(site, llm, workdir):
+    os.chdir(workdir)
+    os.environ.update({
+        "YYC_BASE_URL": site.base_url,
+        "OPENAI_API_BASE": llm.api_base,
+        "OPENAI_API_KEY": "bench",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        "DEBUG_ARTIFACTS": "off",
+        "REPLY_CACHE_DIR": os.path.join(workdir, "cache", "replies"),
+    })
+    os.makedirs("cookies", exist_ok=True)
+    with open(os.path.join("cookies", f"{BENCH_EMAIL}_storage.json"), "w", encoding="utf-8") as f:
+        json.dump({"cookies": [], "origins": []}, f)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import app  # 環境変数を設定してから読み込む
+    return app
+
+
+def run(args):
+    site = FixtureSite().start()
+    llm = FakeOpenAI(latency=args.llm_latency, jitter=args.llm_jitter).start()
+    workdir = tempfile.mkdtemp(prefix="appres-bench-")
+    original_cwd = os.getcwd()
+    recorder = StageRecorder()
+    app = None
+    try:
+        app = _prepare_environment(site, llm, workdir)
+        browser = app.get_browser()
+        stages = set(args.stages)
+
+        if "browser" in stages:
+            try:
+                with recorder.stage("browser_warmup") as lat:
+                    timed(lat, browser.run, BENCH_EMAIL, app._check_cookie_in_context)
+            except Exception as e:
+                # Chromium（Playwright）がない環境でも、ブラウザを使わないステージは測る
+                print(f"Chromium を起動できないため、ブラウザのステージを飛ばします: {type(e).__name__}: {e}", flush=True)
+                stages.discard("browser")
+
+        for rows in args.rows if "browser" in stages else ():
+            site.row_count = rows
+            with recorder.stage(f"fetch[rows={rows}]", items_per_op=rows) as lat:
+                for _ in range(args.iterations):
+                    messages = timed(lat, browser.run, BENCH_EMAIL, app._fetch_messages_in_context)
+                    if len(messages) != rows:
+                        raise RuntimeError(f"fetch: {rows}件のはずが {len(messages)}件でした")
+
+        # ブラウザを使わないHTTPだけの取得
+        for rows in args.rows if "http" in stages else ():
+            site.row_count = rows
+            with recorder.stage(f"fetch_http[rows={rows}]", items_per_op=rows) as lat:
+                for _ in range(args.iterations):
+                    messages = timed(lat, app.get_latest_messages_http, BENCH_EMAIL)
+                    if len(messages) != rows:
+                        raise RuntimeError(f"fetch_http: {rows}件のはずが {len(messages)}件でした")
+
+        # ページ送りのある一覧で、最初のメッセージが届くまでの時間（受信箱の大きさに依存しないはず）
+        site.page_size = args.page_size
+        for rows in args.rows if "http" in stages else ():
+            site.row_count = rows
+            with recorder.stage(f"first_message[rows={rows}]") as lat:
+                for _ in range(args.iterations):
+                    started = time.perf_counter()
+                    stream = app.stream_messages(BENCH_EMAIL)
+                    next(stream)
+                    lat.append(time.perf_counter() - started)
+                    for _ in stream:  # 残りを読み切ってブラウザを空ける
+                        pass
+        site.page_size = 0
+
+        if "generate" in stages:
+            _run_generate_stages(app, site, llm, recorder, args)
+        if "send" in stages:
+            with recorder.stage("send_reply") as lat:
+                for i in range(args.send_count):
+                    ok, detail = timed(lat, app.send_reply, BENCH_EMAIL, f"/my/mail_box/history/?id={i}", f"ベンチマーク送信 {i} {time.time()}")
+                    if not ok:
+                        raise RuntimeError(f"send_reply が失敗しました: {detail}")
+        if "browser" in stages:
+            _run_browser_send_stages(app, browser, recorder, args)
+    finally:
+        try:
+            if app is not None:
+                app.get_browser().shutdown()
+        finally:
+            site.stop()
+            llm.stop()
+            os.chdir(original_cwd)
+
+    return {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "stages": sorted(stages),
+            "llm_latency_s": args.llm_latency,
+            "llm_requests": llm.requests,
+        },
+        "stages": recorder.stages,
+    }
+
+
+def _run_generate_stages(app, site, llm, recorder, args):
+    site.row_count = args.generate_count
+    messages = app.get_latest_messages_http(BENCH_EMAIL)
+    with recorder.stage("generate_reply") as lat:
+        for message in messages:
+            timed(lat, app.generate_reply, message, BENCH_PERSONA)
+
+    # batch=1 は1件ずつ（既定）、もう一方は --batch-size ごとにまとめて生成する
+    with recorder.stage(f"generate_replies[n={len(messages)},batch=1]", items_per_op=len(messages)) as lat:
+        for _ in range(args.iterations):
+            timed(lat, app.generate_replies, messages, BENCH_PERSONA, batch_size=1)
+    before = llm.requests
+    with recorder.stage(f"generate_replies[n={len(messages)}]", items_per_op=len(messages)) as lat:
+        for _ in range(args.iterations):
+            timed(lat, app.generate_replies, messages, BENCH_PERSONA, batch_size=args.batch_size)
+    recorder.stages[f"generate_replies[n={len(messages)}]"]["llm_requests_per_op"] = (llm.requests - before) / args.iterations
+
+    # 再作成（ストリーミング）: 最初のトークンまでと完成までを別々に測る
+    ttft = []
+    with recorder.stage("regenerate_stream") as lat:
+        for message in messages[:args.iterations]:
+            started = time.perf_counter()
+            first = []
+            on_token = lambda text: first or first.append(time.perf_counter() - started)
+            timed(lat, app.regenerate_reply, message, BENCH_PERSONA, on_token=on_token)
+            ttft.extend(first)
+    recorder.stages["regenerate_stream"]["ttft_p50_ms"] = round(percentile(ttft, 0.5) * 1000, 2) if ttft else None
+    recorder.stages["regenerate_stream"]["ttft_p95_ms"] = round(percentile(ttft, 0.95) * 1000, 2) if ttft else None
+
+
+def _run_browser_send_stages(app, browser, recorder, args):
+    with recorder.stage("send_reply_browser") as lat:
+        for i in range(args.send_count):
+            ok, detail = timed(lat, browser.run, BENCH_EMAIL, app._send_reply_in_context, f"/my/mail_box/history/?id=b{i}", f"ベンチマーク送信 {i} {time.time()}", retry=False)
+            if not ok:
+                raise RuntimeError(f"send_reply（ブラウザ）が失敗しました: {detail}")
+
+    # 送信キュー: 1つの context のままブラウザで send_count 件を続けて送る（1操作 = 全件）
+    with recorder.stage("send_queue_browser", items_per_op=args.send_count) as lat:
+        for n in range(args.iterations):
+            results = []
+            drain = lambda send: results.extend(
+                send(f"/my/mail_box/history/?id=q{n}-{i}", f"ベンチマーク一括送信 {i} {time.time()}") for i in range(args.send_count)
+            )
+            timed(lat, browser.run, BENCH_EMAIL, app._drain_send_queue_in_context, drain, retry=False)
+            failed = [detail for ok, detail in results if not ok]
+            if failed:
+                raise RuntimeError(f"送信キュー（ブラウザ）が失敗しました: {failed[0]}")
+
+
+def compare(current, baseline):
+    """2回分の結果を段階ごとに比較して表示する（マイナスが改善）"""
+    print(f"\n{'stage':<28} {'p50 old':>10} {'p50 new':>10} {'Δ%':>8} {'p95 old':>10} {'p95 new':>10} {'Δ%':>8}")
+    for name, new in current["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if not old:
+            print(f"{name:<28} {'(new)':>10}")
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms"):
+            before, after = old.get(key), new.get(key)
+            delta = (after - before) / before * 100 if before and after is not None else None
+            cells += [f"{before:>10}", f"{after:>10}", f"{delta:>+7.1f}%" if delta is not None else f"{'-':>8}"]
+        print(f"{name:<28} " + " ".join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10,100,1000,5000", help="一覧の行数（カンマ区切り）")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--stages", default=",".join(STAGE_GROUPS), help=f"実行するステージ（カンマ区切り: {','.join(STAGE_GROUPS)}）")
+    parser.add_argument("--page-size", type=int, default=50, help="first_message で使う一覧1ページの行数")
+    parser.add_argument("--generate-count", type=int, default=20, help="生成ベンチで使うメッセージ数")
+    parser.add_argument("--send-count", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8, help="まとめて生成する比較用ステージの OPENAI_BATCH_SIZE")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="偽OpenAIの応答遅延（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="比較対象の過去の結果JSON")
+    args = parser.parse_args(argv)
+    args.rows = [int(r) for r in args.rows.split(",") if r.strip()]
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(args.stages) - set(STAGE_GROUPS)
+    if unknown:
+        parser.error(f"不明なステージ: {', '.join(sorted(unknown))}（{', '.join(STAGE_GROUPS)} から選ぶ）")
+
+    result = run(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {args.output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
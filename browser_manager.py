@@ -0,0 +1,248 @@
+import atexit
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # Streamlit外（スクリプト・ベンチマーク）から使う場合
+    add_script_run_ctx = None
+    get_script_run_ctx = None
+
+
+class StorageStateNotFound(Exception):
+    """storage_state が読み込めず context を作れなかった"""
+
+
+_STOP = object()
+
+# Playwright は最初のブラウザ操作のときにブラウザスレッドで読み込む
+# （HTTPだけで済む間は画面の起動を待たせない）
+sync_playwright = None
+PlaywrightError = None
+
+
+def _load_playwright():
+    global sync_playwright, PlaywrightError
+    if sync_playwright is None:
+        from playwright.sync_api import sync_playwright as _sync_playwright, Error as _PlaywrightError
+        PlaywrightError = _PlaywrightError
+        sync_playwright = _sync_playwright
+
+
+class _BrowserWorker:
+    """1本のブラウザスレッド（Playwrightドライバーと Chromium を1つずつ持つ）"""
+
+    def __init__(self, manager, index):
+        self._manager = manager
+        self.index = index
+        self._playwright = None
+        self._browser = None
+        self.launch_count = 0
+        self.busy = False
+        self.thread = threading.Thread(target=self._loop, name=f"browser-manager-{index}", daemon=True)
+
+    def _loop(self):
+        tasks = self._manager._tasks
+        try:
+            while True:
+                item = tasks.get()
+                if item is _STOP:
+                    break
+                future, ctx, log_ctx, email, func, args, kwargs, retry = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if add_script_run_ctx:
+                    add_script_run_ctx(threading.current_thread(), ctx)
+                self.busy = True
+                try:
+                    future.set_result(log_ctx.run(self._run_task, email, func, args, kwargs, retry))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    self.busy = False
+                    if add_script_run_ctx:
+                        add_script_run_ctx(threading.current_thread(), None)
+        finally:
+            self._teardown()
+
+    def _run_task(self, email, func, args, kwargs, retry):
+        _load_playwright()
+        try:
+            return self._run_in_context(email, func, args, kwargs)
+        except PlaywrightError:
+            if self._browser is not None and self._browser.is_connected():
+                raise
+            if not retry:
+                # 送信などやり直すと二重になりうるタスクは、次のタスクのために再起動だけしておく
+                logger.warning("ブラウザが切断されていました（このタスクは再実行しません）")
+                self._teardown()
+                raise
+            # ブラウザが落ちていた場合は再起動して1回だけやり直す
+            logger.warning("ブラウザが切断されていたため再起動して再実行します")
+            self._teardown()
+            return self._run_in_context(email, func, args, kwargs)
+
+    def _run_in_context(self, email, func, args, kwargs):
+        browser = self._get_browser()
+        context = self._manager._context_factory(browser, email)
+        if context is None:
+            raise StorageStateNotFound(email)
+        try:
+            return func(context, *args, **kwargs)
+        finally:
+            try:
+                context.close()
+            except PlaywrightError:
+                pass
+
+    def _get_browser(self):
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
+        if self._browser is not None:
+            logger.warning("ブラウザの切断を検知しました。再起動します")
+            self._teardown()
+        if self._playwright is None:
+            self._playwright = sync_playwright().start()
+        self._browser = self._playwright.chromium.launch(headless=self._manager._headless, args=self._manager._launch_args)
+        self.launch_count += 1
+        logger.info("Chromiumを起動しました（ワーカー%d・%d回目）", self.index, self.launch_count)
+        return self._browser
+
+    def _teardown(self):
+        if self._browser is not None:
+            try:
+                self._browser.close()
+            except Exception:
+                pass
+            self._browser = None
+        if self._playwright is not None:
+            try:
+                self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+
+
+class BrowserManager:
+    """Chromiumを起動したまま使い回すマネージャー
+
+    Playwrightの同期APIは起動したスレッドからしか操作できないため、
+    ブラウザ操作はすべて専用スレッドのキューに投げて実行する。
+    タスクごとに storage_state から新しい BrowserContext を作り、終わったら閉じる。
+    workers を2以上にすると、その数だけブラウザスレッドが同じキューを処理し、
+    別アカウントの操作を並行して実行できる（同時実行数の上限も workers になる）。
+    """
+
+    def __init__(self, context_factory, headless=True, launch_args=None, workers=1):
+        # context_factory(browser, email) -> BrowserContext | None
+        self._context_factory = context_factory
+        self._headless = headless
+        self._launch_args = launch_args or []
+        self._tasks = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._worker_seq = 0
+        self.max_workers = max(1, workers)
+
+    # --- 呼び出し側（任意のスレッド） ---
+
+    def submit(self, email, func, *args, retry=True, **kwargs):
+        """func(context, *args, **kwargs) をブラウザスレッドで実行し Future を返す
+
+        ブラウザが落ちていたときは再起動して1回だけやり直す。やり直すと困るタスク
+        （返信の送信など）は retry=False を渡す。
+        """
+        future = Future()
+        ctx = get_script_run_ctx() if get_script_run_ctx else None
+        # ログの構造化フィールド・デバッグパネル設定をブラウザスレッドに引き継ぐ
+        log_ctx = contextvars.copy_context()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BrowserManager は既に終了しています")
+            self._ensure_workers()
+            self._tasks.put((future, ctx, log_ctx, email, func, args, kwargs, retry))
+        return future
+
+    def run(self, email, func, *args, timeout=None, retry=True, **kwargs):
+        """submit して結果を待つ"""
+        return self.submit(email, func, *args, retry=retry, **kwargs).result(timeout=timeout)
+
+    def resize(self, workers):
+        """ブラウザスレッド数の上限を引き上げる"""
+        with self._lock:
+            self.max_workers = max(self.max_workers, workers)
+
+    def shutdown(self, timeout=10):
+        """ブラウザとPlaywrightを閉じてスレッドを止める"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = [w for w in self._workers if w.thread.is_alive()]
+            for _ in workers:
+                self._tasks.put(_STOP)
+        for worker in workers:
+            worker.thread.join(timeout)
+            if worker.thread.is_alive():
+                logger.warning("ブラウザスレッド%dが時間内に終了しませんでした", worker.index)
+        # 終了後に残ったタスクはキャンセル扱いにする
+        while True:
+            try:
+                item = self._tasks.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                item[0].cancel()
+
+    @property
+    def is_running(self):
+        return any(w.thread.is_alive() for w in self._workers)
+
+    @property
+    def launch_count(self):
+        return sum(w.launch_count for w in self._workers)
+
+    def stats(self):
+        """ブラウザスレッドの稼働状況"""
+        alive = [w for w in self._workers if w.thread.is_alive()]
+        return {
+            "workers": len(alive),
+            "max_workers": self.max_workers,
+            "busy": sum(1 for w in alive if w.busy),
+            "queued": self._tasks.qsize(),
+            "launches": self.launch_count,
+        }
+
+    def _ensure_workers(self):
+        self._workers = [w for w in self._workers if w.thread.is_alive()]
+        idle = sum(1 for w in self._workers if not w.busy)
+        waiting = self._tasks.qsize() + 1
+        # 待ちタスクが空きスレッドより多く、上限に達していなければ1本増やす
+        if not self._workers or (waiting > idle and len(self._workers) < self.max_workers):
+            self._worker_seq += 1
+            worker = _BrowserWorker(self, self._worker_seq)
+            self._workers.append(worker)
+            worker.thread.start()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_browser_manager(context_factory, **kwargs):
+    """プロセス全体で共有する BrowserManager を返す（初回のみ生成）"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = BrowserManager(context_factory, **kwargs)
+            atexit.register(_manager.shutdown)
+        else:
+            # Streamlitの再実行で load_cookies が作り直されても最新のものを使う
+            _manager._context_factory = context_factory
+        return _manager
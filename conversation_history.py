@@ -0,0 +1,181 @@
+"""スレッドごとの会話履歴のキャッシュ
+
+/my/mail_box/history/?id= のページから読み取ったやり取りを cache/history/<email>.json に
+保存しておき、返信生成のプロンプトに直近の数往復だけを入れる。
+履歴ページを読むのはスレッドの最新メッセージが変わったときだけで、
+前回保存した最後の発言より後の分だけを追記する。
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+
+from sync_state import fingerprint, merge_entries, path_lock, thread_id, write_json_atomic
+from yyc_http import LINE_BREAK, inner_text
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = os.getenv("CONVERSATION_HISTORY_DIR", os.path.join("cache", "history"))
+# 1スレッドに保存する発言数・プロンプトに入れる発言数・同時に読む履歴ページ数
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "50"))
+HISTORY_PROMPT_TURNS = int(os.getenv("HISTORY_PROMPT_TURNS", "6"))
+HISTORY_FETCH_CONCURRENCY = int(os.getenv("HISTORY_FETCH_CONCURRENCY", "4"))
+THREAD_RETENTION_SECONDS = 30 * 24 * 3600
+
+# 自分の発言を表すクラス名（このどれかが .message に付いていれば自分側）
+MINE_CLASSES = {"mine", "me", "self", "sent", "right", "send"}
+
+
+class HistoryPageParser(HTMLParser):
+    """履歴ページの .message 内の <p> を発言として古い順に取り出す（空白は一覧と同じく innerText に合わせる）"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.turns = []
+        self._stack = []  # (tag, classes)
+        self._text = None
+        self._text_depth = None
+        self._mine = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("br", "img", "input", "meta", "link", "hr"):
+            if tag == "br" and self._text is not None:
+                self._text.append(LINE_BREAK)
+            return
+        classes = set((dict(attrs).get("class") or "").split())
+        self._stack.append((tag, classes))
+        if tag == "p" and self._text is None:
+            messages = [c for _, c in self._stack if "message" in c]
+            if messages:
+                self._text = []
+                self._text_depth = len(self._stack)
+                self._mine = bool(messages[-1] & MINE_CLASSES)
+
+    def handle_endtag(self, tag):
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                break
+        else:
+            return
+        del self._stack[index:]
+        if self._text is not None and len(self._stack) < self._text_depth:
+            text = inner_text(self._text)
+            if text:
+                self.turns.append({"text": text, "mine": self._mine})
+            self._text = None
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+def parse_history_page(html):
+    parser = HistoryPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.turns
+
+
+def merge_turns(cached, fetched):
+    """保存済みの発言に、履歴ページ（fetched）のうち保存済みの分より後の発言だけを足す
+
+    ページの先頭と保存済みの末尾が最も長く重なるところでつなぐ。重なりがなければ
+    （間が空いた・ページの方が古い発言まで含む）ページの内容で置き換える。
+    """
+    if not cached:
+        return list(fetched)
+    for overlap in range(min(len(cached), len(fetched)), 0, -1):
+        if cached[-overlap:] == fetched[:overlap]:
+            return cached + fetched[overlap:]
+    return list(fetched)
+
+
+class ConversationHistory:
+    """アカウントごとの会話履歴（スレッドID -> 発言のリスト）"""
+
+    def __init__(self, email, history_dir=HISTORY_DIR):
+        self.email = email
+        self.path = os.path.join(history_dir, f"{email}.json")
+        os.makedirs(history_dir, exist_ok=True)
+        self.threads = self._read()
+        # このインスタンスで更新したスレッド（保存時にディスク上の最新の状態へ重ねる）
+        self._changed = {}
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("会話履歴の読み込みに失敗: %s (%s)", self.path, e)
+            return {}
+
+    def save(self):
+        """ファイルごとのロックの中で読み直し、更新したスレッドだけを重ねて書き込む"""
+        cutoff = time.time() - THREAD_RETENTION_SECONDS
+        with self._lock, path_lock(self.path):
+            threads = merge_entries(self._read(), self._changed)
+            self.threads = {tid: entry for tid, entry in threads.items() if entry.get("updated_at", 0) >= cutoff}
+            write_json_atomic(self.path, self.threads)
+            self._changed = {}
+
+    def needs_refresh(self, message):
+        """スレッドに新しい動きがあった（最新メッセージが前回と違う）か"""
+        if not message.get("reply_url"):
+            return False
+        entry = self.threads.get(thread_id(message))
+        return entry is None or entry.get("fingerprint") != fingerprint(message)
+
+    def update(self, message, fetched_turns):
+        with self._lock:
+            tid = thread_id(message)
+            entry = self.threads.get(tid, {})
+            turns = merge_turns(entry.get("turns", []), fetched_turns)[-HISTORY_MAX_TURNS:]
+            self.threads[tid] = self._changed[tid] = {
+                "turns": turns,
+                "fingerprint": fingerprint(message),
+                "updated_at": time.time(),
+            }
+
+    def refresh(self, messages, fetch_html, concurrency=None):
+        """新しい動きのあったスレッドだけ履歴ページを並行して読み、追記して保存する
+
+        fetch_html(reply_url) は履歴ページのHTMLを返す（読めなければ例外）。
+        """
+        targets = [m for m in messages if self.needs_refresh(m)]
+        if not targets:
+            return 0
+
+        def fetch(message):
+            return parse_history_page(fetch_html(message["reply_url"]))
+
+        workers = max(1, min(concurrency or HISTORY_FETCH_CONCURRENCY, len(targets)))
+        updated = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-fetch") as executor:
+            futures = [(m, executor.submit(contextvars.copy_context().run, fetch, m)) for m in targets]
+            for message, future in futures:
+                try:
+                    self.update(message, future.result())
+                    updated += 1
+                except Exception as e:
+                    logger.info("会話履歴を読めませんでした（%s）: %s", message.get("reply_url"), e)
+        if updated:
+            self.save()
+        return updated
+
+    def window(self, message, max_turns=None):
+        """プロンプトに入れる直近の発言（最新メッセージ自体は除く、古い順）"""
+        entry = self.threads.get(thread_id(message))
+        if not entry:
+            return []
+        turns = list(entry.get("turns", []))
+        # 履歴ページの最後は今回返信するメッセージそのものなので除く
+        if turns and not turns[-1]["mine"] and turns[-1]["text"].strip() == message.get("content", "").strip():
+            turns.pop()
+        return turns[-(max_turns or HISTORY_PROMPT_TURNS):]
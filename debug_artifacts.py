@@ -0,0 +1,139 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# off: 保存しない / on-error: 失敗時のみ / always: 毎回
+LEVEL_OFF = "off"
+LEVEL_ON_ERROR = "on-error"
+LEVEL_ALWAYS = "always"
+LEVELS = (LEVEL_OFF, LEVEL_ON_ERROR, LEVEL_ALWAYS)
+
+ARTIFACT_LEVEL = os.getenv("DEBUG_ARTIFACTS", LEVEL_ON_ERROR)
+ARTIFACT_DIR = os.getenv("DEBUG_ARTIFACT_DIR", "debug_artifacts")
+ARTIFACT_MAX_BYTES = int(os.getenv("DEBUG_ARTIFACT_MAX_BYTES", str(50 * 1024 * 1024)))
+QUEUE_SIZE = 64
+
+if ARTIFACT_LEVEL not in LEVELS:
+    logger.warning("DEBUG_ARTIFACTS=%s は不正な値です（%s）。on-error として扱います", ARTIFACT_LEVEL, "/".join(LEVELS))
+    ARTIFACT_LEVEL = LEVEL_ON_ERROR
+
+
+class ArtifactWriter:
+    """デバッグ用のHTML・スクリーンショットをバックグラウンドで圧縮保存する
+
+    <ARTIFACT_DIR>/<capture_id>/ 以下に保存し、合計サイズが max_bytes を超えたら
+    古い capture_id から順に削除する（リングバッファ）。キューが一杯なら捨てる。
+    """
+
+    def __init__(self, base_dir=ARTIFACT_DIR, max_bytes=ARTIFACT_MAX_BYTES, queue_size=QUEUE_SIZE):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def enqueue(self, capture_id, name, data, compress):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="artifact-writer", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((capture_id, name, data, compress))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("デバッグ保存キューが一杯のため %s/%s を破棄しました", capture_id, name)
+
+    def flush(self, timeout=None):
+        """キューに溜まった分の書き込みを待つ（テスト・終了処理用）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _worker(self):
+        while True:
+            capture_id, name, data, compress = self._queue.get()
+            try:
+                self._write(capture_id, name, data, compress)
+                self._enforce_limit()
+            except Exception as e:
+                logger.warning("デバッグ保存に失敗: %s/%s (%s)", capture_id, name, e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, capture_id, name, data, compress):
+        directory = os.path.join(self.base_dir, capture_id)
+        os.makedirs(directory, exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = os.path.join(directory, name + (".gz" if compress else ""))
+        if compress:
+            with gzip.open(path, "wb", compresslevel=6) as f:
+                f.write(data)
+        else:
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def _enforce_limit(self):
+        captures = []
+        total = 0
+        for entry in os.scandir(self.base_dir):
+            if not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            captures.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+        for _, size, path in sorted(captures):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+_writer = ArtifactWriter()
+
+
+class ArtifactCapture:
+    """1回の送信などに対応するデバッグ保存の単位
+
+    wants() で取得する価値があるかを先に確認し、ページからの取得（page.content() 等）自体を省く。
+    level が on-error の場合は error=True のものだけ保存する。
+    """
+
+    def __init__(self, operation, level=None, writer=None):
+        self.level = ARTIFACT_LEVEL if level is None else level
+        self.capture_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{operation}_{uuid.uuid4().hex[:8]}"
+        self._writer = writer or _writer
+
+    def wants(self, error=False):
+        if self.level == LEVEL_ALWAYS:
+            return True
+        return self.level == LEVEL_ON_ERROR and error
+
+    def add_html(self, name, html, error=False):
+        if self.wants(error):
+            self._writer.enqueue(self.capture_id, f"{name}.html", html, compress=True)
+
+    def add_json(self, name, data, error=False):
+        if self.wants(error):
+            self._writer.enqueue(self.capture_id, f"{name}.json", json.dumps(data, ensure_ascii=False), compress=True)
+
+    def add_screenshot(self, name, png, error=False):
+        # PNGは圧縮済みなのでそのまま保存する
+        if self.wants(error):
+            self._writer.enqueue(self.capture_id, f"{name}.png", png, compress=False)
+
+
+def start_capture(operation, level=None):
+    return ArtifactCapture(operation, level=level)
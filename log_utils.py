@@ -0,0 +1,118 @@
+import contextvars
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - [%(account)s|%(stage)s|%(message_id)s] %(message)s"
+
+# ログに自動で付与する構造化フィールド（スレッドをまたぐ場合は contextvars.copy_context() で引き継ぐ）
+_FIELDS = {
+    "account": contextvars.ContextVar("log_account", default="-"),
+    "stage": contextvars.ContextVar("log_stage", default="-"),
+    "message_id": contextvars.ContextVar("log_message_id", default="-"),
+}
+
+# アプリ内のデバッグパネルへ流すバッファ（オプトインしたセッションのみ設定される）
+_panel = contextvars.ContextVar("debug_panel", default=None)
+
+_setup_lock = threading.Lock()
+_configured = False
+
+
+class ContextFieldFilter(logging.Filter):
+    """contextvars の account / stage / message_id をログレコードに付与する"""
+
+    def filter(self, record):
+        for name, var in _FIELDS.items():
+            if not hasattr(record, name):
+                setattr(record, name, var.get())
+        return True
+
+
+def setup_logging():
+    """ロギングの初期設定（何度呼ばれても1回だけ行う）
+
+    LOG_LEVEL はここで読むので、.env を読み込んでから呼ぶ。
+    """
+    global _configured
+    with _setup_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(ContextFieldFilter())
+        root = logging.getLogger()
+        root.addHandler(handler)
+        # 本番は INFO。詳細ログが必要なときだけ LOG_LEVEL=DEBUG にする
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        _configured = True
+
+
+@contextmanager
+def log_context(**fields):
+    """with 内のログに account / stage / message_id を付ける"""
+    tokens = [(_FIELDS[name], _FIELDS[name].set(value)) for name, value in fields.items() if value is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextmanager
+def debug_panel(buffer):
+    """with 内の debug() 呼び出しを buffer（deque）にも書き出す"""
+    token = _panel.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _panel.reset(token)
+
+
+def new_panel_buffer(maxlen=500):
+    return deque(maxlen=maxlen)
+
+
+def panel_enabled():
+    return _panel.get() is not None
+
+
+def debug_enabled(logger):
+    """DEBUGログかデバッグパネルのどちらかが有効か（ログ専用の重い取得処理の前に確認する）"""
+    return logger.isEnabledFor(logging.DEBUG) or _panel.get() is not None
+
+
+def debug(logger, message, *args):
+    """遅延フォーマットのデバッグログ
+
+    ロガーが DEBUG 無効でデバッグパネルも無効なら、引数のフォーマットを一切行わない。
+    """
+    panel = _panel.get()
+    enabled = logger.isEnabledFor(logging.DEBUG)
+    if not enabled and panel is None:
+        return
+    if enabled:
+        logger.debug(message, *args)
+    if panel is not None:
+        panel.append("DEBUG: " + (message % args if args else message))
+
+
+class LogSampler:
+    """最初の first 件と、それ以降は every 件に1件だけ True を返す
+
+    every の既定値は LOG_SAMPLE_EVERY（要素ごとの解析ログなど件数の多いログは N 件に1件だけ出す）。
+    """
+
+    def __init__(self, every=None, first=3):
+        if every is None:
+            every = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "20")))
+        self.every = every
+        self.first = first
+        self._count = itertools.count()
+
+    def __call__(self):
+        n = next(self._count)
+        return n < self.first or n % self.every == 0
@@ -0,0 +1,141 @@
+"""返信生成プロンプトのテンプレートとトークン数の計算
+
+テンプレートは最初に1回だけ分解しておき、ペルソナ部分はペルソナが変わるまで
+描画済みの文字列を使い回す。トークン数は tiktoken があればそれで数え、
+なければ文字数からの見積もりを使う。
+"""
+import json
+import logging
+import string
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # 入っていなければ見積もりで数える
+    tiktoken = None
+
+PERSONA_FIELDS = ("name", "age", "occupation", "interests", "personality", "writing_style")
+TRIM_MARKER = "…（中略）…"
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def _encoding(model):
+    with _encodings_lock:
+        if model not in _encodings:
+            if tiktoken is None:
+                # 日本語は見積もりとのずれが大きいので、予算・使用量が概算になることを1回だけ知らせる
+                logger.warning("tiktoken が入っていないため、トークン数は文字数からの見積もりで数えます（requirements.txt を確認してください）")
+                _encodings[model] = None
+            else:
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except Exception as e:
+                    logger.warning("tiktoken のエンコーディングを取得できないため、トークン数は見積もりで数えます: %s", e)
+                    _encodings[model] = None
+        return _encodings[model]
+
+
+def estimate_tokens(text):
+    """トークン数のおおよその見積もり（日本語は1文字1トークン、英数字は4文字1トークン程度）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """テキストのトークン数（ローカルで数える）"""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def trim_to_tokens(text, max_tokens, model="gpt-3.5-turbo"):
+    """max_tokens に収まるよう、先頭と末尾を残して中ほどを省略する。(文章, 省略したか) を返す"""
+    if count_tokens(text, model) <= max_tokens:
+        return text, False
+    if max_tokens <= count_tokens(TRIM_MARKER, model):
+        return "", True
+    # 文字数を比例で縮めてから、収まるまで少しずつ削る（先頭7割・末尾3割を残す）
+    keep = max(1, int(len(text) * max_tokens / count_tokens(text, model)))
+    while keep > 0:
+        head = int(keep * 0.7)
+        trimmed = text[:head] + TRIM_MARKER + text[len(text) - (keep - head):]
+        if count_tokens(trimmed, model) <= max_tokens:
+            return trimmed, True
+        keep = int(keep * 0.9)
+    return TRIM_MARKER, True
+
+
+def persona_values(persona):
+    return {
+        "name": persona['name'],
+        "age": persona['age'],
+        "occupation": persona['occupation'],
+        "interests": ', '.join(persona['interests']),
+        "personality": persona['personality'],
+        "writing_style": persona['writing_style'],
+    }
+
+
+class PromptTemplate:
+    """str.format 形式のテンプレートを、ペルソナ部分を描画済みにしてキャッシュしながら使う
+
+    variable_fields 以外のフィールドはすべてペルソナの項目。ペルソナごとに
+    「固定部分の文字列と可変フィールドの並び」と固定部分のトークン数を覚えておく。
+    """
+
+    def __init__(self, template, variable_fields=("content",), model="gpt-3.5-turbo", cache_size=16):
+        self.template = template
+        self.variable_fields = tuple(variable_fields)
+        self.model = model
+        self.cache_size = cache_size
+        # (前の文字列, フィールド名) の並び。描画のたびに書式を解析し直さない
+        self._pieces = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+        unknown = {f for _, f in self._pieces if f and f not in self.variable_fields and f not in PERSONA_FIELDS}
+        if unknown:
+            raise ValueError(f"テンプレートに不明なフィールドがあります: {sorted(unknown)}")
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _compile(self, persona):
+        key = json.dumps(persona, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                return compiled
+        values = persona_values(persona)
+        segments, buffer = [], []
+        for literal, field in self._pieces:
+            buffer.append(literal)
+            if field is None:
+                continue
+            if field in self.variable_fields:
+                segments.append("".join(buffer))
+                segments.append((field,))
+                buffer = []
+            else:
+                buffer.append(str(values[field]))
+        segments.append("".join(buffer))
+        fixed_tokens = count_tokens("".join(s for s in segments if isinstance(s, str)), self.model)
+        compiled = (segments, fixed_tokens)
+        with self._lock:
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.cache_size:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def render(self, persona, **values):
+        segments, _ = self._compile(persona)
+        return "".join(s if isinstance(s, str) else str(values[s[0]]) for s in segments)
+
+    def fixed_tokens(self, persona):
+        """可変フィールド以外（指示文・ペルソナ）のトークン数"""
+        return self._compile(persona)[1]
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("REPLY_CACHE_DIR", os.path.join("cache", "replies"))
+MEMORY_ENTRIES = int(os.getenv("REPLY_CACHE_MEMORY_ENTRIES", "512"))
+DISK_MAX_BYTES = int(os.getenv("REPLY_CACHE_DISK_MAX_BYTES", str(20 * 1024 * 1024)))
+MAX_AGE_SECONDS = int(os.getenv("REPLY_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+
+def make_key(content, persona, template, model):
+    """メッセージ本文・ペルソナ・プロンプトテンプレート・モデル名からキャッシュキーを作る"""
+    payload = json.dumps(
+        {"content": content, "persona": persona, "template": template, "model": model},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReplyCache:
+    """生成済み返信のキャッシュ（メモリ上のLRU + ディスク）
+
+    ディスク側は1エントリ1ファイルで保存し、最終アクセス時刻（mtime）の古い順に
+    合計サイズが上限を超えた分を削除する。max_age を過ぎたエントリは読み込み時に破棄する。
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_entries=MEMORY_ENTRIES,
+                 disk_max_bytes=DISK_MAX_BYTES, max_age=MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.max_age = max_age
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_bytes = self._scan_disk()
+
+    def get(self, key):
+        """キャッシュされた返信文を返す（なければ None）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry["created"] <= self.max_age:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry["reply"]
+                del self._memory[key]
+            entry = self._read_disk(key, now)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.disk_hits += 1
+            return entry["reply"]
+
+    def put(self, key, reply):
+        """返信文を保存する（既存エントリは上書き）"""
+        entry = {"reply": reply, "created": time.time()}
+        with self._lock:
+            self._remember(key, entry)
+            self._write_disk(key, entry)
+            self.writes += 1
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "writes": self.writes,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    # --- 内部処理（ロック取得済みで呼ぶ） ---
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key, now):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("返信キャッシュの読み込みに失敗: %s (%s)", path, e)
+            self._remove(path)
+            return None
+        if now - entry.get("created", 0) > self.max_age:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # LRU 判定用に最終アクセス時刻を更新
+        except OSError:
+            pass
+        return entry
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._disk_bytes += os.path.getsize(path) - old_size
+        except OSError as e:
+            logger.warning("返信キャッシュの書き込みに失敗: %s (%s)", path, e)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._disk_bytes -= size
+        except OSError:
+            pass
+
+    def _list_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _scan_disk(self):
+        # 起動時に期限切れを掃除して合計サイズを求める
+        total = 0
+        cutoff = time.time() - self.max_age
+        for mtime, size, path in self._list_disk():
+            if mtime < cutoff:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            total += size
+        return total
+
+    def _evict_disk(self):
+        entries = sorted(self._list_disk())
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.max_age
+        # 上限の9割まで減らして、書き込みのたびに掃除が走らないようにする
+        target = self.disk_max_bytes * 0.9
+        for mtime, size, path in entries:
+            if total <= target and mtime >= cutoff:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+        logger.info("返信キャッシュを整理しました（%d bytes）", total)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_reply_cache():
+    """プロセス全体で共有する ReplyCache を返す"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ReplyCache()
+        return _cache
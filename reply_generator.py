@@ -0,0 +1,533 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+import openai
+
+from log_utils import log_context
+from prompt_template import PromptTemplate, count_tokens, trim_to_tokens
+from reply_cache import make_key
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "あなたは親しみやすい女性のペルソナで、マッチングアプリでの会話を担当します。"
+
+# 同時に投げるリクエスト数・リトライ回数・1リクエストのタイムアウト（秒）
+MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "4"))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "30"))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+# 1回のリクエストで返信を作るメッセージ数の上限（1でまとめない）と、1バッチの入出力トークンの上限。
+# まとめるとリクエスト数と重複する指示・ペルソナのトークンは減るが、バッチ内の返信は全件そろうまで
+# 届かず（1件ずつ表示できない）、応答も JSON モードになる。既定はまとめず、バックグラウンドで
+# 大量に生成するときだけ OPENAI_BATCH_SIZE で有効にする（画面で順に表示する取得ではまとめない）
+BATCH_SIZE = int(os.getenv("OPENAI_BATCH_SIZE", "1"))
+BATCH_TOKEN_BUDGET = int(os.getenv("OPENAI_BATCH_TOKEN_BUDGET", "3500"))
+REPLY_MAX_TOKENS = 200
+# 1件分のプロンプト（システム・指示・ペルソナ・本文）の入力トークンの上限。本文が長ければ中ほどを省略する
+INPUT_TOKEN_BUDGET = int(os.getenv("OPENAI_INPUT_TOKEN_BUDGET", "1500"))
+# プロンプトに入れる会話履歴のトークンの上限（古い発言から落とす）
+HISTORY_TOKEN_BUDGET = int(os.getenv("OPENAI_HISTORY_TOKEN_BUDGET", "600"))
+
+# ストリーミング生成の計測値（最初のトークンまでの時間など）と、呼び出しごとのトークン数を直近の分だけ残す
+_stream_metrics = deque(maxlen=50)
+_stream_metrics_lock = threading.Lock()
+_usage_metrics = deque(maxlen=200)
+_usage_totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+# 時間をおけば成功する可能性があるエラー（429・タイムアウト・一時的な接続断）
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+@dataclass
+class ReplyResult:
+    reply: str = ""
+    error: str = None
+    cached: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+PROMPT_TEMPLATE = """
+        以下のメッセージに対する返信を、以下のペルソナに基づいて生成してください。
+
+        ペルソナ:
+        - 名前: {name}
+        - 年齢: {age}歳
+        - 職業: {occupation}
+        - 趣味: {interests}
+        - 性格: {personality}
+        - 文章スタイル: {writing_style}
+
+        メッセージ:
+        {content}
+
+        返信の条件:
+        1. 自然で親しみやすい文章
+        2. 相手のメッセージの内容に適切に反応
+        3. 会話を発展させる要素を含める
+        4. 短すぎず長すぎない適度な長さ
+        5. 絵文字を適度に使用
+
+        返信文のみを出力してください。
+        """
+
+
+# 会話履歴があるときのプロンプト（履歴がなければ PROMPT_TEMPLATE をそのまま使う）
+HISTORY_PROMPT_TEMPLATE = """
+        以下のメッセージに対する返信を、以下のペルソナとこれまでのやり取りに基づいて生成してください。
+
+        ペルソナ:
+        - 名前: {name}
+        - 年齢: {age}歳
+        - 職業: {occupation}
+        - 趣味: {interests}
+        - 性格: {personality}
+        - 文章スタイル: {writing_style}
+
+        これまでのやり取り（古い順。「自分」はペルソナ側の発言）:
+        {history}
+
+        メッセージ:
+        {content}
+
+        返信の条件:
+        1. 自然で親しみやすい文章
+        2. 相手のメッセージの内容に適切に反応
+        3. 会話を発展させる要素を含める
+        4. 短すぎず長すぎない適度な長さ
+        5. 絵文字を適度に使用
+        6. これまでのやり取りと矛盾しない
+
+        返信文のみを出力してください。
+        """
+
+
+BATCH_PROMPT_TEMPLATE = """
+        以下の複数のメッセージそれぞれに対する返信を、以下のペルソナに基づいて生成してください。
+
+        ペルソナ:
+        - 名前: {name}
+        - 年齢: {age}歳
+        - 職業: {occupation}
+        - 趣味: {interests}
+        - 性格: {personality}
+        - 文章スタイル: {writing_style}
+
+        メッセージ（JSON。id ごとに別の相手からのメッセージです。history があれば、それまでのやり取りです）:
+        {messages}
+
+        返信の条件:
+        1. 自然で親しみやすい文章
+        2. 相手のメッセージの内容に適切に反応
+        3. 会話を発展させる要素を含める
+        4. 短すぎず長すぎない適度な長さ
+        5. 絵文字を適度に使用
+
+        次の形式のJSONだけを出力してください。すべての id に1つずつ返信を入れてください。
+        {{"replies": [{{"id": "<メッセージのid>", "reply": "<返信文>"}}]}}
+        """
+
+
+REPLY_PROMPT = PromptTemplate(PROMPT_TEMPLATE, ("content",), MODEL)
+HISTORY_PROMPT = PromptTemplate(HISTORY_PROMPT_TEMPLATE, ("history", "content"), MODEL)
+BATCH_PROMPT = PromptTemplate(BATCH_PROMPT_TEMPLATE, ("messages",), MODEL)
+
+
+def format_history(turns):
+    """会話履歴を「相手: ...」「自分: ...」の行にする。HISTORY_TOKEN_BUDGET を超える分は古い方から落とす"""
+    lines = [f"{'自分' if turn.get('mine') else '相手'}: {turn['text']}" for turn in turns or []]
+    while lines and count_tokens("\n".join(lines), MODEL) > HISTORY_TOKEN_BUDGET:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def fit_content(message, persona):
+    """本文を、1件分のプロンプトが INPUT_TOKEN_BUDGET に収まる長さにする"""
+    template = HISTORY_PROMPT if message.get("history") else REPLY_PROMPT
+    budget = INPUT_TOKEN_BUDGET - count_tokens(SYSTEM_PROMPT, MODEL) - template.fixed_tokens(persona)
+    if message.get("history"):
+        budget -= count_tokens(format_history(message["history"]), MODEL)
+    content, trimmed = trim_to_tokens(message['content'], budget, MODEL)
+    if trimmed:
+        logger.info("本文が長いため %dトークンに収まるよう省略しました（%s）", budget, message.get("reply_url"))
+    return content
+
+
+def build_prompt(message, persona):
+    """ペルソナとメッセージ（history があれば直近の会話履歴も）から返信生成用のプロンプトを作成"""
+    if message.get("history"):
+        return HISTORY_PROMPT.render(persona, history=format_history(message["history"]), content=fit_content(message, persona))
+    return REPLY_PROMPT.render(persona, content=fit_content(message, persona))
+
+
+def cache_key(message, persona):
+    """返信キャッシュのキー（本文・ペルソナ・プロンプト・モデル・会話履歴が同じなら同じ返信を使う）"""
+    if message.get("history"):
+        template = SYSTEM_PROMPT + HISTORY_PROMPT_TEMPLATE + format_history(message["history"])
+        return make_key(message['content'], persona, template, MODEL)
+    return make_key(message['content'], persona, SYSTEM_PROMPT + PROMPT_TEMPLATE, MODEL)
+
+
+def _create_completion(prompt, **kwargs):
+    return openai.ChatCompletion.create(
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=REPLY_MAX_TOKENS,
+        request_timeout=REQUEST_TIMEOUT,
+        **kwargs
+    )
+
+
+def build_batch_prompt(messages, persona):
+    """複数メッセージをまとめて1回で返信を作るプロンプト（id はリスト内の位置）"""
+    items = []
+    for i, message in enumerate(messages):
+        item = {"id": str(i), "content": fit_content(message, persona)}
+        if message.get("history"):
+            item["history"] = format_history(message["history"]).split("\n")
+        items.append(item)
+    return BATCH_PROMPT.render(persona, messages=json.dumps(items, ensure_ascii=False))
+
+
+def plan_batches(messages, persona, batch_size=None, token_budget=None):
+    """メッセージのインデックスを、件数とトークンの上限に収まるバッチに分ける"""
+    batch_size = max(1, batch_size or BATCH_SIZE)
+    token_budget = token_budget or BATCH_TOKEN_BUDGET
+    base = count_tokens(SYSTEM_PROMPT, MODEL) + BATCH_PROMPT.fixed_tokens(persona)
+    batches, current, used = [], [], base
+    for i, message in enumerate(messages):
+        # 入力（本文＋JSONの枠）と出力（返信1件分）
+        cost = count_tokens(fit_content(message, persona), MODEL) + 10 + REPLY_MAX_TOKENS
+        if message.get("history"):
+            cost += count_tokens(format_history(message["history"]), MODEL)
+        if current and (len(current) >= batch_size or used + cost > token_budget):
+            batches.append(current)
+            current, used = [], base
+        current.append(i)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_batch_replies(text, count):
+    """バッチ生成の出力（JSON）から id -> 返信文 を取り出す。形式が崩れた項目は含めない"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("{"):] if "{" in text else text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            return {}
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            return {}
+    entries = data.get("replies", []) if isinstance(data, dict) else data
+    if isinstance(entries, dict):
+        entries = [{"id": k, "reply": v} for k, v in entries.items()]
+    replies = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        reply = entry.get("reply")
+        try:
+            index = int(str(entry.get("id")).strip())
+        except ValueError:
+            continue
+        if 0 <= index < count and isinstance(reply, str) and reply.strip():
+            replies.setdefault(index, reply.strip())
+    return replies
+
+
+def request_batch_replies(messages, persona):
+    """複数メッセージの返信を1回のAPI呼び出しで作る。{位置: 返信文} を返す（欠けた分は含まない）"""
+    started = time.perf_counter()
+    prompt = build_batch_prompt(messages, persona)
+    response = openai.ChatCompletion.create(
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=REPLY_MAX_TOKENS * len(messages),
+        response_format={"type": "json_object"},
+        request_timeout=REQUEST_TIMEOUT
+    )
+    _record_response_usage("batch", started, response, prompt, messages=len(messages))
+    return parse_batch_replies(response.choices[0].message.content, len(messages))
+
+
+def _record_usage(kind, started, prompt_tokens, completion_tokens, estimated=False, messages=1):
+    entry = {
+        "at": time.strftime("%H:%M:%S"),
+        "kind": kind,
+        "messages": messages,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        "estimated": estimated,
+    }
+    logger.info("生成（%s）: prompt_tokens=%s completion_tokens=%s %.0fms%s", kind, prompt_tokens,
+                completion_tokens, entry["latency_ms"], "（ローカル計算）" if estimated else "")
+    with _stream_metrics_lock:
+        _usage_metrics.appendleft(entry)
+        _usage_totals["calls"] += 1
+        _usage_totals["prompt_tokens"] += prompt_tokens or 0
+        _usage_totals["completion_tokens"] += completion_tokens or 0
+
+
+def _record_response_usage(kind, started, response, prompt, messages=1):
+    usage = response.get("usage") or {}
+    if usage:
+        _record_usage(kind, started, usage.get("prompt_tokens"), usage.get("completion_tokens"), messages=messages)
+    else:
+        text = response.choices[0].message.content or ""
+        _record_usage(kind, started, count_tokens(SYSTEM_PROMPT + prompt, MODEL), count_tokens(text, MODEL), True, messages)
+
+
+def recent_usage():
+    """直近の呼び出しごとのトークン数と所要時間（新しい順）"""
+    with _stream_metrics_lock:
+        return list(_usage_metrics)
+
+
+def usage_totals():
+    """起動してからのトークン数の合計"""
+    with _stream_metrics_lock:
+        return dict(_usage_totals)
+
+
+def request_reply(message, persona):
+    """ChatGPT APIを1回呼び出して返信文を返す（失敗時は例外）"""
+    started = time.perf_counter()
+    prompt = build_prompt(message, persona)
+    response = _create_completion(prompt)
+    _record_response_usage("single", started, response, prompt)
+    return response.choices[0].message.content.strip()
+
+
+class StreamInterrupted(Exception):
+    """ストリーミングの途中で失敗した（partial にそこまでの文章が入る）"""
+
+    def __init__(self, partial, error):
+        super().__init__(f"ストリーミングが途中で失敗しました: {error}")
+        self.partial = partial
+        self.error = error
+
+
+def request_reply_stream(message, persona, on_token):
+    """ストリーミングで1回呼び出し、届いた分までの文章を on_token(text) に渡す
+
+    最初のトークンまでの時間（TTFT）と全体の時間を記録する。最初のトークンより前の失敗は
+    そのまま例外になり、途中で失敗した場合は StreamInterrupted になる。
+    """
+    prompt = build_prompt(message, persona)
+    started = time.perf_counter()
+    first_token_at = None
+    parts = []
+    try:
+        for chunk in _create_completion(prompt, stream=True):
+            delta = chunk["choices"][0].get("delta", {}).get("content")
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                logger.info("最初のトークンまで %.0fms", (first_token_at - started) * 1000)
+            parts.append(delta)
+            on_token("".join(parts))
+    except Exception as e:
+        if first_token_at is None:
+            raise
+        raise StreamInterrupted("".join(parts), e) from e
+    finally:
+        _record_stream_metric(started, first_token_at, len("".join(parts)))
+    # ストリーミングでは usage が返らないのでローカルで数える
+    text = "".join(parts)
+    _record_usage("stream", started, count_tokens(SYSTEM_PROMPT + prompt, MODEL),
+                  count_tokens(text, MODEL), estimated=True)
+    return text.strip()
+
+
+def _record_stream_metric(started, first_token_at, chars):
+    finished = time.perf_counter()
+    with _stream_metrics_lock:
+        _stream_metrics.appendleft({
+            "at": time.strftime("%H:%M:%S"),
+            "ttft_ms": round((first_token_at - started) * 1000, 1) if first_token_at is not None else None,
+            "total_ms": round((finished - started) * 1000, 1),
+            "chars": chars,
+        })
+
+
+def recent_stream_metrics():
+    """直近のストリーミング生成の計測値（新しい順）"""
+    with _stream_metrics_lock:
+        return list(_stream_metrics)
+
+
+def _retry_delay(error, attempt):
+    # Retry-After ヘッダーがあればそれに従う
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _call_with_backoff(call, max_retries=None):
+    """call() を実行し、429やタイムアウトの場合は指数バックオフで再試行する"""
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            delay = _retry_delay(e, attempt)
+            logger.warning("返信生成を%.1f秒後に再試行します（%d回目）: %s", delay, attempt + 1, e)
+            time.sleep(delay)
+            attempt += 1
+
+
+def request_reply_with_backoff(message, persona, max_retries=None, on_token=None):
+    """429やタイムアウトの場合は指数バックオフで再試行する
+
+    on_token を渡すとストリーミングで生成する。途中で失敗した場合はストリーミングせずに
+    生成し直して、完成した文章を返す。
+    """
+    streaming = [on_token is not None]
+
+    def call():
+        if not streaming[0]:
+            return request_reply(message, persona)
+        try:
+            return request_reply_stream(message, persona, on_token)
+        except StreamInterrupted as e:
+            logger.warning("%s。通常の生成でやり直します", e)
+            streaming[0] = False
+            return request_reply(message, persona)
+
+    return _call_with_backoff(call, max_retries)
+
+
+def _generate_one(message, persona, max_retries, cache):
+    try:
+        with log_context(stage="generate", message_id=message.get("reply_url")):
+            reply = request_reply_with_backoff(message, persona, max_retries)
+    except Exception as e:
+        logger.error("返信生成エラー（%s）: %s", message.get("sender"), e)
+        return ReplyResult(error=f"{type(e).__name__}: {e}")
+    if cache is not None:
+        cache.put(cache_key(message, persona), reply)
+    return ReplyResult(reply=reply)
+
+
+def _generate_single(messages, persona, max_retries, cache):
+    return [_generate_one(messages[0], persona, max_retries, cache)]
+
+
+def _generate_batch(messages, persona, max_retries, cache):
+    """まとめて1回で生成し、返ってこなかった・形式が崩れた分だけ1件ずつ生成し直す"""
+    try:
+        with log_context(stage="generate_batch"):
+            replies = _call_with_backoff(lambda: request_batch_replies(messages, persona), max_retries)
+    except Exception as e:
+        logger.warning("バッチ生成に失敗したため1件ずつ生成します: %s", e)
+        replies = {}
+    results = []
+    for i, message in enumerate(messages):
+        if i in replies:
+            if cache is not None:
+                cache.put(cache_key(message, persona), replies[i])
+            results.append(ReplyResult(reply=replies[i]))
+        else:
+            results.append(_generate_one(message, persona, max_retries, cache))
+    missing = len(messages) - len(replies)
+    if missing:
+        logger.info("バッチ生成で%d件中%d件が欠けていたため個別に生成しました", len(messages), missing)
+    return results
+
+
+def generate_replies(messages, persona, max_in_flight=None, max_retries=None, cache=None, on_result=None,
+                     batch_size=None):
+    """複数メッセージの返信を並列に生成する
+
+    同時リクエスト数は max_in_flight で制限し、結果はメッセージと同じ順序で返す。
+    失敗したメッセージは ReplyResult.error にエラー内容が入る。
+    cache を渡すとキャッシュ済みのメッセージはAPIを呼ばずに返す。
+    on_result(index, result) を渡すと、1件できるたびに呼び出し元のスレッドで呼ぶ。
+    batch_size（既定は OPENAI_BATCH_SIZE）が2以上なら、複数メッセージを1回のリクエストにまとめる。
+    """
+    if not messages:
+        return []
+    results = [None] * len(messages)
+    pending = []
+    for i, message in enumerate(messages):
+        cached = cache.get(cache_key(message, persona)) if cache is not None else None
+        if cached is not None:
+            results[i] = ReplyResult(reply=cached, cached=True)
+            if on_result is not None:
+                on_result(i, results[i])
+        else:
+            pending.append(i)
+    if pending:
+        max_in_flight = max(1, max_in_flight or MAX_IN_FLIGHT)
+        with ThreadPoolExecutor(max_workers=min(max_in_flight, len(pending)), thread_name_prefix="reply-gen") as executor:
+            # タスクごとに contextvars をコピーしてログのフィールドを引き継ぐ
+            batch_size = BATCH_SIZE if batch_size is None else batch_size
+            if batch_size > 1 and len(pending) > 1:
+                batches = [[pending[j] for j in batch] for batch in
+                           plan_batches([messages[i] for i in pending], persona, batch_size)]
+            else:
+                batches = [[i] for i in pending]
+            futures = {}
+            for batch in batches:
+                task = _generate_batch if len(batch) > 1 else _generate_single
+                future = executor.submit(contextvars.copy_context().run, task, [messages[i] for i in batch], persona, max_retries, cache)
+                futures[future] = batch
+            for future in as_completed(futures):
+                for i, result in zip(futures[future], future.result()):
+                    results[i] = result
+                    if on_result is not None:
+                        on_result(i, result)
+    return results
+
+
+def regenerate_reply(message, persona, cache=None, on_token=None):
+    """キャッシュを使わずに生成し直し、キャッシュを上書きする（on_token でストリーミング表示）"""
+    reply = request_reply_with_backoff(message, persona, on_token=on_token)
+    if cache is not None:
+        cache.put(cache_key(message, persona), reply)
+    return reply
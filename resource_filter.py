@@ -0,0 +1,147 @@
+import base64
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _env_list(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return list(default)
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# ブロックを有効にするか（0で無効）
+ENABLED = os.getenv("BLOCK_RESOURCES", "1") != "0"
+
+# DOMのテキストとフォームしか使わないので読み込まないリソースの種類
+BLOCKED_RESOURCE_TYPES = set(_env_list("BLOCK_RESOURCE_TYPES", ["image", "media", "font"]))
+
+# 広告・アクセス解析などのドメイン（部分一致）
+BLOCKED_DOMAINS = _env_list("BLOCK_DOMAINS", [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "googleadservices.com",
+    "doubleclick.net",
+    "adservice.google.",
+    "facebook.net",
+    "connect.facebook.com",
+    "amazon-adsystem.com",
+    "criteo.com",
+    "criteo.net",
+    "microad.jp",
+    "i-mobile.co.jp",
+    "adingo.jp",
+    "taboola.com",
+    "outbrain.com",
+    "clarity.ms",
+    "hotjar.com",
+])
+
+# ブロック対象でも通すURL（正規表現）。送信フォームが必要とするものはここに追加する
+ALLOWED_URL_PATTERNS = [re.compile(p) for p in _env_list("ALLOW_URL_PATTERNS", [
+    r"recaptcha",
+])]
+
+# ブロックしたリクエストの節約バイト数の見積もり（実際のサイズは取得しないと分からないため）
+ESTIMATED_BYTES = {
+    "image": 30 * 1024,
+    "media": 500 * 1024,
+    "font": 40 * 1024,
+    "script": 50 * 1024,
+    "stylesheet": 20 * 1024,
+    "xhr": 2 * 1024,
+    "fetch": 2 * 1024,
+}
+DEFAULT_ESTIMATED_BYTES = 5 * 1024
+
+# 画像は中断するとonerror等が走るので1x1の透明GIFで応答する
+_EMPTY_GIF = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+
+_totals = {"blocked_requests": 0, "allowed_requests": 0, "estimated_bytes_saved": 0}
+_totals_lock = threading.Lock()
+
+
+class ResourceFilter:
+    """BrowserContext の全リクエストを振り分け、不要なリソースを止める
+
+    ページ（メインフレームのURL）ごとに、止めたリクエスト数と節約できたバイト数の見積もりを記録する。
+    """
+
+    def __init__(self, blocked_types=None, blocked_domains=None, allowed_patterns=None):
+        self.blocked_types = BLOCKED_RESOURCE_TYPES if blocked_types is None else set(blocked_types)
+        self.blocked_domains = BLOCKED_DOMAINS if blocked_domains is None else list(blocked_domains)
+        self.allowed_patterns = ALLOWED_URL_PATTERNS if allowed_patterns is None else list(allowed_patterns)
+        self.page_stats = {}
+
+    def install(self, context):
+        context.route("**/*", self._handle)
+        context.on("close", lambda _: self._log_summary())
+        return self
+
+    def should_block(self, url, resource_type):
+        if any(p.search(url) for p in self.allowed_patterns):
+            return False
+        if resource_type in self.blocked_types:
+            return True
+        host = url.split("://", 1)[-1].split("/", 1)[0]
+        return any(domain in host for domain in self.blocked_domains)
+
+    def _handle(self, route, request):
+        blocked = self.should_block(request.url, request.resource_type)
+        self._count(request, blocked)
+        if not blocked:
+            route.continue_()
+        elif request.resource_type == "image":
+            route.fulfill(status=200, content_type="image/gif", body=_EMPTY_GIF)
+        elif request.resource_type == "script":
+            # 広告スクリプトは空のJSで応答してページ側のエラーを避ける
+            route.fulfill(status=200, content_type="application/javascript", body="")
+        else:
+            route.abort()
+
+    def _count(self, request, blocked):
+        try:
+            frame = request.frame
+            page_url = frame.page.main_frame.url if frame else ""
+        except Exception:
+            page_url = ""
+        if request.is_navigation_request() and not blocked:
+            page_url = request.url
+        stats = self.page_stats.setdefault(page_url, {"blocked_requests": 0, "allowed_requests": 0, "estimated_bytes_saved": 0})
+        if blocked:
+            saved = ESTIMATED_BYTES.get(request.resource_type, DEFAULT_ESTIMATED_BYTES)
+            stats["blocked_requests"] += 1
+            stats["estimated_bytes_saved"] += saved
+        else:
+            saved = 0
+            stats["allowed_requests"] += 1
+        with _totals_lock:
+            _totals["blocked_requests" if blocked else "allowed_requests"] += 1
+            _totals["estimated_bytes_saved"] += saved
+
+    def _log_summary(self):
+        for url, stats in self.page_stats.items():
+            if stats["blocked_requests"]:
+                logger.info(
+                    "リソースブロック %s: %d件ブロック / %d件許可（約%.0fKB節約）",
+                    url or "(不明)", stats["blocked_requests"], stats["allowed_requests"],
+                    stats["estimated_bytes_saved"] / 1024
+                )
+
+
+def install_resource_filter(context):
+    """context にリソースブロックを設定する（無効設定なら何もしない）"""
+    if not ENABLED:
+        return None
+    return ResourceFilter().install(context)
+
+
+def totals():
+    """プロセス全体の累計（ブロック数・許可数・節約バイト数の見積もり）"""
+    with _totals_lock:
+        return dict(_totals)
@@ -0,0 +1,273 @@
+"""アカウントごとの返信の一括送信キュー
+
+積まれた (reply_url, reply_text) を1本のスレッドで順番に送る。送信そのものは
+runner(email, drain) に任せ、runner は HTTP のセッションや1つのブラウザ
+context を開いたまま drain(send) を呼ぶので、件数分ログインし直すことはない。
+失敗したジョブは、履歴ページに同じ本文が載っていないことを確かめてから
+送り直す（確かめられなければ送り直さない）ので、二重送信にはならない。
+"""
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from conversation_history import parse_history_page
+from log_utils import log_context
+from yyc_http import HttpFallback, fetch_history_html
+
+logger = logging.getLogger(__name__)
+
+# 同じアカウントで送信と送信の間に空ける秒数・一時的な失敗を送り直す回数・その待ち時間の基準（秒）
+SEND_QUEUE_INTERVAL = float(os.getenv("SEND_QUEUE_INTERVAL_SECONDS", "10"))
+SEND_QUEUE_MAX_RETRIES = int(os.getenv("SEND_QUEUE_MAX_RETRIES", "2"))
+SEND_QUEUE_RETRY_DELAY = float(os.getenv("SEND_QUEUE_RETRY_DELAY_SECONDS", "15"))
+# 履歴ページで自分の発言を照合するときに見る直近の件数と本文の先頭文字数
+VERIFY_RECENT_TURNS = 5
+VERIFY_PREFIX_CHARS = 30
+
+QUEUED, SENDING, RETRYING, SENT, FAILED = "queued", "sending", "retrying", "sent", "failed"
+
+
+def job_key(reply_url, reply_text):
+    """同じスレッドに同じ本文を送るジョブを同一とみなすキー"""
+    return hashlib.sha1(f"{reply_url}\n{reply_text.strip()}".encode("utf-8")).hexdigest()
+
+
+class SendJob:
+    """送信キューの1件"""
+
+    def __init__(self, reply_url, reply_text, label=None):
+        self.key = job_key(reply_url, reply_text)
+        self.reply_url = reply_url
+        self.reply_text = reply_text
+        self.label = label or reply_url
+        self.status = QUEUED
+        self.attempts = 0
+        self.message = None
+        self.queued_at = time.time()
+        self.finished_at = None
+        self.not_before = 0.0
+
+    @property
+    def done(self):
+        return self.status in (SENT, FAILED)
+
+    def snapshot(self):
+        return {
+            "label": self.label,
+            "status": self.status,
+            "attempts": self.attempts,
+            "message": self.message,
+        }
+
+
+def already_sent(email, reply_url, reply_text):
+    """履歴ページの直近の発言に reply_text があるか（確かめられなければ None）
+
+    自分側かどうかのクラス名は推測なので、照合はどちら側の発言かを問わずに行う。
+    見つからなくても、自分の発言を1件も見分けられないページでは「送っていない」とは言えないので None。
+    """
+    try:
+        turns = parse_history_page(fetch_history_html(email, reply_url))
+    except HttpFallback as e:
+        logger.info("送信済みかどうかを確認できません（%s）: %s", reply_url, e)
+        return None
+    head = reply_text.strip()[:VERIFY_PREFIX_CHARS]
+    if any(head in turn["text"] for turn in turns[-VERIFY_RECENT_TURNS:]):
+        return True
+    if not any(turn["mine"] for turn in turns):
+        logger.info("履歴ページで自分の発言を見分けられないため、送信済みかどうかを確認できません: %s", reply_url)
+        return None
+    return False
+
+
+class SendQueue:
+    """1アカウント分の送信キュー
+
+    runner(email, drain) は送信の準備（セッション・ブラウザ context）をしてから
+    drain(send) を呼ぶ。send(reply_url, reply_text) は (成功したか, メッセージ) を返す。
+    send が HttpFallback を送出したジョブは送っていない扱いでキューに戻し、
+    runner が別の方法で drain をやり直せるようにする。
+    """
+
+    def __init__(self, email, runner, interval=SEND_QUEUE_INTERVAL, max_retries=SEND_QUEUE_MAX_RETRIES,
+                 retry_delay=SEND_QUEUE_RETRY_DELAY, verify=already_sent):
+        self.email = email
+        self._runner = runner
+        self.interval = interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._verify = verify
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_sent_at = 0.0
+        self._stop = threading.Event()
+
+    # --- 操作 ---
+
+    def configure(self, runner):
+        with self._lock:
+            self._runner = runner
+
+    def enqueue(self, items):
+        """(reply_url, reply_text[, label]) を積む。同じ内容が積まれている・送信済みなら積まない"""
+        added = 0
+        with self._lock:
+            known = {job.key for job in self._jobs if job.status != FAILED}
+            for item in items:
+                job = SendJob(*item)
+                if not job.reply_url or not job.reply_text.strip() or job.key in known:
+                    continue
+                known.add(job.key)
+                self._jobs.append(job)
+                added += 1
+            if added:
+                self._stop.clear()
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=contextvars.copy_context().run, args=(self._run,),
+                        name=f"send-queue-{self.email}", daemon=True
+                    )
+                    self._thread.start()
+        return added
+
+    def cancel(self):
+        """まだ送っていないジョブを取り消す（送信中の1件は最後まで送る）"""
+        self._stop.set()
+        with self._lock:
+            for job in self._jobs:
+                if job.status in (QUEUED, RETRYING):
+                    job.status = FAILED
+                    job.message = "取り消しました"
+                    job.finished_at = time.time()
+
+    def clear_finished(self):
+        with self._lock:
+            self._jobs = [job for job in self._jobs if not job.done]
+
+    @property
+    def active(self):
+        with self._lock:
+            return any(not job.done for job in self._jobs)
+
+    def status(self):
+        """件数の集計とジョブごとの状況"""
+        with self._lock:
+            jobs = [job.snapshot() for job in self._jobs]
+        counts = {state: sum(1 for job in jobs if job["status"] == state) for state in (QUEUED, SENDING, RETRYING, SENT, FAILED)}
+        return {"total": len(jobs), "done": counts[SENT] + counts[FAILED], **counts, "jobs": jobs}
+
+    # --- 送信スレッド ---
+
+    def _run(self):
+        with log_context(account=self.email, stage="send_queue"):
+            while True:
+                with self._lock:
+                    if self._stop.is_set() or all(job.done for job in self._jobs):
+                        # ここで抜ける前に積まれたジョブは、次の enqueue が新しいスレッドで送る
+                        self._thread = None
+                        return
+                    runner = self._runner
+                try:
+                    runner(self.email, self._drain)
+                except Exception as e:
+                    # 準備（storage_state・ブラウザ）に失敗したら残りはすべて失敗にする
+                    logger.warning("送信キューを処理できませんでした: %s", e)
+                    self._fail_pending(f"{type(e).__name__}: {e}")
+
+    def _fail_pending(self, message):
+        with self._lock:
+            for job in self._jobs:
+                if not job.done:
+                    job.status = FAILED
+                    job.message = message
+                    job.finished_at = time.time()
+
+    def _next_job(self):
+        """次に送るジョブ（再送待ちは時刻が来てから）。なければ None"""
+        while not self._stop.is_set():
+            with self._lock:
+                pending = [job for job in self._jobs if job.status in (QUEUED, RETRYING)]
+                if not pending:
+                    return None
+                now = time.time()
+                ready = [job for job in pending if job.not_before <= now]
+                if ready:
+                    job = ready[0]
+                    job.status = SENDING
+                    return job
+                wait = min(job.not_before for job in pending) - now
+            self._stop.wait(min(wait, 1.0))
+        return None
+
+    def _drain(self, send):
+        """キューが空になるまで、積まれた順に間隔を空けて send で送る"""
+        while True:
+            wait = self._last_sent_at + self.interval - time.time()
+            if wait > 0 and self._stop.wait(wait):
+                return
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._send_job(job, send)
+            except HttpFallback:
+                # POST する前に分かった失敗なので送っていない。別の方法でやり直してもらう
+                with self._lock:
+                    job.status = QUEUED
+                raise
+
+    def _send_job(self, job, send):
+        if job.attempts > 0:
+            # 前回の結果が分からないまま送り直さないよう、履歴ページで確かめる
+            sent = self._verify(self.email, job.reply_url, job.reply_text)
+            if sent is None:
+                self._finish(job, FAILED, "送信済みかどうか確認できないため送り直しませんでした。手動でご確認ください。")
+                return
+            if sent:
+                self._finish(job, SENT, "返信を送信しました（履歴ページで確認）")
+                return
+        job.attempts += 1
+        self._last_sent_at = time.time()
+        try:
+            with log_context(message_id=job.reply_url):
+                ok, message = send(job.reply_url, job.reply_text)
+        except HttpFallback:
+            job.attempts -= 1
+            raise
+        except Exception as e:
+            ok, message = False, f"{type(e).__name__}: {e}"
+        if ok:
+            self._finish(job, SENT, message)
+        elif job.attempts <= self.max_retries:
+            logger.info("送信に失敗したため再送します（%d回目）: %s", job.attempts, message)
+            with self._lock:
+                job.status = RETRYING
+                job.message = message
+                job.not_before = time.time() + self.retry_delay * job.attempts
+        else:
+            self._finish(job, FAILED, message)
+
+    def _finish(self, job, status, message):
+        with self._lock:
+            job.status = status
+            job.message = message
+            job.finished_at = time.time()
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_send_queue(email, runner=None, **kwargs):
+    """アカウントごとにプロセス全体で共有する SendQueue を返す（初回のみ生成）"""
+    with _queues_lock:
+        queue = _queues.get(email)
+        if queue is None:
+            queue = _queues[email] = SendQueue(email, runner, **kwargs)
+        elif runner is not None:
+            queue.configure(runner)
+        return queue
@@ -0,0 +1,107 @@
+"""アカウントごとの storage_state（Playwright形式のcookie JSON）の読み書き
+
+正規化（sameSite の補正）は保存時に1回だけ行い、読み込みはファイルの
+(mtime, size) をキーにしたメモリ上のキャッシュから返す。
+"""
+import json
+import logging
+import os
+import threading
+
+from sync_state import path_lock, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+COOKIES_DIR = "cookies"
+STORAGE_SUFFIX = "_storage.json"
+SAME_SITE_VALUES = ("Strict", "Lax", "None")
+
+
+def storage_file(email):
+    return os.path.join(COOKIES_DIR, f"{email}{STORAGE_SUFFIX}")
+
+
+def file_signature(path):
+    """ファイルの (mtime, size)。ファイルがなければ None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def normalize_storage_state(data):
+    """Playwrightが受け付けない sameSite の値を "None" に直す。変更があれば True を返す"""
+    changed = False
+    for cookie in data.get("cookies", []):
+        if cookie.get("sameSite") not in SAME_SITE_VALUES:
+            cookie["sameSite"] = "None"
+            changed = True
+    data.setdefault("cookies", [])
+    data.setdefault("origins", [])
+    return changed
+
+
+class StorageStateCache:
+    """読み込み・正規化済みの storage_state をファイルごとに保持する
+
+    返す dict は共有されるので、呼び出し側で変更しないこと。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        """storage_state を返す。ファイルがなければ None（読めないJSONは例外）"""
+        signature = file_signature(path)
+        if signature is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # 古いファイル（アップロード時に正規化されていないもの）はメモリ上でだけ直す
+        if normalize_storage_state(data):
+            logger.info("storage_state の sameSite を補正しました（メモリ上のみ）: %s", path)
+        with self._lock:
+            self._entries[path] = (signature, data)
+        return data
+
+    def save(self, path, data):
+        """正規化して原子的に書き込み、キャッシュも更新する
+
+        巡回・cookie保存・画面から同じアカウントに同時に書いても、ファイルごとのロックで1件ずつ書く。
+        """
+        normalize_storage_state(data)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with path_lock(path):
+            write_json_atomic(path, data, indent=2)
+            with self._lock:
+                self._entries[path] = (file_signature(path), data)
+        return data
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_storage_state_cache():
+    """プロセス全体で共有する StorageStateCache を返す"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StorageStateCache()
+        return _cache
+
+
+def load_storage_state(email):
+    """アカウントの storage_state を返す（キャッシュ済みならファイルを読まない）"""
+    return get_storage_state_cache().load(storage_file(email))
+
+
+def save_storage_state(email, data):
+    """アカウントの storage_state を正規化して保存する（アップロード・ブラウザからの保存）"""
+    return get_storage_state_cache().save(storage_file(email), data)
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SYNC_DIR = os.getenv("INBOX_SYNC_DIR", os.path.join("cache", "sync"))
+THREAD_RETENTION_SECONDS = 30 * 24 * 3600
+
+
+def sync_path(email, sync_dir=SYNC_DIR):
+    return os.path.join(sync_dir, f"{email}.json")
+
+
+def sync_mtime(email, sync_dir=SYNC_DIR):
+    """同期状態ファイルの更新時刻（ファイルがなければ None）。読み込み直す必要があるかの判定に使う"""
+    try:
+        return os.path.getmtime(sync_path(email, sync_dir))
+    except OSError:
+        return None
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def path_lock(path):
+    """ファイルごとにプロセス全体で共有するロック（読み込み→変更→保存をまとめて守る）"""
+    key = os.path.abspath(path)
+    with _path_locks_lock:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = _path_locks[key] = threading.RLock()
+        return lock
+
+
+def write_json_atomic(path, data, indent=None):
+    """同じディレクトリの一時ファイル（書き込みごとに別名）に書いてから置き換える"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def merge_entries(saved, changed):
+    """ディスク上のエントリに、このインスタンスで変えたエントリを重ねる（updated_at の新しい方を残す）"""
+    merged = dict(saved)
+    for key, entry in changed.items():
+        current = merged.get(key)
+        if current is None or current.get("updated_at", 0) <= entry.get("updated_at", 0):
+            merged[key] = entry
+    return merged
+
+
+def thread_id(message):
+    """スレッドを識別するキー（返信URLの /my/mail_box/history/?id= を使う）"""
+    if message.get("reply_url"):
+        return message["reply_url"]
+    # 返信URLが取れなかった行は送信者・日時・本文で代用する
+    return "nourl:" + fingerprint(message)
+
+
+def fingerprint(message):
+    """スレッドの最新メッセージが変わったかを判定するためのハッシュ"""
+    payload = json.dumps([message.get("sender"), message.get("time"), message.get("content")], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class InboxSyncState:
+    """アカウントごとの受信箱の同期状態（スレッドごとの最新メッセージと生成済み返信）
+
+    cache/sync/<email>.json に保存し、前回と同じスレッド・同じ内容のものは
+    返信を生成し直さずに使い回す。
+    """
+
+    def __init__(self, email, sync_dir=SYNC_DIR):
+        self.email = email
+        self.path = sync_path(email, sync_dir)
+        os.makedirs(sync_dir, exist_ok=True)
+        self.threads = {}
+        self.order = []
+        self.last_check = None
+        self._persona = None
+        # このインスタンスで変えたスレッドと項目（保存時にディスク上の最新の状態へ重ねる）
+        self._changed = {}
+        self._changed_fields = set()
+        self._apply(self._read())
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("同期状態の読み込みに失敗: %s (%s)", self.path, e)
+            return {}
+
+    def _apply(self, data):
+        self.threads = data.get("threads", {})
+        self.order = data.get("order", [])
+        self.last_check = data.get("last_check")
+        self._persona = data.get("persona")
+
+    @property
+    def persona(self):
+        return self._persona
+
+    @persona.setter
+    def persona(self, value):
+        self._persona = value
+        self._changed_fields.add("persona")
+
+    def save(self, prune=False):
+        """ディスク上の最新の状態に、このインスタンスで変えた分だけを重ねて書き込む
+
+        同じアカウントの同期状態は巡回・画面の取得・カードの再作成がそれぞれ別の
+        インスタンスで更新するので、ファイルごとのロックの中で読み直してから書く。
+        """
+        with path_lock(self.path):
+            data = self._read()
+            data["threads"] = merge_entries(data.get("threads", {}), self._changed)
+            if "order" in self._changed_fields:
+                data["order"] = self.order
+                data["last_check"] = self.last_check
+            if "persona" in self._changed_fields:
+                data["persona"] = self._persona
+            if prune:
+                # 一覧から消えて（返信済みになって）しばらく経ったスレッドは捨てる
+                current = set(data.get("order", []))
+                cutoff = time.time() - THREAD_RETENTION_SECONDS
+                data["threads"] = {
+                    tid: entry for tid, entry in data["threads"].items()
+                    if tid in current or entry.get("updated_at", 0) >= cutoff
+                }
+            write_json_atomic(self.path, data)
+            self._apply(data)
+            self._changed = {}
+            self._changed_fields = set()
+
+    def pending(self, messages, reply_key):
+        """返信を（再）生成する必要があるメッセージのインデックスを返す
+
+        新しいスレッド、最新メッセージが変わったスレッド、前回の生成に失敗したスレッド、
+        reply_key（ペルソナ・プロンプト等）が変わったスレッドが対象。
+        """
+        result = []
+        for i, message in enumerate(messages):
+            known = self.threads.get(thread_id(message))
+            if (known is None
+                    or known.get("fingerprint") != fingerprint(message)
+                    or known.get("reply_key") != reply_key(message)
+                    or known.get("error")
+                    or not known.get("reply")):
+                result.append(i)
+        return result
+
+    def reply_for(self, message):
+        known = self.threads.get(thread_id(message))
+        return known.get("reply", "") if known else ""
+
+    def record(self, message, reply, reply_key, error=None):
+        """スレッドの最新メッセージと返信を記録する"""
+        tid = thread_id(message)
+        self.threads[tid] = self._changed[tid] = {
+            "fingerprint": fingerprint(message),
+            "message": message,
+            "reply": reply,
+            "reply_key": reply_key,
+            "error": error,
+            "updated_at": time.time(),
+        }
+
+    def finish_sync(self, messages):
+        """今回の取得結果で一覧の順序と最終取得時刻を更新して保存する
+
+        一覧を最後まで読めたときだけ呼ぶ。失敗・途中までの取得では save() だけにして、
+        前回の順序と最終取得時刻を残す（空の一覧で古いスレッドを消さないように）。
+        """
+        self.order = [thread_id(m) for m in messages]
+        self.last_check = time.time()
+        self._changed_fields.add("order")
+        self.save(prune=True)
+
+    def snapshot(self):
+        """前回の取得結果（メッセージ・返信・エラー）を一覧の順で返す"""
+        entries = [self.threads[tid] for tid in self.order if tid in self.threads]
+        return (
+            [e["message"] for e in entries],
+            [e.get("reply", "") for e in entries],
+            [e.get("error") for e in entries],
+        )
@@ -0,0 +1,19 @@
+"""履歴ページの発言を保存済みの会話履歴につなぐ処理"""
+from conversation_history import merge_turns
+
+
+def turns(*texts):
+    return [{"text": text, "mine": False} for text in texts]
+
+
+def test_appends_only_turns_after_the_overlap():
+    assert merge_turns(turns("a", "b", "c"), turns("b", "c", "d")) == turns("a", "b", "c", "d")
+
+
+def test_uses_the_longest_overlap_for_repeated_turns():
+    assert merge_turns(turns("a", "b", "a"), turns("b", "a", "e")) == turns("a", "b", "a", "e")
+
+
+def test_replaces_the_cache_without_overlap():
+    assert merge_turns(turns("a", "b"), turns("x", "y")) == turns("x", "y")
+    assert merge_turns(turns("a", "b"), turns("z", "a", "b", "c")) == turns("z", "a", "b", "c")
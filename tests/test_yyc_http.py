@@ -0,0 +1,87 @@
+"""一覧ページのHTTPパーサーが、ブラウザ（MESSAGE_EXTRACT_JS の innerText）と同じ結果になるか"""
+import ast
+import os
+
+import pytest
+
+from conversation_history import parse_history_page
+from yyc_http import parse_inbox_page
+
+BASE_URL = "https://www.yyc.co.jp/my/mail_box/round_trip?filter=not_res"
+
+# ソースに改行・インデント・<br> を含む一覧ページ
+INBOX_HTML = """<!DOCTYPE html>
+<html><body>
+<div class="message_listWrap">
+  <div class="mdl_listBox_simple">
+    <a href="/my/mail_box/history/?id=1">
+      <div class="name"><strong>
+        はなこ
+      </strong></div>
+      <div class="message">
+        <p>こんにちは
+           元気ですか？<br>
+           よろしく</p>
+      </div>
+      <span class="date"> 02/29 12:00 </span>
+    </a>
+  </div>
+  <div class="mdl_listBox_simple">
+    <div class="thumb"><img src="/img/2.png"></div>
+    <div>
+      <strong>たろう</strong>
+      <p>週末は   カフェに<br><br>行きませんか</p>
+      <span class="date">12:34</span>
+      <a href="/my/mail_box/history/?id=2">返信</a>
+    </div>
+  </div>
+</div>
+<div class="pager"><a rel="next" href="/my/mail_box/round_trip?filter=not_res&amp;page=2">次へ</a></div>
+</body></html>
+"""
+
+EXPECTED_ITEMS = [
+    {"sender": "はなこ", "content": "こんにちは 元気ですか？\nよろしく", "time": "02/29 12:00",
+     "is_unreplied": False, "reply_url": "/my/mail_box/history/?id=1"},
+    {"sender": "たろう", "content": "週末は カフェに\n\n行きませんか", "time": "12:34",
+     "is_unreplied": False, "reply_url": "/my/mail_box/history/?id=2"},
+]
+
+
+def message_extract_js():
+    """app.py の MESSAGE_EXTRACT_JS（app を import すると Streamlit が動くのでソースから読む）"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "MESSAGE_EXTRACT_JS" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise AssertionError("MESSAGE_EXTRACT_JS が見つかりません")
+
+
+def test_inbox_text_matches_inner_text():
+    page = parse_inbox_page(INBOX_HTML, BASE_URL)
+    assert page["hasWrap"]
+    assert page["items"] == EXPECTED_ITEMS
+    assert page["next"] == "https://www.yyc.co.jp/my/mail_box/round_trip?filter=not_res&page=2"
+
+
+def test_history_text_matches_inbox_text():
+    turns = parse_history_page('<div class="message"><p>こんにちは\n     元気ですか？<br>\n  よろしく</p></div>')
+    assert turns == [{"text": "こんにちは 元気ですか？\nよろしく", "mine": False}]
+
+
+def test_inbox_matches_browser():
+    sync_api = pytest.importorskip("playwright.sync_api")
+    with sync_api.sync_playwright() as p:
+        try:
+            browser = p.chromium.launch()
+        except sync_api.Error as e:
+            pytest.skip(f"Chromium を起動できません: {e}")
+        try:
+            page = browser.new_page()
+            page.set_content(INBOX_HTML)
+            rows = page.evaluate(message_extract_js())
+        finally:
+            browser.close()
+    assert rows["items"] == parse_inbox_page(INBOX_HTML, BASE_URL)["items"]
@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 操作ごとのタイムアウト予算（ミリ秒）
+FETCH_BUDGET_MS = 60000
+COOKIE_CHECK_BUDGET_MS = 15000
+SEND_BUDGET_MS = 90000
+# 送信ボタンを押した後に予算を使い切っても、送信結果の確認に使う待ち時間（ミリ秒）
+SEND_CONFIRM_GRACE_MS = 5000
+
+_recent_reports = deque(maxlen=50)
+_reports_lock = threading.Lock()
+
+
+class BudgetExceeded(Exception):
+    """操作全体のタイムアウト予算を使い切った"""
+
+
+class OperationBudget:
+    """1操作（取得・送信など）全体のタイムアウト予算と、段階ごとの待ち時間の記録
+
+    各待機は remaining_ms() を timeout に渡して、操作全体が total_ms を超えないようにする。
+    """
+
+    def __init__(self, name, total_ms):
+        self.name = name
+        self.total_ms = total_ms
+        self.stages = []
+        self._started = time.perf_counter()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._started) * 1000
+
+    def remaining_ms(self, cap=None):
+        """残り予算（ミリ秒）。cap を渡すとそれ以下に切り詰める"""
+        remaining = int(self.total_ms - self.elapsed_ms())
+        if remaining <= 0:
+            raise BudgetExceeded(f"{self.name}: タイムアウト予算 {self.total_ms}ms を超えました")
+        return min(remaining, cap) if cap is not None else remaining
+
+    @contextmanager
+    def stage(self, name):
+        """with 内で実際に待った時間を段階名つきで記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.perf_counter() - started) * 1000))
+
+    def report(self):
+        return {
+            "operation": self.name,
+            "budget_ms": self.total_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 1),
+            "stages": [{"stage": name, "waited_ms": round(ms, 1)} for name, ms in self.stages],
+        }
+
+    def finish(self):
+        """記録を確定してログと直近レポートに残す"""
+        report = self.report()
+        with _reports_lock:
+            _recent_reports.append(report)
+        logger.info(
+            "%s: 合計 %.0fms（%s）", self.name, report["elapsed_ms"],
+            ", ".join(f"{s['stage']}={s['waited_ms']:.0f}ms" for s in report["stages"])
+        )
+        return report
+
+
+def recent_reports():
+    """直近の待ち時間レポート（新しい順）"""
+    with _reports_lock:
+        return list(reversed(_recent_reports))
+
+
+_recent_reruns = deque(maxlen=50)
+
+
+def record_rerun(report):
+    """Streamlit の再実行1回分の段階別所要時間を残す（ログには DEBUG でだけ出す）"""
+    with _reports_lock:
+        _recent_reruns.append(report)
+    logger.debug("rerun: %s", report)
+
+
+def recent_reruns():
+    """直近の再実行の所要時間（新しい順）"""
+    with _reports_lock:
+        return list(reversed(_recent_reruns))
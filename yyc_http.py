@@ -0,0 +1,478 @@
+"""ブラウザを使わずにHTTPでYYCにアクセスする
+
+storage_state（Playwright形式のJSON）のcookieを読み込んだ requests.Session を
+アカウントごとに使い回す（keep-alive の接続プール）。判定できない応答のときは
+呼び出し側がブラウザでの処理にフォールバックする。
+"""
+import logging
+import os
+import re
+import threading
+import time
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from storage_state import file_signature, load_storage_state, storage_file
+
+logger = logging.getLogger(__name__)
+
+# YYCのURL（ベンチマーク等でローカルのテスト用サイトに向けるときだけ変更する）
+YYC_BASE_URL = os.getenv("YYC_BASE_URL", "https://www.yyc.co.jp").rstrip("/")
+
+# 1リクエストのタイムアウト（秒）と、cookie有効性チェック結果を使い回す時間（秒）
+HTTP_TIMEOUT = float(os.getenv("YYC_HTTP_TIMEOUT", "10"))
+COOKIE_CHECK_TTL = float(os.getenv("COOKIE_CHECK_TTL_SECONDS", "600"))
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+)
+
+
+def build_session(storage_state):
+    """storage_state のcookieを入れた Session を作る"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "User-Agent": USER_AGENT,
+        "Accept-Language": "ja,en-US;q=0.8,en;q=0.6",
+    })
+    now = time.time()
+    for cookie in storage_state.get("cookies", []):
+        expires = cookie.get("expires", -1)
+        if expires and 0 < expires < now:
+            continue
+        session.cookies.set(
+            cookie["name"], cookie["value"],
+            domain=cookie.get("domain", ""), path=cookie.get("path", "/"),
+            secure=cookie.get("secure", False),
+        )
+    return session
+
+
+class AccountSessions:
+    """アカウントごとの Session（storage_state ファイルが変わったら作り直す）"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        """Session を返す。storage_state がなければ None"""
+        signature = file_signature(storage_file(email))
+        if signature is None:
+            return None
+        with self._lock:
+            cached = self._sessions.get(email)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        storage_state = load_storage_state(email)
+        if storage_state is None:
+            return None
+        session = build_session(storage_state)
+        with self._lock:
+            old = self._sessions.get(email)
+            self._sessions[email] = (signature, session)
+        if old is not None:
+            old[1].close()
+        return session
+
+
+def looks_like_login(response):
+    """ログインページに飛ばされた応答か"""
+    if "login" in response.url.lower():
+        return True
+    return "type=\"password\"" in response.text or "type='password'" in response.text
+
+
+def check_cookie_http(email):
+    """マイページをHTTPで開いてcookieが有効か判定する
+
+    有効なら True、ログインページに飛ばされたら False、
+    通信エラーや想定外の応答で判定できなければ None を返す。
+    """
+    try:
+        session = get_sessions().get(email)
+    except (OSError, ValueError) as e:
+        logger.warning("storage_state を読み込めません: %s", e)
+        return False
+    if session is None:
+        return False
+    try:
+        response = session.get(f"{YYC_BASE_URL}/mypage/", timeout=HTTP_TIMEOUT, allow_redirects=True)
+    except requests.RequestException as e:
+        logger.info("HTTPでのcookieチェックに失敗: %s", e)
+        return None
+    if looks_like_login(response):
+        return False
+    if response.status_code == 200 and "mypage" in response.url:
+        return True
+    logger.info("HTTPでのcookieチェック結果を判定できません（%s %s）", response.status_code, response.url)
+    return None
+
+
+class HttpFallback(Exception):
+    """HTTPの応答を判定できない（ログインページ・想定外のHTML）。ブラウザで処理し直す"""
+
+
+_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+# 開いている <p> を暗黙に閉じるタグ（ブラウザと同じ扱い）
+_P_CLOSERS = {"address", "article", "aside", "div", "dl", "fieldset", "footer", "form", "h1", "h2", "h3", "h4",
+              "h5", "h6", "header", "hr", "main", "nav", "ol", "p", "pre", "section", "table", "ul"}
+HISTORY_LINK_PREFIX = "/my/mail_box/history/?id="
+# innerText で改行になる要素（この境界は連続しても1つの改行）
+_BLOCK_TAGS = _P_CLOSERS | {"li", "tr"}
+# 取り出し中のテキストに入れる改行の印（<br> と要素の境界）
+LINE_BREAK = "\x00"
+BLOCK_BREAK = "\x01"
+# innerText がまとめる空白（全角スペースはまとめない）
+_COLLAPSIBLE_SPACE = re.compile(r"[ \t\n\r\f]+")
+_BLOCK_BREAKS = re.compile(BLOCK_BREAK + "+")
+
+
+def inner_text(parts):
+    """HTMLのテキスト片をブラウザの innerText と同じ形にする
+
+    ソースの空白・改行の連続は半角スペース1つにまとめ、<br>（LINE_BREAK）と
+    要素の境界（BLOCK_BREAK）だけを改行にして、各行の前後の空白を除く。
+    HTTP とブラウザのどちらで読んでも本文（スレッドIDや返信のキャッシュキーの元）が同じになる。
+    """
+    text = _COLLAPSIBLE_SPACE.sub(" ", "".join(parts))
+    text = _BLOCK_BREAKS.sub(BLOCK_BREAK, text).strip(BLOCK_BREAK + " ")
+    text = text.replace(BLOCK_BREAK, "\n").replace(LINE_BREAK, "\n")
+    return "\n".join(line.strip(" ") for line in text.split("\n")).strip("\n")
+
+
+class InboxPageParser(HTMLParser):
+    """メッセージ一覧のHTMLから、ブラウザの MESSAGE_EXTRACT_JS と同じ形の結果を作る
+
+    html.parser でタグを1回なめるだけなので、DOMを組み立てずに済む。
+    セレクターは MESSAGE_EXTRACT_JS と同じ（.name strong / .message p / .thumb + div ... / .date）。
+    テキストは innerText と同じように空白をまとめる（inner_text）。
+    結果は {"hasWrap": bool, "items": [...], "next": URL or None}。
+    """
+
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.has_wrap = False
+        self.items = []
+        self.next_url = None
+        # 開いている要素: [tag, classes, .thumb の次の div か, 直前に閉じた子要素の classes]
+        self._stack = []
+        self._root_last_child = set()
+        self._row = None
+        self._row_depth = None
+        self._captures = []  # [field, depth, parts]
+
+    def _inside(self, cls):
+        return any(cls in entry[1] for entry in self._stack)
+
+    def _after_thumb(self):
+        return any(entry[2] for entry in self._stack)
+
+    def handle_starttag(self, tag, attrs):
+        attr = dict(attrs)
+        classes = set((attr.get("class") or "").split())
+        if tag == "br":
+            self._break(LINE_BREAK)
+        elif tag in _BLOCK_TAGS:
+            self._break(BLOCK_BREAK)
+        if tag in _P_CLOSERS and self._stack and self._stack[-1][0] == "p":
+            self.handle_endtag("p")
+        parent = self._stack[-1] if self._stack else None
+        previous_sibling = parent[3] if parent else self._root_last_child
+        if "message_listWrap" in classes:
+            self.has_wrap = True
+        if tag == "a" and self.next_url is None and attr.get("href") and (attr.get("rel") == "next" or self._inside("next")):
+            self.next_url = urljoin(self.base_url, attr["href"])
+        if self._row is None and ("mdl_listBox_simple" in classes or (tag == "div" and parent and "message_listWrap" in parent[1])):
+            self._row = {"sender": None, "content": None, "time": None, "is_unreplied": False, "reply_url": None}
+            self._row_depth = len(self._stack) + 1
+        if self._row is not None:
+            self._scan_row(tag, attr, classes)
+        if tag in _VOID_TAGS:
+            if parent:
+                parent[3] = classes
+            else:
+                self._root_last_child = classes
+            return
+        self._stack.append([tag, classes, tag == "div" and "thumb" in previous_sibling, set()])
+        if self._row is not None:
+            self._start_captures(tag, classes)
+
+    def _scan_row(self, tag, attr, classes):
+        row = self._row
+        href = attr.get("href") or ""
+        if tag == "a" and row["reply_url"] is None and href.startswith(HISTORY_LINK_PREFIX):
+            row["reply_url"] = href
+        if "msgHistoryStatus" in classes and "replied" in classes:
+            row["is_unreplied"] = True
+
+    def _start_captures(self, tag, classes):
+        row = self._row
+        depth = len(self._stack)
+        capturing = {c[0] for c in self._captures}
+        after_thumb = self._after_thumb()
+        if tag == "strong" and row["sender"] is None and "sender" not in capturing and (self._inside("name") or after_thumb):
+            self._captures.append(["sender", depth, []])
+        if tag == "p" and row["content"] is None and "content" not in capturing and (self._inside("message") or after_thumb):
+            self._captures.append(["content", depth, []])
+        if "date" in classes and row["time"] is None and "time" not in capturing:
+            self._captures.append(["time", depth, []])
+
+    def handle_endtag(self, tag):
+        if tag in _VOID_TAGS:
+            return
+        # 閉じ忘れのタグがあっても、対応する開きタグまで戻る
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                break
+        else:
+            return
+        closed = self._stack[index]
+        if tag in _BLOCK_TAGS:
+            self._break(BLOCK_BREAK)
+        del self._stack[index:]
+        if self._stack:
+            self._stack[-1][3] = closed[1]
+        else:
+            self._root_last_child = closed[1]
+        depth = len(self._stack)
+        for capture in [c for c in self._captures if c[1] > depth]:
+            field, _, parts = capture
+            if self._row[field] is None:
+                self._row[field] = inner_text(parts)
+            self._captures.remove(capture)
+        if self._row is not None and depth < self._row_depth:
+            self._finish_row()
+
+    def handle_data(self, data):
+        for _, _, parts in self._captures:
+            parts.append(data)
+
+    def _break(self, mark):
+        for _, _, parts in self._captures:
+            parts.append(mark)
+
+    def _finish_row(self):
+        row = self._row
+        self._row = None
+        self._row_depth = None
+        self._captures = []
+        self.items.append({
+            "sender": row["sender"] if row["sender"] is not None else "不明",
+            "content": row["content"] or "",
+            "time": row["time"] or "",
+            "is_unreplied": row["is_unreplied"],
+            "reply_url": row["reply_url"],
+        })
+
+    def result(self):
+        if self._row is not None:
+            self._finish_row()
+        return {"hasWrap": self.has_wrap, "items": self.items, "next": self.next_url}
+
+
+def parse_inbox_page(html, base_url):
+    parser = InboxPageParser(base_url)
+    parser.feed(html)
+    parser.close()
+    return parser.result()
+
+
+def fetch_inbox_page(email, url):
+    """一覧の1ページをHTTPで取得して解析する
+
+    ログインページに飛ばされた・一覧の構造が見つからないときは HttpFallback。
+    """
+    session = get_sessions().get(email)
+    if session is None:
+        raise HttpFallback("storage_state がありません")
+    try:
+        response = session.get(url, timeout=HTTP_TIMEOUT, allow_redirects=True)
+    except requests.RequestException as e:
+        raise HttpFallback(f"通信エラー: {e}") from e
+    if looks_like_login(response):
+        raise HttpFallback(f"ログインページに飛ばされました: {response.url}")
+    if response.status_code != 200:
+        raise HttpFallback(f"HTTP {response.status_code}")
+    page = parse_inbox_page(response.text, response.url)
+    if not page["hasWrap"] and not page["items"]:
+        raise HttpFallback("メッセージ一覧の構造が見つかりません")
+    return page
+
+
+class SendFormParser(HTMLParser):
+    """履歴ページから返信フォーム（form#send-mail-form）の送信先と入力欄を取り出す
+
+    id が send-mail-form のフォームを優先し、なければ textarea[name=message] を含むフォームを使う。
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms = []
+        self._form = None
+
+    def handle_starttag(self, tag, attrs):
+        attr = dict(attrs)
+        if tag == "form":
+            self._form = {
+                "id": attr.get("id"),
+                "action": attr.get("action") or "",
+                "method": (attr.get("method") or "get").lower(),
+                "fields": [],
+                "textareas": [],
+            }
+            self.forms.append(self._form)
+        elif self._form is None:
+            return
+        elif tag == "input":
+            name = attr.get("name")
+            kind = (attr.get("type") or "text").lower()
+            if not name or kind in ("submit", "button", "image", "reset", "file"):
+                return
+            if kind in ("checkbox", "radio") and "checked" not in attr:
+                return
+            self._form["fields"].append((name, attr.get("value") or ""))
+        elif tag == "textarea" and attr.get("name"):
+            self._form["textareas"].append(attr["name"])
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+
+    def send_form(self):
+        for form in self.forms:
+            if form["id"] == "send-mail-form":
+                return form
+        for form in self.forms:
+            if "message" in form["textareas"]:
+                return form
+        return None
+
+
+def parse_send_form(html):
+    parser = SendFormParser()
+    parser.feed(html)
+    parser.close()
+    return parser.send_form()
+
+
+def fetch_history_html(email, reply_url):
+    """履歴ページ（/my/mail_box/history/?id=）のHTMLをHTTPで取得する（読めなければ HttpFallback）"""
+    session = get_sessions().get(email)
+    if session is None:
+        raise HttpFallback("storage_state がありません")
+    try:
+        response = session.get(urljoin(f"{YYC_BASE_URL}/", reply_url), timeout=HTTP_TIMEOUT, allow_redirects=True)
+    except requests.RequestException as e:
+        raise HttpFallback(f"通信エラー: {e}") from e
+    if looks_like_login(response):
+        raise HttpFallback(f"ログインページに飛ばされました: {response.url}")
+    if response.status_code != 200:
+        raise HttpFallback(f"HTTP {response.status_code}")
+    return response.text
+
+
+def send_reply_http(email, reply_url, reply_text):
+    """ブラウザを使わずに返信を送信する
+
+    履歴ページを GET してフォームの送信先と hidden フィールドを取り出し、本文を入れて POST する。
+    履歴ページへのリダイレクトが返れば成功。POST する前に判定できないこと
+    （ログインページ・フォームの形が違う）が分かったときは HttpFallback を送出する。
+    POST した後はブラウザでやり直すと二重送信になりうるため、フォールバックしない。
+    """
+    session = get_sessions().get(email)
+    if session is None:
+        raise HttpFallback("storage_state がありません")
+    page_url = urljoin(f"{YYC_BASE_URL}/", reply_url)
+    try:
+        response = session.get(page_url, timeout=HTTP_TIMEOUT, allow_redirects=True)
+    except requests.RequestException as e:
+        raise HttpFallback(f"通信エラー: {e}") from e
+    if looks_like_login(response):
+        raise HttpFallback(f"ログインページに飛ばされました: {response.url}")
+    if response.status_code != 200:
+        raise HttpFallback(f"HTTP {response.status_code}")
+    form = parse_send_form(response.text)
+    if form is None or form["method"] != "post" or "message" not in form["textareas"]:
+        raise HttpFallback("返信フォームの形が想定と違います")
+    action = urljoin(response.url, form["action"] or response.url)
+    data = [(name, value) for name, value in form["fields"] if name != "message"]
+    data.append(("message", reply_text))
+    logger.debug("返信フォーム: action=%s fields=%s", action, [name for name, _ in data])
+    try:
+        result = session.post(
+            action, data=data, timeout=HTTP_TIMEOUT, allow_redirects=False,
+            headers={"Referer": response.url, "Origin": YYC_BASE_URL},
+        )
+    except requests.RequestException as e:
+        return False, f"送信結果を確認できませんでした（{e}）。手動でご確認ください。"
+    location = result.headers.get("Location", "")
+    if result.is_redirect and "/my/mail_box/history/" in urljoin(action, location):
+        return True, "返信を送信しました"
+    if result.is_redirect and "login" in location.lower():
+        return False, "cookieでログインできませんでした。再度保存してください。"
+    logger.info("返信送信の応答を判定できません（%s %s）", result.status_code, location)
+    return False, "送信処理は完了しましたが、送信結果を確認できませんでした。手動でご確認ください。"
+
+
+class CookieCheckCache:
+    """アカウントごとのcookie有効性チェック結果（TTL付き、storage_state が変わったら無効）"""
+
+    def __init__(self, ttl=COOKIE_CHECK_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        """キャッシュ済みの結果（True/False）。なければ None"""
+        signature = file_signature(storage_file(email))
+        with self._lock:
+            entry = self._entries.get(email)
+        if entry is None:
+            return None
+        cached_signature, checked_at, valid = entry
+        if cached_signature != signature or time.time() - checked_at > self.ttl:
+            return None
+        return valid
+
+    def put(self, email, valid):
+        with self._lock:
+            self._entries[email] = (file_signature(storage_file(email)), time.time(), valid)
+
+    def invalidate(self, email=None):
+        with self._lock:
+            if email is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(email, None)
+
+
+_sessions = None
+_cookie_checks = None
+_singleton_lock = threading.Lock()
+
+
+def get_sessions():
+    """プロセス全体で共有する AccountSessions を返す"""
+    global _sessions
+    with _singleton_lock:
+        if _sessions is None:
+            _sessions = AccountSessions()
+        return _sessions
+
+
+def get_cookie_check_cache():
+    """プロセス全体で共有する CookieCheckCache を返す"""
+    global _cookie_checks
+    with _singleton_lock:
+        if _cookie_checks is None:
+            _cookie_checks = CookieCheckCache()
+        return _cookie_checks